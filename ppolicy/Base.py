@@ -17,6 +17,9 @@ except:
     # ZopeInterface package from http://zope.org/Products/ZopeInterface
     logging.getLogger().warn("can't find zope.interface, trying to use old twisted interface (it is OK twisted 1.3)")
     from twisted.python.components import Interface
+from twisted.internet import threads
+from tools import deadline
+import profiler
 
 
 __version__ = "$Revision$"
@@ -89,6 +92,10 @@ class IPPolicyCheck(Interface):
             ...
         """
 
+    def checkAsync(self, data, *args, **keywords):
+        """asynchronous version of check method that returns Deferred
+        which fires with the same tuple as check method."""
+
 
 
 class Base(object):
@@ -97,8 +104,8 @@ class Base(object):
     and "hashArg"
 
     Module arguments (see output of getParams method):
-    factory, cachePositive, cacheUnknown, cacheNegative, saveResult,
-    saveResultPrefix
+    factory, cachePositive, cacheUnknown, cacheNegative, staleTTL,
+    coalesce, saveResult, saveResultPrefix, executor, sessionMemo, optional
 
     Check arguments:
         None
@@ -117,8 +124,13 @@ class Base(object):
                'cachePositive': ('maximum time for caching positive result', 60*15),
                'cacheUnknown': ('maximum time for caching unknown result', 60*15),
                'cacheNegative': ('maximum time for caching negative result', 60*15),
+               'staleTTL': ('time expired result is still returned while it is refreshed in background', 0),
+               'coalesce': ('wait for result of the same check running in other request instead of calling module again', True),
                'saveResult': ('save returned value in data hash for further modules', True),
                'saveResultPrefix': ('prefix for saved data', 'result_'),
+               'executor': ('name of executor that limits concurrent calls of this module', ''),
+               'sessionMemo': ('reuse result for all requests from one SMTP session (same instance)', False),
+               'optional': ('module can be skipped (returns 0) when ppolicy is overloaded', False),
 #               'redefineDefaultValue': (None, 'abc'),
                }
     PERSIST_VERSION = 0
@@ -285,6 +297,19 @@ class Base(object):
             setattr(self, k, v)
 
 
+    def memoryUsage(self):
+        """Approximate memory (bytes) used by data cached by this
+        module or None if module doesn't keep such data. Called
+        periodically by factory memory budget."""
+        return None
+
+
+    def memoryLimit(self, limit):
+        """Remove cached data to use at most limit bytes (None means
+        that module memory is not limited)."""
+        pass
+
+
     def start(self):
         """Called when changing state to 'ready'."""
         pass
@@ -307,24 +332,36 @@ class Base(object):
 
 
     def hashArg(self, data, *args, **keywords):
-        """Compute hash from parameters which is then used as index to
-        the result cache. Changing this function in subclasses and
-        using only required fields for hash can improve cache usage
-        and performance.
-
-        NOTE:
-        For good hash better algorithm should be used, e.g. Item 7 in
-        Joshua Bloch's Effective Java Programming Language Guide"""
+        """Return tuple of fields which is then used to compute key
+        for the result cache (factory creates digest of these fields
+        together with module name and definition). Changing this
+        function in subclasses and using only required fields can
+        improve cache usage and performance. Returned tuple should
+        contain only strings, numbers and None (values have to be
+        same in all ppolicy processes to share results in memcache),
+        0 means that result is not cached."""
 
         if type(data) == type({}):
-            dataStr = "\n".join([ "%s=%s" % (k,v) for k,v in data.items() ])
+            dataList = [ "%s=%s" % (k,v) for k,v in data.items() ]
+            dataList.sort()
+            dataTuple = tuple(dataList)
         else:
-            dataStr = str(data)
+            dataTuple = ( str(data), )
         keys = keywords.keys()
         keys.sort()
         keywordsTuple = tuple([ "=".join([x, str(keywords[x])]) for x in keys ])
         argsTuple = tuple([ str(x) for x in args ])
-        return hash(dataStr) + hash(argsTuple) + hash(keywordsTuple)
+        return ( dataTuple, argsTuple, keywordsTuple )
+
+
+    def sessionArg(self, data, *args, **keywords):
+        """Key for results remembered for one SMTP session (requests
+        with the same instance) when sessionMemo parameter is set. It
+        has to contain all data that can change between requests of one
+        session and that are relevant for this module. Default uses
+        hashArg, modules that depend only on client can return just
+        client_address. Returning 0 disables remembering the result."""
+        return self.hashArg(data, *args, **keywords)
 
 
     def check(self, data, *args, **keywords):
@@ -342,3 +379,19 @@ class Base(object):
             ...
         """
         raise NotImplementedError("Don't call base class directly")
+
+
+    def checkAsync(self, data, *args, **keywords):
+        """Asynchronous version of check method. It is called from
+        reactor thread and returns Deferred which fires with the same
+        (code, codeEx) tuple as check. Default implementation runs
+        blocking check method in reactor thread pool, modules that
+        spend most of the time waiting for network I/O can override
+        this method and return result without occupying thread."""
+        return threads.deferToThread(deadline.callWithDeadline, data.get(deadline.DATA_KEY), profiler.call, self.getName(), self.check, data, *args, **keywords)
+
+
+    def hasCheckAsync(self):
+        """True if module overrides checkAsync with native asynchronous
+        implementation that doesn't need thread."""
+        return self.__class__.checkAsync.im_func is not Base.checkAsync.im_func
@@ -49,6 +49,7 @@ class Country(Base):
                'cachePositive': (None, 0), #
                'cacheUnknown': (None, 0),  # don't cache Country informations
                'cacheNegative': (None, 0), #
+               'sessionMemo': (None, True),
                }
 
 
@@ -76,6 +77,10 @@ class Country(Base):
         # del(self.gi)
 
 
+    def sessionArg(self, data, *args, **keywords):
+        return data.get('client_address')
+
+
     def hashArg(self, data, *args, **keywords):
         """Don't cache results of this module - always return 0"""
         return 0
@@ -11,7 +11,9 @@
 #
 import logging
 import time
+import threading
 from Base import Base, ParamError
+from tools import membudget
 
 
 __version__ = "$Revision$"
@@ -74,6 +76,9 @@ class DOS(Base):
             params = list(params)
         self.setParam('params', params)
 
+        # counters are updated by request threads and evicted by
+        # factory memory budget thread
+        self.lock = threading.Lock()
         self.cache = {}
 
 
@@ -81,13 +86,43 @@ class DOS(Base):
         self.cache = {}
 
 
+    def memoryUsage(self):
+        if getattr(self, 'lock', None) == None:
+            return None
+        self.lock.acquire()
+        try:
+            return membudget.dictUsage(self.cache)
+        finally:
+            self.lock.release()
+
+
+    def memoryLimit(self, limit):
+        if getattr(self, 'lock', None) == None:
+            return
+        self.lock.acquire()
+        try:
+            usage = membudget.dictUsage(self.cache)
+            if limit == None or usage <= limit:
+                return
+            # counters with all time windows expired can be removed
+            # without changing results
+            expire = time.time() - int(self.getParam('limitTime'))
+            for key in [ k for k, v in self.cache.items() if v[1] < expire ]:
+                del(self.cache[key])
+            # forget counters that were not updated for the longest time
+            evicted = membudget.dictLimit(self.cache, membudget.dictUsage(self.cache), limit, lambda k, v: v[1])
+        finally:
+            self.lock.release()
+        if evicted > 0:
+            logging.getLogger().warn("%s: memory limit reached, %i active counters reset" % (self.getId(), evicted))
+
+
     def hashArg(self, data, *args, **keywords):
         params = self.getParam('params')
-        hashKey = "\n".join([ "=".join([x, data.get(x, '')]) for x in params ])
         if bool(self.getParam('caseSensitive')):
-            return hash(hashKey)
+            return tuple([ data.get(x, '') for x in params ])
         else:
-            return hash(hashKey.lower())
+            return tuple([ data.get(x, '').lower() for x in params ])
 
 
     def check(self, data, *args, **keywords):
@@ -128,7 +163,11 @@ class DOS(Base):
             key = hash(keyStr)
             if not bool(self.getParam('caseSensitive')):
                 key = hash(keyStr.lower())
-            hitsum = self.__checkDos(key, incNum)
+            self.lock.acquire()
+            try:
+                hitsum = self.__checkDos(key, incNum)
+            finally:
+                self.lock.release()
             ddetail.append((key, hitsum))
             if not hasDosKey and hitsum > limitCount:
                 hasDosKey = True
@@ -147,8 +186,8 @@ class DOS(Base):
         limitInt = int(limitTime / limitGran)
         countOver = bool(self.getParam('countOver'))
 
-        if self.cache.has_key(key):
-            data, nextUpdate = self.cache.get(key, (None, None))
+        data, nextUpdate = self.cache.get(key, (None, None))
+        if data != None:
             if nextUpdate < time.time():
                 sh = long((time.time() - nextUpdate) / limitInt) + 1
                 if sh > len(data):
@@ -11,7 +11,7 @@
 #
 import logging
 from Base import Base, ParamError
-from tools import dnsbl
+from tools import dnsbl, deadline
 
 
 __version__ = "$Revision$"
@@ -44,6 +44,7 @@ class Dnsbl(Base):
                'cachePositive': (None, 6*60*60),
                'cacheUnknown': (None, 30*60),
                'cacheNegative': (None, 12*60*60),
+               'sessionMemo': (None, True),
                }
 
 
@@ -57,8 +58,12 @@ class Dnsbl(Base):
             raise ParamError("there is not %s dnsbl list in config file" % dnsblName)
 
 
+    def sessionArg(self, data, *args, **keywords):
+        return data.get('client_address')
+
+
     def hashArg(self, data, *args, **keywords):
-        return hash(data.get('client_address'))
+        return ( data.get('client_address'), )
 
 
     def check(self, data, *args, **keywords):
@@ -68,3 +73,11 @@ class Dnsbl(Base):
 
         resHit, resScore = dnsbl.check(client_address, sender, [ dnsblName ], False)
         return resHit, resScore
+
+
+    def checkAsync(self, data, *args, **keywords):
+        client_address = data.get('client_address')
+        sender = None # FIXME: we should check also sender domain!!!
+        dnsblName = self.getParam('dnsbl')
+
+        return dnsbl.checkAsync(client_address, sender, [ dnsblName ], False, data.get(deadline.DATA_KEY))
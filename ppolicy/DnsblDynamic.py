@@ -48,6 +48,7 @@ class DnsblDynamic(Base):
                'cachePositive': (None, 6*60*60),
                'cacheUnknown': (None, 30*60),
                'cacheNegative': (None, 12*60*60),
+               'sessionMemo': (None, True),
                }
 
 
@@ -91,8 +92,12 @@ class DnsblDynamic(Base):
             # match domain name looking like mm-retail-out-13101.amazon.com
             self.patternExclude.append(re.compile('[.-](out)(|-[^.]+)\.[^.]+\.[^.]+'))
 
+    def sessionArg(self, data, *args, **keywords):
+        return data.get('client_address')
+
+
     def hashArg(self, data, *args, **keywords):
-        return hash(data.get('client_address'))
+        return ( data.get('client_address'), )
 
 
     def check(self, data, *args, **keywords):
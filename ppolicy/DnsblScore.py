@@ -53,6 +53,7 @@ class DnsblScore(Base):
                'cachePositive': (None, 6*60*60), # cache DNSBL results longer time
                'cacheUnknown': (None, 30*60),    # because it consume a lot of time
                'cacheNegative': (None, 12*60*60),# to make multiple DNS requests
+               'sessionMemo': (None, True),
                }
 
 
@@ -86,8 +87,8 @@ class DnsblScore(Base):
                     val = val[val.rfind('@')+1:]
                 else:
                     val = ''
-            paramsVal.append("%s=%s" % (param, val))
-        return hash("\n".join(paramsVal))
+            paramsVal.append(val)
+        return tuple(paramsVal)
 
 
     def check(self, data, *args, **keywords):
@@ -65,10 +65,10 @@ class Dummy(Base):
 
 
     def hashArg(self, data, *args, **keywords):
-        """Compute hash from data which is then used as index
-        to the result cache. Changing this function in subclasses
-        and using only required fields for computing hash can
-        improve cache usage and performance.
+        """Return tuple of fields from data which is then used to
+        compute key for the result cache. Changing this function in
+        subclasses and using only required fields can improve cache
+        usage and performance.
         arguments:
             data -- input data
             args -- array of arguments defined in ppolicy.conf
@@ -79,7 +79,7 @@ class Dummy(Base):
             client_address, ...). So for best cache performance you should
             return value that depends only on sender address:
 
-            return hash(data.get('sender', ''))
+            return ( data.get('sender', ''), )
 
             If you return 0 it means that check method result will not
             be cached.
@@ -10,6 +10,7 @@
 # $Id$
 #
 import logging
+import threading
 from Base import Base, ParamError
 from tools import spf, dnscache
 
@@ -89,11 +90,6 @@ class Greylist(Base):
                 logging.getLogger().debug("SQL: %s" % sql)
             cursor.execute(sql)
 
-            sql = "DELETE FROM `%s` WHERE (UNIX_TIMESTAMP(`date`) + %i < UNIX_TIMESTAMP() AND `state` = 0) OR (UNIX_TIMESTAMP(`date`) + %i < UNIX_TIMESTAMP())" % (table, mustRetry, expiration)
-            if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
-                logging.getLogger().debug("SQL: %s" % sql)
-            cursor.execute(sql)
-
             cursor.close()
             conn.commit()
         except Exception, e:
@@ -101,9 +97,35 @@ class Greylist(Base):
             raise e
         #self.factory.releaseDbConnection(conn)
 
+        # check doesn't depend on removed records, so don't wait
+        # for cleanup of (possibly big) table
+        sql = "DELETE FROM `%s` WHERE (UNIX_TIMESTAMP(`date`) + %i < UNIX_TIMESTAMP() AND `state` = 0) OR (UNIX_TIMESTAMP(`date`) + %i < UNIX_TIMESTAMP())" % (table, mustRetry, expiration)
+        thread = threading.Thread(target=self.__cleanup, args=(sql,), name="%s-cleanup" % self.getName())
+        thread.setDaemon(True)
+        thread.start()
+
+
+    def __cleanup(self, sql):
+        try:
+            conn = self.factory.getDbConnection()
+            try:
+                cursor = conn.cursor()
+                try:
+                    if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
+                        logging.getLogger().debug("SQL: %s" % sql)
+                    cursor.execute(sql)
+                    conn.commit()
+                finally:
+                    cursor.close()
+            finally:
+                # this thread finishes, don't leave its connection in pool
+                self.factory.closeDbConnection(conn)
+        except Exception, e:
+            logging.getLogger().error("%s cleanup failed: %s" % (self.getName(), e))
+
 
     def hashArg(self, data, *args, **keywords):
-        return hash("\n".join([ "%s=%s" % (x, data.get(x, '').lower()) for x in [ 'sender', 'recipient', 'client_address' ] ]))
+        return tuple([ data.get(x, '').lower() for x in [ 'sender', 'recipient', 'client_address' ] ])
 
 
     def check(self, data, *args, **keywords):
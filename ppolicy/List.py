@@ -13,6 +13,7 @@ import logging
 import time
 import threading
 from Base import Base, ParamError
+from tools import membudget
 
 
 __version__ = "$Revision$"
@@ -70,7 +71,12 @@ class List(Base):
                'cacheAllExpire': ('expire cache not successfuly refreshed during this time', 60*60),
                }
     DB_ENGINE="ENGINE=InnoDB"
-    
+    # records cached with cacheAll are saved in state file, so they
+    # can be used immediately after restart
+    PERSIST_VERSION = 1
+    PERSIST_DATA = [ 'allDataSnapshot' ]
+    allDataSnapshot = None
+
 
     def __retcolsSQL(self, retcols):
         retcolsSQL = ''
@@ -93,14 +99,29 @@ class List(Base):
         else: # *, COUNT(*), AVG(column), ...
             retcolsSQL = retcols
 
-        logging.getLogger().debug("retcols: %s %s %s" % (retcols, retcolsNew, retcolsSQL))
+        logging.getLogger().debug("retcols: %s %s %s", retcols, retcolsNew, retcolsSQL)
 
         return (retcolsSQL, retcolsNew)
 
 
+    def __createTable(self):
+        conn = self.factory.getDbConnection()
+        try:
+            cursor = conn.cursor()
+            sql = self.createTableSQL
+            logging.getLogger().debug("SQL: %s", sql)
+            cursor.execute(sql)
+            cursor.close()
+            conn.commit()
+        except Exception, e:
+            cursor.close()
+            raise e
+
+
     def __cacheAllRefresh(self):
         """This method has to be called from synchronized block."""
-        allDataCacheUpdated = 0
+        allDataCacheUpdated = self.allDataCacheUpdated
+        tableCreated = False
 
         while not self.allDataCacheStop:
             conn = None
@@ -115,13 +136,18 @@ class List(Base):
             try:
                 newCache = {}
 
+                if not tableCreated:
+                    # schema check deferred from start
+                    self.__createTable()
+                    tableCreated = True
+
                 conn = self.factory.getDbConnection()
                 cursor = conn.cursor()
 
                 sql = self.selectAllSQL
-                logging.getLogger().debug("SQL: %s" % sql)
+                logging.getLogger().debug("SQL: %s", sql)
                 cursor.execute(sql)
-                logging.getLogger().info("cached %s records for %ss (%ss)" % (int(cursor.rowcount), self.getParam('cacheAllRefresh'), self.getParam('cacheAllExpire')))
+                logging.getLogger().info("cached %s records for %ss (%ss)", int(cursor.rowcount), self.getParam('cacheAllRefresh'), self.getParam('cacheAllExpire'))
                 while True:
                     res = cursor.fetchone()
                     if res == None:
@@ -147,6 +173,7 @@ class List(Base):
                 self.allDataCacheReady = True
 
                 allDataCacheUpdated = time.time()
+                self.allDataSnapshot = (self.selectAllSQL, allDataCacheUpdated, newCache)
                 allDataCacheRefresh = self.getParam('cacheAllRefresh')
             except Exception, e:
                 logging.getLogger().error("caching all records failed: %s" % e)
@@ -180,11 +207,11 @@ class List(Base):
         for par in param:
             parVal = str(data.get(par, ''))
             if cacheCaseSensitive or type(parVal) != str:
-                paramValue.append("%s=%s" % (par, parVal))
+                paramValue.append(parVal)
             else:
-                paramValue.append("%s=%s" % (par, parVal.lower()))
+                paramValue.append(parVal.lower())
 
-        return hash("\n".join(paramValue))
+        return tuple(paramValue)
 
 
     def start(self):
@@ -210,19 +237,10 @@ class List(Base):
         if type(retcols) != type([]):
             retcols = []
 
-        conn = self.factory.getDbConnection()
-        try:
-            cursor = conn.cursor()
-            sql = "CREATE TABLE IF NOT EXISTS `%s` (`%s` VARCHAR(100) NOT NULL, PRIMARY KEY (`%s`)) %s" % (table, "` VARCHAR(100) NOT NULL, `".join(column+retcols), "`, `".join(column), List.DB_ENGINE)
-            logging.getLogger().debug("SQL: %s" % sql)
-            cursor.execute(sql)
-            cursor.close()
-            conn.commit()
-        except Exception, e:
-            cursor.close()
-            raise e
+        self.createTableSQL = "CREATE TABLE IF NOT EXISTS `%s` (`%s` VARCHAR(100) NOT NULL, PRIMARY KEY (`%s`)) %s" % (table, "` VARCHAR(100) NOT NULL, `".join(column+retcols), "`, `".join(column), List.DB_ENGINE)
 
         if not self.getParam('cacheAll', False):
+            self.__createTable()
             self.lock = threading.Lock()
             self.cache = {}
         else:
@@ -239,15 +257,42 @@ class List(Base):
             self.allDataCache = {}
             self.allDataCacheStop = False
             self.allDataCacheReady = False
+            self.allDataCacheUpdated = 0
+            snapshot = self.allDataSnapshot
+            if snapshot != None and snapshot[0] == self.selectAllSQL and snapshot[1] + self.getParam('cacheAllExpire') > time.time():
+                logging.getLogger().info("using %i records cached %is ago", len(snapshot[2]), int(time.time() - snapshot[1]))
+                self.allDataCache = snapshot[2]
+                self.allDataCacheReady = True
+                self.allDataCacheUpdated = snapshot[1]
             self.allDataCacheCondition = threading.Condition()
             self.allDataCacheThread = threading.Thread(target=self.__cacheAllRefresh)
             self.allDataCacheThread.daemon = True
             self.allDataCacheThread.start()
 
 
+    def memoryUsage(self):
+        """Memory used by records cached with cacheAll (they can't
+        be evicted) or by memCache results."""
+        if getattr(self, 'allDataCache', None) != None:
+            return membudget.dictUsage(self.allDataCache)
+        if getattr(self, 'cache', None) != None:
+            return membudget.dictUsage(self.cache)
+        return None
+
+
+    def memoryLimit(self, limit):
+        if getattr(self, 'cache', None) == None:
+            return
+        self.lock.acquire()
+        try:
+            membudget.dictLimit(self.cache, membudget.dictUsage(self.cache), limit, lambda k, v: v[1])
+        finally:
+            self.lock.release()
+
+
     def stop(self):
         """Called when changing state to 'stopped'."""
-        if getattr(self, 'allDataCacheThread') != None:
+        if getattr(self, 'allDataCacheThread', None) != None:
             self.allDataCacheStop = True
 
             self.allDataCacheCondition.acquire()
@@ -346,7 +391,7 @@ class List(Base):
                 sql = "SELECT %s FROM `%s` %s" % (self.retcolsSQL, table, sqlWhere)
 
                 if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
-                    logging.getLogger().debug("SQL: %s %s" % (sql, str(paramVal)))
+                    logging.getLogger().debug("SQL: %s %s", sql, paramVal)
                 cursor.execute(sql, paramVal)
 
                 if int(cursor.rowcount) > 0:
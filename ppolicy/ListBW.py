@@ -13,6 +13,7 @@ import logging
 import time
 import threading
 from Base import Base, ParamError
+from tools import membudget
 
 
 __version__ = "$Revision$"
@@ -66,6 +67,11 @@ class ListBW(Base):
                'cacheAllExpire': ('expire cache not successfuly refreshed during this time', 60*60),
                }
     DB_ENGINE="ENGINE=InnoDB"
+    # records cached with cacheAll are saved in state file, so they
+    # can be used immediately after restart
+    PERSIST_VERSION = 1
+    PERSIST_DATA = [ 'allDataSnapshot' ]
+    allDataSnapshot = None
 
 
     def __defaultMapping(self, mapping):
@@ -113,14 +119,30 @@ class ListBW(Base):
         else: # *, COUNT(*), AVG(column), ...
             retcolsSQL = retcols
 
-        logging.getLogger().debug("retcols: %s %s %s" % (retcols, retcolsNew, retcolsSQL))
+        logging.getLogger().debug("retcols: %s %s %s", retcols, retcolsNew, retcolsSQL)
 
         return (retcolsSQL, retcolsNew)
 
 
+    def __createTables(self):
+        conn = self.factory.getDbConnection()
+        cursor = conn.cursor()
+        try:
+            for sql in self.createTableSQL:
+                logging.getLogger().debug("SQL: %s", sql)
+                cursor.execute(sql)
+            cursor.close()
+            conn.commit()
+        except Exception, e:
+            cursor.close()
+            raise e
+        #self.factory.releaseDbConnection(conn)
+
+
     def __cacheAllRefresh(self):
         """This method has to be called from synchronized block."""
-        allDataCacheUpdated = 0
+        allDataCacheUpdated = self.allDataCacheUpdated
+        tableCreated = False
 
         while not self.allDataCacheStop:
             conn = None
@@ -133,14 +155,19 @@ class ListBW(Base):
                 newCacheWhitelist = {}
                 newCacheBlacklist = {}
 
+                if not tableCreated:
+                    # schema check deferred from start
+                    self.__createTables()
+                    tableCreated = True
+
                 conn = self.factory.getDbConnection()
                 cursor = conn.cursor()
 
                 if self.tableWhitelist != None:
                     sql = self.selectAllSQLWhitelist
-                    logging.getLogger().debug("SQL: %s" % sql)
+                    logging.getLogger().debug("SQL: %s", sql)
                     cursor.execute(sql)
-                    logging.getLogger().info("whitelist cached %s records for %ss (%ss)" % (int(cursor.rowcount), self.getParam('cacheAllRefresh'), self.getParam('cacheAllExpire')))
+                    logging.getLogger().info("whitelist cached %s records for %ss (%ss)", int(cursor.rowcount), self.getParam('cacheAllRefresh'), self.getParam('cacheAllExpire'))
                     while True:
                         res = cursor.fetchone()
                         if res == None:
@@ -162,9 +189,9 @@ class ListBW(Base):
 
                 if self.tableBlacklist != None:
                     sql = self.selectAllSQLBlacklist
-                    logging.getLogger().debug("SQL: %s" % sql)
+                    logging.getLogger().debug("SQL: %s", sql)
                     cursor.execute(sql)
-                    logging.getLogger().info("blacklist cached %s records for %ss (%ss)" % (int(cursor.rowcount), self.getParam('cacheAllRefresh'), self.getParam('cacheAllExpire')))
+                    logging.getLogger().info("blacklist cached %s records for %ss (%ss)", int(cursor.rowcount), self.getParam('cacheAllRefresh'), self.getParam('cacheAllExpire'))
                     while True:
                         res = cursor.fetchone()
                         if res == None:
@@ -191,6 +218,7 @@ class ListBW(Base):
                 self.allDataCacheReady = True
 
                 allDataCacheUpdated = time.time()
+                self.allDataSnapshot = ((self.selectAllSQLWhitelist, self.selectAllSQLBlacklist), allDataCacheUpdated, newCacheWhitelist, newCacheBlacklist)
                 allDataCacheRefresh = self.getParam('cacheAllRefresh')
             except Exception, e:
                 logging.getLogger().error("caching all records failed: %s" % e)
@@ -220,12 +248,12 @@ class ListBW(Base):
         paramValue = []
         for par in self.param:
             parVal = str(data.get(par, ''))
-            if self.cacheCaseSensitive and type(parVal) != str:
-                paramValue.append("%s=%s" % (par, parVal))
+            if self.cacheCaseSensitive or type(parVal) != str:
+                paramValue.append(parVal)
             else:
-                paramValue.append("%s=%s" % (par, parVal.lower()))
+                paramValue.append(parVal.lower())
 
-        return hash("\n".join(paramValue))
+        return tuple(paramValue)
 
 
     def start(self):
@@ -284,7 +312,7 @@ class ListBW(Base):
         idxWhitelist = []
         if len(self.wherecolsWhitelist) > 0:
             idxWhitelist.append("INDEX `autoindex_key` (`%s`)" % "`,`".join(self.wherecolsWhitelist))
-        logging.getLogger().debug("mapping: %s" % mappingWhitelist)
+        logging.getLogger().debug("mapping: %s", mappingWhitelist)
 
         colsBlacklist = []
         colsCreateBlacklist = []
@@ -310,29 +338,19 @@ class ListBW(Base):
         idxBlacklist = []
         if len(self.wherecolsBlacklist) > 0:
             idxBlacklist.append("INDEX `autoindex_key` (`%s`)" % "`,`".join(self.wherecolsBlacklist))
-        logging.getLogger().debug("mapping: %s" % mappingBlacklist)
+        logging.getLogger().debug("mapping: %s", mappingBlacklist)
 
-        conn = self.factory.getDbConnection()
-        cursor = conn.cursor()
-        try:
-            if self.tableWhitelist != None:
-                cursor = conn.cursor()
-                sql = "CREATE TABLE IF NOT EXISTS `%s` (%s) %s" % (self.tableWhitelist, ",".join(colsCreateWhitelist+idxWhitelist), ListBW.DB_ENGINE)
-                logging.getLogger().debug("SQL: %s" % sql)
-                cursor.execute(sql)
-            if self.tableBlacklist != None:
-                cursor = conn.cursor()
-                sql = "CREATE TABLE IF NOT EXISTS `%s` (%s) %s" % (self.tableBlacklist, ",".join(colsCreateBlacklist+idxBlacklist), ListBW.DB_ENGINE)
-                logging.getLogger().debug("SQL: %s" % sql)
-                cursor.execute(sql)
-            cursor.close()
-            conn.commit()
-        except Exception, e:
-            cursor.close()
-            raise e
-        #self.factory.releaseDbConnection(conn)
+        self.createTableSQL = []
+        if self.tableWhitelist != None:
+            self.createTableSQL.append("CREATE TABLE IF NOT EXISTS `%s` (%s) %s" % (self.tableWhitelist, ",".join(colsCreateWhitelist+idxWhitelist), ListBW.DB_ENGINE))
+        if self.tableBlacklist != None:
+            self.createTableSQL.append("CREATE TABLE IF NOT EXISTS `%s` (%s) %s" % (self.tableBlacklist, ",".join(colsCreateBlacklist+idxBlacklist), ListBW.DB_ENGINE))
 
-        if self.getParam('cacheAll', False):
+        if not self.getParam('cacheAll', False):
+            self.__createTables()
+        else:
+            self.selectAllSQLWhitelist = None
+            self.selectAllSQLBlacklist = None
             if self.tableWhitelist != None:
                 groupBySQLWhitelist = ''
                 if self.retcolsSQLWhitelist == '*':
@@ -357,15 +375,31 @@ class ListBW(Base):
             self.allDataCacheBlacklist = {}
             self.allDataCacheStop = False
             self.allDataCacheReady = False
+            self.allDataCacheUpdated = 0
+            snapshot = self.allDataSnapshot
+            if snapshot != None and snapshot[0] == (self.selectAllSQLWhitelist, self.selectAllSQLBlacklist) and snapshot[1] + self.getParam('cacheAllExpire') > time.time():
+                logging.getLogger().info("using %i/%i records cached %is ago", len(snapshot[2]), len(snapshot[3]), int(time.time() - snapshot[1]))
+                self.allDataCacheWhitelist = snapshot[2]
+                self.allDataCacheBlacklist = snapshot[3]
+                self.allDataCacheReady = True
+                self.allDataCacheUpdated = snapshot[1]
             self.allDataCacheCondition = threading.Condition()
             self.allDataCacheThread = threading.Thread(target=self.__cacheAllRefresh)
             self.allDataCacheThread.daemon = True
             self.allDataCacheThread.start()
 
 
+    def memoryUsage(self):
+        """Memory used by records cached with cacheAll (they can't
+        be evicted)."""
+        if getattr(self, 'allDataCacheWhitelist', None) == None:
+            return None
+        return membudget.dictUsage(self.allDataCacheWhitelist) + membudget.dictUsage(self.allDataCacheBlacklist)
+
+
     def stop(self):
         """Called when changing state to 'stopped'."""
-        if getattr(self, 'allDataCacheThread') != None:
+        if getattr(self, 'allDataCacheThread', None) != None:
             self.allDataCacheStop = True
 
             self.allDataCacheCondition.acquire()
@@ -429,7 +463,7 @@ class ListBW(Base):
                 sql = "SELECT %s FROM `%s` %s" % (self.retcolsSQLWhitelist, self.tableWhitelist, sqlWhere)
 
                 if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
-                    logging.getLogger().debug("SQL: %s %s" % (sql, str(paramValue)))
+                    logging.getLogger().debug("SQL: %s %s", sql, paramValue)
                 cursor.execute(sql, paramValue)
 
                 if int(cursor.rowcount) > 0:
@@ -449,7 +483,7 @@ class ListBW(Base):
                 sql = "SELECT %s FROM `%s` %s" % (self.retcolsSQLBlacklist, self.tableBlacklist, sqlWhere)
 
                 if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
-                    logging.getLogger().debug("SQL: %s %s" % (sql, str(paramValue)))
+                    logging.getLogger().debug("SQL: %s %s", sql, paramValue)
                 cursor.execute(sql, paramValue)
 
                 if int(cursor.rowcount) > 0:
@@ -10,6 +10,7 @@
 # $Id$
 #
 import logging
+import threading
 from Base import Base, ParamError
 
 
@@ -136,7 +137,9 @@ class ListDyn(Base):
 
     def hashArg(self, data, *args, **keywords):
         param = self.getParam('param')
-        return hash("\n".join([ lambda x: "%s=%s" % (x, data.get(x)) for x in param ]))
+        if type(param) == str:
+            param = [ param ]
+        return tuple([ data.get(x) for x in param ])
 
 
     def start(self):
@@ -182,20 +185,15 @@ class ListDyn(Base):
         idx = []
         if len(idxNames) > 0:
             idx.append("INDEX `autoindex_key` (`%s`)" % "`,`".join(idxNames))
-        logging.getLogger().debug("mapping: %s" % mapping)
+        logging.getLogger().debug("mapping: %s", mapping)
 
         # create database table if not exist
         conn = self.factory.getDbConnection()
         cursor = conn.cursor()
         try:
             sql = "CREATE TABLE IF NOT EXISTS `%s` (%s) %s" % (table, ",".join(colsCreate+idx), ListDyn.DB_ENGINE)
-            logging.getLogger().debug("SQL: %s" % sql)
+            logging.getLogger().debug("SQL: %s", sql)
             cursor.execute(sql)
-            if hardExpire > 0:
-                colName = self.mapping['hard_expire']
-                sql = "DELETE FROM `%s` WHERE UNIX_TIMESTAMP(`%s`) < UNIX_TIMESTAMP()" % (table, colName)
-                logging.getLogger().debug("SQL: %s" % sql)
-                cursor.execute(sql)
             cursor.close()
             conn.commit()
         except Exception, e:
@@ -203,6 +201,33 @@ class ListDyn(Base):
             raise e
         #self.factory.releaseDbConnection(conn)
 
+        if hardExpire > 0:
+            # expired records are ignored by check, so don't wait
+            # for cleanup of (possibly big) table
+            colName = self.mapping['hard_expire']
+            sql = "DELETE FROM `%s` WHERE UNIX_TIMESTAMP(`%s`) < UNIX_TIMESTAMP()" % (table, colName)
+            thread = threading.Thread(target=self.__cleanup, args=(sql,), name="%s-cleanup" % self.getName())
+            thread.setDaemon(True)
+            thread.start()
+
+
+    def __cleanup(self, sql):
+        try:
+            conn = self.factory.getDbConnection()
+            try:
+                cursor = conn.cursor()
+                try:
+                    logging.getLogger().debug("SQL: %s", sql)
+                    cursor.execute(sql)
+                    conn.commit()
+                finally:
+                    cursor.close()
+            finally:
+                # this thread finishes, don't leave its connection in pool
+                self.factory.closeDbConnection(conn)
+        except Exception, e:
+            logging.getLogger().error("%s cleanup failed: %s" % (self.getName(), e))
+
 
     def check(self, data, *args, **keywords):
         operation = self.dataArg(0, 'operation', None, *args, **keywords)
@@ -220,7 +245,7 @@ class ListDyn(Base):
         if type(param) == str:
             param = [ param ]
 
-        logging.getLogger().debug("%s; %s; %s; %s; %s; %s; %s; %s" % (data, operation, value, softExpire, hardExpire, table, param, retcols))
+        logging.getLogger().debug("%s; %s; %s; %s; %s; %s; %s; %s", data, operation, value, softExpire, hardExpire, table, param, retcols)
 
         # create all parameter combinations (cartesian product)
         valX = []
@@ -270,7 +295,7 @@ class ListDyn(Base):
                 # add
                 if operation == 'add':
                     sql = "SELECT 1 FROM `%s` WHERE %s" % (table, where)
-                    logging.getLogger().debug("SQL: %s %s" % (sql, str(tuple(whereData))))
+                    logging.getLogger().debug("SQL: %s %s", sql, tuple(whereData))
                     cursor.execute(sql, tuple(whereData))
                     if int(cursor.rowcount) == 0:
                         colNames = colNV.keys() + colNVadd.keys()
@@ -283,7 +308,7 @@ class ListDyn(Base):
                             colNames.append(self.mapping['hard_expire'])
                             colExpire.append("FROM_UNIXTIME(UNIX_TIMESTAMP()+%i)" % hardExpire)
                         sql = "INSERT INTO `%s` (`%s`) VALUES (%s)" % (table, "`,`".join(colNames), ",".join([ "%s" for x in colValues ] + colExpire))
-                        logging.getLogger().debug("SQL: %s %s" % (sql, str(tuple(colValues))))
+                        logging.getLogger().debug("SQL: %s %s", sql, tuple(colValues))
                         cursor.execute(sql, tuple(colValues))
                     else:
                         if len(retcols) > 0 or softExpire != 0 or hardExpire != 0:
@@ -300,12 +325,12 @@ class ListDyn(Base):
                                 sfExp.append("`%s`=%%s" % colName)
                                 sfVal.append(colNVadd[colName])
                             sql = "UPDATE `%s` SET %s WHERE %s" % (table, ",".join(sfExp), where)
-                            logging.getLogger().debug("SQL: %s %s" % (sql, str(tuple(sfVal+whereData))))
+                            logging.getLogger().debug("SQL: %s %s", sql, tuple(sfVal+whereData))
                             cursor.execute(sql, tuple(sfVal+whereData))
                 # remove
                 elif operation == 'remove':
                     sql = "DELETE FROM `%s` WHERE %s" % (table, where)
-                    logging.getLogger().debug("SQL: %s %s" % (sql, str(tuple(whereData))))
+                    logging.getLogger().debug("SQL: %s %s", sql, tuple(whereData))
                     cursor.execute(sql, tuple(whereData))
                 # check
                 elif operation == 'check':
@@ -326,7 +351,7 @@ class ListDyn(Base):
                     if len(sfExp) == 0:
                         sfExp.append("1")
                     sql = "SELECT %s FROM `%s` WHERE %s" % (",".join(sfExp), table, where)
-                    logging.getLogger().debug("SQL: %s %s" % (sql, str(tuple(whereData))))
+                    logging.getLogger().debug("SQL: %s %s", sql, tuple(whereData))
                     cursor.execute(sql, tuple(whereData))
                     retCodeNew = -1
                     if int(cursor.rowcount) > 0:
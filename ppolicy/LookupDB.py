@@ -210,11 +210,11 @@ class LookupDB(Base):
         for par in param:
             parVal = str(data.get(par, ''))
             if cacheCaseSensitive:
-                paramValue.append("%s=%s" % (par, parVal))
+                paramValue.append(parVal)
             else:
-                paramValue.append("%s=%s" % (par, parVal.lower()))
+                paramValue.append(parVal.lower())
 
-        return hash("\n".join(paramValue))
+        return tuple(paramValue)
 
 
     def start(self):
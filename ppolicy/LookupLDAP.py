@@ -12,6 +12,7 @@
 import logging
 import ldap
 from Base import Base, ParamError
+from tools import deadline
 
 
 __version__ = "$Revision$"
@@ -89,7 +90,7 @@ class LookupLDAP(Base):
 
     def hashArg(self, data, *args, **keywords):
         param = self.getParam('param', None, keywords)
-        return hash(data.get(param, ''))
+        return ( data.get(param, ''), )
 
 
     def check(self, data, *args, **keywords):
@@ -107,7 +108,10 @@ class LookupLDAP(Base):
 
         retVal = []
         try:
-            retVal = self._ldap.search_s(base, scope, queryFilter, attributes)
+            timeout = deadline.timeout(-1)
+            if timeout == 0:
+                raise deadline.DeadlineExceeded()
+            retVal = self._ldap.search_st(base, scope, queryFilter, attributes, 0, timeout)
         except Exception, e:
             return 0, str(e)
 
@@ -62,6 +62,7 @@ class P0f(Base):
                'cachePositive': (None, 60*60),
                'cacheUnknown': (None, 60*15),
                'cacheNegative': (None, 60*60),
+               'sessionMemo': (None, True),
                }
 
 
@@ -77,8 +78,12 @@ class P0f(Base):
         self.reIPv4 = re.compile('^(25[0-5]|2[0-4]\d|[01]?\d?\d)(\.(25[0-5]|2[0-4]\d|[01]?\d?\d)){3}$')
 
 
+    def sessionArg(self, data, *args, **keywords):
+        return data.get('client_address')
+
+
     def hashArg(self, data, *args, **keywords):
-        return hash(data.get('client_address'))
+        return ( data.get('client_address'), )
 
 
     def check(self, data, *args, **keywords):
@@ -10,8 +10,9 @@
 # $Id$
 #
 import logging
+from twisted.internet import defer
 from Base import Base, ParamError
-from tools import dnscache
+from tools import dnscache, dnsasync, deadline
 
 
 __version__ = "$Revision$"
@@ -65,7 +66,7 @@ class Resolve(Base):
 
     def hashArg(self, data, *args, **keywords):
         param = self.getParam('param')
-        return hash("%s=%s" % (param, data.get(param)))
+        return ( data.get(param), )
 
 
     def check(self, data, *args, **keywords):
@@ -94,6 +95,24 @@ class Resolve(Base):
         return 1, "%s resolve ok" % self.getId()
 
 
+    def checkAsync(self, data, *args, **keywords):
+        param = self.getParam('param')
+        resolveType = self.getParam('type')
+        paramValue = data.get(param, [])
+
+        if type(paramValue) == tuple:
+            paramValue = list(paramValue)
+        if type(paramValue) != list:
+            paramValue = [ paramValue ]
+
+        if paramValue in [ None, [], [ None ] ]:
+            expl = "%s: no test data for %s" % (self.getId(), param)
+            logging.getLogger().warn(expl)
+            return defer.succeed((0, expl))
+
+        return self.__testResolveAsync(paramValue, resolveType.lower(), data.get(deadline.DATA_KEY))
+
+
     def __testResolve(self, dta, resType):
         retval = False
         if resType == 'ip->name':
@@ -128,3 +147,80 @@ class Resolve(Base):
                     else:
                         if dta.lower() in names: retval = True
         return retval
+
+
+    def __testResolveAsync(self, paramValue, resType, deadlineTime):
+        """Test values one after another same way as check method."""
+        if len(paramValue) == 0:
+            return defer.succeed((1, "%s resolve ok" % self.getId()))
+        dta = paramValue[0]
+
+        def testCallback(retval):
+            if not retval:
+                return -1, "%s can't resolve %s or DNS misconfiguration" % (self.getId(), dta)
+            return self.__testResolveAsync(paramValue[1:], resType, deadlineTime)
+
+        def testErrback(err):
+            err.trap(dnscache.DNSCacheError)
+            logging.getLogger().debug("%s can't resolve %s, DNS error: %s" % (self.getId(), dta, err.getErrorMessage()))
+            return -1, "%s can't resolve %s, DNS error" % (self.getId(), dta)
+
+        try:
+            d = self.__testResolveDeferred(dta, resType, deadlineTime)
+        except Exception, e:
+            d = defer.fail(e)
+        d.addCallbacks(testCallback, testErrback)
+        return d
+
+
+    def __testResolveDeferred(self, dta, resType, deadlineTime):
+        """Asynchronous version of __testResolve, returns Deferred
+        that fires with True or False."""
+        def hasResult(res):
+            return len(res) > 0
+
+        def resolveAll(values, f, test):
+            # resolve all values and fail on first DNS error
+            def resolveAllCallback(results):
+                retval = False
+                for success, res in results:
+                    if not success:
+                        return res
+                    if test(res): retval = True
+                return retval
+            dl = [ f(x) for x in values ]
+            d = defer.DeferredList(dl, consumeErrors=True)
+            d.addCallback(resolveAllCallback)
+            return d
+
+        if resType == 'ip->name':
+            d = dnsasync.getNameForIp(dta, deadlineTime)
+            d.addCallback(hasResult)
+        elif resType == 'name->ip':
+            d = dnsasync.getIpForName(dta, deadlineTime=deadlineTime)
+            d.addCallback(hasResult)
+        elif resType == 'name->mx':
+            d = dnsasync.getDomainMailhosts(dta, local=False, deadlineTime=deadlineTime)
+            d.addCallback(hasResult)
+        elif resType == 'ip->name->ip' or resType == 'ip1->name->ip2' or resType == 'ip->name->mx':
+            if resType == 'ip->name->mx':
+                f = lambda x: dnsasync.getDomainMailhosts(x, local=False, deadlineTime=deadlineTime)
+                test = hasResult
+            elif resType == 'ip1->name->ip2':
+                f = lambda x: dnsasync.getIpForName(x, deadlineTime=deadlineTime)
+                test = hasResult
+            else:
+                f = lambda x: dnsasync.getIpForName(x, deadlineTime=deadlineTime)
+                test = lambda ips: dta in ips
+            d = dnsasync.getNameForIp(dta, deadlineTime)
+            d.addCallback(resolveAll, f, test)
+        elif resType == 'name->ip->name' or resType == 'name1->ip->name2':
+            if resType == 'name1->ip->name2':
+                test = hasResult
+            else:
+                test = lambda names: dta.lower() in map(lambda x: x.lower(), names)
+            d = dnsasync.getIpForName(dta, deadlineTime=deadlineTime)
+            d.addCallback(resolveAll, lambda x: dnsasync.getNameForIp(x, deadlineTime), test)
+        else:
+            d = defer.succeed(False)
+        return d
@@ -51,7 +51,7 @@ class SPF(Base):
 
 
     def hashArg(self, data, *args, **keywords):
-        return hash("\n".join(map(lambda x: "%s=%s" % (x, data.get(x, '').lower()), [ 'sender', 'client_address', 'client_name' ])))
+        return tuple([ data.get(x, '').lower() for x in [ 'sender', 'client_address', 'client_name' ] ])
 
 
     def check(self, data, *args, **keywords):
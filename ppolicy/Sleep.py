@@ -11,6 +11,7 @@
 #
 import logging
 import time
+from twisted.internet import reactor, defer
 from Base import Base
 
 
@@ -57,3 +58,9 @@ class Sleep(Base):
     def check(self, data, *args, **keywords):
         time.sleep(self.sleep)
         return 0, 'Sleep'
+
+
+    def checkAsync(self, data, *args, **keywords):
+        d = defer.Deferred()
+        reactor.callLater(self.sleep, d.callback, (0, 'Sleep'))
+        return d
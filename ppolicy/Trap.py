@@ -12,7 +12,9 @@
 #
 import logging
 import time
+import threading
 from Base import Base, ParamError
+from tools import membudget
 
 
 __version__ = "$Revision$"
@@ -62,17 +64,56 @@ class Trap(Base):
             if self.getParam(attr) == None:
                 raise ParamError("parameter \"%s\" has to be specified for this module" % attr)
 
-        # NOTE: this dict should be synchronized
+        # updated by request threads and evicted by factory memory
+        # budget thread
+        self.lock = threading.Lock()
         self.trap = {}
 
 
     def stop(self):
-        del(self.trap)
+        self.lock.acquire()
+        try:
+            self.trap = {}
+        finally:
+            self.lock.release()
+
+
+    def memoryUsage(self):
+        if getattr(self, 'lock', None) == None:
+            return None
+        self.lock.acquire()
+        try:
+            return membudget.dictUsage(self.trap)
+        finally:
+            self.lock.release()
+
+
+    def memoryLimit(self, limit):
+        if getattr(self, 'lock', None) == None:
+            return
+        self.lock.acquire()
+        try:
+            usage = membudget.dictUsage(self.trap)
+            if limit == None or usage <= limit:
+                return
+            # clients with all records expired are handled same way
+            # as unknown clients
+            now = time.time()
+            for key in [ k for k, v in self.trap.items() if max(v + [ 0 ]) < now ]:
+                del(self.trap[key])
+            # forget clients with the oldest trap records
+            evicted = membudget.dictLimit(self.trap, membudget.dictUsage(self.trap), limit, lambda k, v: max(v + [ 0 ]))
+        finally:
+            self.lock.release()
+        if evicted > 0:
+            logging.getLogger().warn("%s: memory limit reached, %i trapped clients forgotten" % (self.getId(), evicted))
 
 
     def hashArg(self, data, *args, **keywords):
         traps = self.dataArg(0, 'traps', [], *args, **keywords)
-        return hash("client_address=%s\ntraps=%s" % (data.get('client_address'), str(traps)))
+        if type(traps) == list:
+            traps = tuple(traps)
+        return ( data.get('client_address'), traps )
 
 
     def check(self, data, *args, **keywords):
@@ -93,36 +134,40 @@ class Trap(Base):
         if recipient == 'postmaster' or recipient[:11] == 'postmaster@':
             return 0, "%s accept mail from postmaster" % self.getId()
         
-        if recipient in traps:
-            # add to trap cache
-            newTrap = []
-            for expire in self.trap.get(client_address, []):
-                if expire > time.time():
-                    newTrap.append(expire)
-
-            if len(newTrap) > treshold:
-                newTrap.pop()
-            newTrap.insert(0, time.time() + expire)
-            self.trap[client_address] = newTrap
-            return Trap.CHECK_RESULT_TRAP, "%s: do nothing with trapped message" % self.getId()
-        else:
-            # RFC 2821, section 4.1.1.3
-            # see RCTP TO: grammar
-            if recipient == 'postmaster' or recipient[:11] == 'postmaster@':
-                return 0, "%s always accept postmaster as recipient" % self.getId()
+        self.lock.acquire()
+        try:
+            if recipient in traps:
+                # add to trap cache
+                newTrap = []
+                for expire in self.trap.get(client_address, []):
+                    if expire > time.time():
+                        newTrap.append(expire)
+
+                if len(newTrap) > treshold:
+                    newTrap.pop()
+                newTrap.insert(0, time.time() + expire)
+                self.trap[client_address] = newTrap
+                return Trap.CHECK_RESULT_TRAP, "%s: do nothing with trapped message" % self.getId()
+            else:
+                # RFC 2821, section 4.1.1.3
+                # see RCTP TO: grammar
+                if recipient == 'postmaster' or recipient[:11] == 'postmaster@':
+                    return 0, "%s always accept postmaster as recipient" % self.getId()
             
-            thisTrap = self.trap.get(client_address, [])
-            if len(thisTrap) > 0 and thisTrap[len(thisTrap)-1] < time.time():
-                # remove expired
-                for i in range(0, len(thisTrap)):
-                    if thisTrap[i] < time.time():
-                        thisTrap = thisTrap[:i]
-                        break
-
-            thisTrap.append(time.time())
-            self.trap[client_address] = thisTrap
-
-            if len(thisTrap) > treshold:
-                return 1, "%s blacklisted your client address" % self.getId()
-
-            return -1, "%s did not blacklisted your client address" % self.getId()
+                thisTrap = self.trap.get(client_address, [])
+                if len(thisTrap) > 0 and thisTrap[len(thisTrap)-1] < time.time():
+                    # remove expired
+                    for i in range(0, len(thisTrap)):
+                        if thisTrap[i] < time.time():
+                            thisTrap = thisTrap[:i]
+                            break
+
+                thisTrap.append(time.time())
+                self.trap[client_address] = thisTrap
+
+                if len(thisTrap) > treshold:
+                    return 1, "%s blacklisted your client address" % self.getId()
+
+                return -1, "%s did not blacklisted your client address" % self.getId()
+        finally:
+            self.lock.release()
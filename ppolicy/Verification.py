@@ -13,7 +13,7 @@ import logging
 import socket
 from Base import Base, ParamError
 from ListDyn import ListDyn
-from tools import dnscache, smtplib
+from tools import dnscache, smtplib, deadline
 
 
 __version__ = "$Revision$"
@@ -133,9 +133,9 @@ class Verification(Base):
             if domain == None:
                 return 0
             else:
-                return hash("%s" % domain)
+                return ( None, domain )
         else:
-            return hash("%s@%s" % (user, domain))
+            return ( user, domain )
 
 
     def check(self, data, *args, **keywords):
@@ -211,6 +211,8 @@ class Verification(Base):
         maxMXToTry = 3
         for mailhost in mailhosts:
             # FIXME: how many MX try? timeout?
+            if deadline.expired():
+                break
             logging.getLogger().debug("trying to check %s for %s@%s" % (mailhost, user, domain))
             code, codeEx = self.checkMailhost(mailhost, domain, user)
             logging.getLogger().debug("checking returned: %s (%s)" % (code, codeEx))
@@ -250,7 +252,7 @@ class Verification(Base):
         communication see RFC 2821, section 4.3.2"""
 
         param = self.getParam('param')
-        timeout = self.getParam('timeout')
+        timeout = deadline.timeout(self.getParam('timeout'))
         try:
             conn = smtplib.SMTP(mailhost, timeout=timeout)
             if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
@@ -0,0 +1,695 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Check module benchmarks
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+# Run all check modules in tight loop with local stand-ins for
+# database (SQLite), DNS, LDAP and p0f, so results doesn't depend
+# on network and external services. Results can be saved as baseline
+# and compared with later runs (e.g. before release):
+#
+#   python bench.py --save bench-2.7.0.json
+#   python bench.py --compare bench-2.7.0.json List Resolve
+#
+# Local result cache scaling with number of threads (single lock
+# and sharded cache) can be measured by
+#
+#   python bench.py --cache-threads=1,4,16,40
+#
+# and memcache round trips saved by tiered cache engine (with local
+# memcache stand-in) by
+#
+#   python bench.py --cache-tiered
+#
+import sys, os, re, gc
+import time
+import random
+import struct
+import socket
+import tempfile
+import threading
+import resource
+import logging
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+
+__version__ = "$Revision$"
+
+
+class SQLiteCursor:
+    """MySQLdb like cursor for SQLite connection (format paramstyle,
+    rowcount for SELECT and MySQL functions used by modules)."""
+
+    reEngine = re.compile(r'\s(ENGINE|TYPE)\s*=\s*\w+', re.IGNORECASE)
+    reIndex = re.compile(r',\s*(UNIQUE\s+)?(INDEX|KEY)\s+`[^`]*`\s*(\([^)]*\))', re.IGNORECASE)
+    reTable = re.compile(r'CREATE\s+TABLE\s+(IF\s+NOT\s+EXISTS\s+)?`([^`]*)`', re.IGNORECASE)
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.rows = []
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, sql, params = None):
+        sql = self.reEngine.sub('', sql)
+        # SQLite doesn't support index definition in CREATE TABLE
+        table = self.reTable.match(sql.strip())
+        if table != None:
+            for i, (unique, index, columns) in enumerate(self.reIndex.findall(sql)):
+                self.cursor.execute(self.reIndex.sub('', sql))
+                sql = "CREATE %sINDEX IF NOT EXISTS `%s_%i` ON `%s` %s" % (unique, table.group(2), i, table.group(2), columns)
+        if params != None:
+            if type(params) not in (list, tuple):
+                # MySQLdb accepts single value instead of sequence
+                params = [ params ]
+            sql = sql.replace('%s', '?').replace('%%', '%')
+            self.cursor.execute(sql, tuple(params))
+        else:
+            self.cursor.execute(sql)
+        self.description = self.cursor.description
+        if self.description != None:
+            self.rows = self.cursor.fetchall()
+            self.rowcount = len(self.rows)
+        else:
+            self.rows = []
+            self.rowcount = self.cursor.rowcount
+        return self.rowcount
+
+    def fetchone(self):
+        if len(self.rows) == 0:
+            return None
+        return self.rows.pop(0)
+
+    def fetchall(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    """MySQLdb like connection to in-memory SQLite database."""
+
+    def __init__(self):
+        import sqlite3
+        self.conn = sqlite3.connect(':memory:', check_same_thread = False)
+        self.conn.text_factory = str
+        fmt = "%Y-%m-%d %H:%M:%S"
+        def unixTimestamp(value = None):
+            if value == None:
+                return int(time.time())
+            return int(time.mktime(time.strptime(str(value), fmt)))
+        self.conn.create_function('NOW', 0, lambda: time.strftime(fmt))
+        self.conn.create_function('UNIX_TIMESTAMP', 0, unixTimestamp)
+        self.conn.create_function('UNIX_TIMESTAMP', 1, unixTimestamp)
+        self.conn.create_function('FROM_UNIXTIME', 1, lambda x: time.strftime(fmt, time.localtime(x)))
+
+    def cursor(self):
+        return SQLiteCursor(self.conn)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+
+    def close(self):
+        pass
+
+
+
+class BenchFactory:
+    """The same interface as FakeFactory in test.py, but database
+    connection goes to in-memory SQLite."""
+
+    def __init__(self):
+        self.config = { 'domain': 'example.com' }
+        self.conn = SQLiteConnection()
+
+    def getConfig(self, key, default = None):
+        return self.config.get(key, default)
+
+    def getDbConnection(self):
+        return self.conn
+
+    def releaseDbConnection(self, conn):
+        pass
+
+    def closeDbConnection(self, conn):
+        # connection is shared by all threads
+        pass
+
+
+
+class StubResolver:
+    """Deterministic DNS answers generated from queried name, it can
+    replace resolver returned by tools.dnscache.getResolver.
+
+    IP a.b.c.d has PTR mail-a-b-c-d.example.net (except every fifth),
+    each domain has MX mx.domain, SPF record and A record, DNSBL
+    zones list every tenth IP."""
+
+    def __init__(self, cache = True):
+        self.cache = cache
+        self.answers = {}
+        self.queries = 0
+
+    def __rdata(self, qtype, text):
+        import dns.rdata, dns.rdataclass, dns.rdatatype
+        return dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.from_text(qtype), text)
+
+    def __ip(self, name):
+        h = hash(name) & 0xffff
+        return "198.51.%i.%i" % (h >> 8, h & 0xff or 1)
+
+    def __resolve(self, name, qtype):
+        import dns.resolver
+        name = name.lower().rstrip('.')
+        labels = name.split('.')
+        reversed = len(labels) > 4 and len([ x for x in labels[:4] if x.isdigit() ]) == 4
+        if name.endswith('.in-addr.arpa'):
+            if qtype != 'PTR' or int(labels[0]) % 5 == 0:
+                raise dns.resolver.NXDOMAIN()
+            return [ self.__rdata('PTR', "mail-%s.example.net." % "-".join(labels[3::-1])) ]
+        if reversed:
+            # DNSBL query
+            if int(labels[0]) % 10 != 0:
+                raise dns.resolver.NXDOMAIN()
+            if qtype == 'A':
+                return [ self.__rdata('A', '127.0.0.2') ]
+            if qtype == 'TXT':
+                return [ self.__rdata('TXT', '"listed by benchmark"') ]
+            raise dns.resolver.NoAnswer()
+        if qtype == 'A':
+            if name.startswith('mail-') and name.endswith('.example.net'):
+                return [ self.__rdata('A', labels[0][5:].replace('-', '.')) ]
+            return [ self.__rdata('A', self.__ip(name)) ]
+        if qtype == 'MX' and not name.startswith('mx.'):
+            return [ self.__rdata('MX', "10 mx.%s." % name) ]
+        if qtype == 'TXT' and not name.startswith('mx.'):
+            return [ self.__rdata('TXT', '"v=spf1 mx ip4:%s -all"' % self.__ip(name)) ]
+        raise dns.resolver.NoAnswer()
+
+    def query(self, name, qtype = 'A', *args, **keywords):
+        key = (str(name).lower(), qtype)
+        answer = self.answers.get(key)
+        if answer != None:
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+        self.queries += 1
+        try:
+            answer = self.__resolve(str(name), qtype)
+        except Exception, e:
+            if self.cache:
+                self.answers[key] = e
+            raise
+        if self.cache:
+            self.answers[key] = answer
+        return answer
+
+
+
+class StubLDAPObject:
+    """LDAP connection that knows only entries with "mail" attribute
+    given in entries list."""
+
+    entries = set()
+    reValue = re.compile(r'=([^()]*)\)')
+
+    def __init__(self, uri, *args, **keywords):
+        self.uri = uri
+
+    def bind_s(self, *args, **keywords):
+        pass
+
+    def unbind_s(self):
+        pass
+
+    def search_st(self, base, scope, filterstr, attrlist = None, attrsonly = 0, timeout = -1):
+        ret = []
+        for value in self.reValue.findall(filterstr):
+            if value in self.entries:
+                ret.append(("mail=%s,%s" % (value, base), { 'mail': [ value ] }))
+        return ret
+
+
+
+class StubP0f(threading.Thread):
+    """Unix socket server answering p0f (>= 2.0.8) queries."""
+
+    def __init__(self, socketPath):
+        threading.Thread.__init__(self, name = "p0f")
+        self.setDaemon(True)
+        self.socketPath = socketPath
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(socketPath)
+        self.sock.listen(50)
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                break
+            try:
+                query = conn.recv(1024)
+                magic, qtype, qid, src, dst, sport, dport = struct.unpack("=III4s4sHH", query)
+                if ord(src[3]) % 3 == 0:
+                    response = struct.pack("=IIB20s40sb30s30sBBBhHi", magic, qid, 2, '', '', 0, '', '', 0, 0, 0, 0, 0, 0)
+                else:
+                    response = struct.pack("=IIB20s40sb30s30sBBBhHi", magic, qid, 0, 'Linux', '2.6 (newer, 1)', 5, 'ethernet/modem', '', 0, 0, 0, 0, 0, 3600)
+                conn.send(response)
+            finally:
+                conn.close()
+
+    def stop(self):
+        self.sock.close()
+        os.unlink(self.socketPath)
+
+
+
+class StubMemcache:
+    """In-process memcache stand-in with python-memcache Client
+    methods used by cache engines. Each call sleeps latency seconds
+    to simulate network round trip."""
+
+    def __init__(self, latency = 0.0002):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.data = {}
+        self.requests = 0
+
+    def __request(self):
+        self.requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def __get(self, key, now):
+        value = self.data.get(key)
+        if value == None:
+            return None
+        if value[1] > 0 and value[1] < now:
+            del(self.data[key])
+            return None
+        return value[0]
+
+    def get(self, key):
+        self.__request()
+        self.lock.acquire()
+        try:
+            return self.__get(key, time.time())
+        finally:
+            self.lock.release()
+
+    def get_multi(self, keys):
+        self.__request()
+        now = time.time()
+        retVal = {}
+        self.lock.acquire()
+        try:
+            for key in keys:
+                value = self.__get(key, now)
+                if value != None:
+                    retVal[key] = value
+        finally:
+            self.lock.release()
+        return retVal
+
+    def set(self, key, value, expire = 0):
+        self.set_multi({ key: value }, expire)
+        return True
+
+    def set_multi(self, mapping, expire = 0):
+        self.__request()
+        if expire > 0:
+            expire += time.time()
+        self.lock.acquire()
+        try:
+            for key, value in mapping.items():
+                self.data[key] = (value, expire)
+        finally:
+            self.lock.release()
+        return []
+
+
+
+def requestData(i):
+    """Deterministic request number i."""
+    ip = socket.inet_ntoa(struct.pack('!I', 0x14000000 + i * 7))
+    return { 'request': 'smtpd_access_policy',
+             'protocol_state': 'RCPT',
+             'protocol_name': 'ESMTP',
+             'helo_name': "mail-%s.example.net" % ip.replace('.', '-'),
+             'queue_id': '%010X' % i,
+             'sender': "user%i@domain%i.example.com" % (i, i % 100),
+             'recipient': "rcpt%i@example.org" % (i % 50),
+             'client_address': ip,
+             'client_name': "mail-%s.example.net" % ip.replace('.', '-'),
+             'reverse_client_name': "mail-%s.example.net" % ip.replace('.', '-'),
+             'instance': "%x.bench.%i" % (i, i),
+             'size': str(1000 + i % 100000) }
+
+
+def populateList(obj, factory, size):
+    conn = factory.getDbConnection()
+    cursor = conn.cursor()
+    # table is created by refresh thread in cacheAll mode
+    cursor.execute("CREATE TABLE IF NOT EXISTS `bench_list` (`mail` VARCHAR(100) NOT NULL, PRIMARY KEY (`mail`))")
+    for i in range(0, size, 2):
+        cursor.execute("INSERT INTO `bench_list` (`mail`) VALUES (%s)", (requestData(i)['sender'], ))
+    conn.commit()
+    if obj.getParam('cacheAll', False):
+        # wait until refresh thread caches all inserted records
+        endTime = time.time() + 10
+        while len(obj.allDataCache) < (size + 1) / 2 and time.time() < endTime:
+            obj.allDataCacheCondition.acquire()
+            obj.allDataCacheCondition.notify_all()
+            obj.allDataCacheCondition.release()
+            time.sleep(0.01)
+
+
+def populateListDyn(obj, factory, size):
+    for i in range(0, size, 2):
+        obj.check(requestData(i), operation = 'add')
+
+
+def populateLDAP(obj, factory, size):
+    StubLDAPObject.entries = set([ requestData(i)['sender'] for i in range(0, size, 2) ])
+
+
+# name, module, parameters, stand-ins, populate function
+CASES = [
+    ( 'Dummy', 'Dummy', {}, [], None ),
+    ( 'DOS', 'DOS', { 'params': 'sender', 'limitCount': 1000000 }, [], None ),
+    ( 'Trap', 'Trap', { 'traps': 'trap1@example.org,trap2@example.org' }, [], None ),
+    ( 'List', 'List', { 'param': 'sender', 'table': 'bench_list', 'column': 'mail' }, [ 'db' ], populateList ),
+    ( 'ListCacheAll', 'List', { 'param': 'sender', 'table': 'bench_list', 'column': 'mail', 'cacheAll': True }, [ 'db' ], populateList ),
+    ( 'ListDyn', 'ListDyn', { 'table': 'bench_listdyn', 'param': 'sender', 'softExpire': 0, 'hardExpire': 0, 'mapping': { 'sender': ('mail', 'VARCHAR(100)') } }, [ 'db' ], populateListDyn ),
+    ( 'Greylist', 'Greylist', { 'table': 'bench_greylist', 'delay': 0 }, [ 'db', 'dns' ], None ),
+    ( 'Resolve', 'Resolve', { 'param': 'client_address', 'type': 'ip->name->ip' }, [ 'dns' ], None ),
+    ( 'SPF', 'SPF', {}, [ 'dns' ], None ),
+    ( 'Dnsbl', 'Dnsbl', { 'dnsbl': 'ZEN' }, [ 'dns' ], None ),
+    ( 'DnsblScore', 'DnsblScore', {}, [ 'dns' ], None ),
+    ( 'DnsblDynamic', 'DnsblDynamic', {}, [ 'dns' ], None ),
+    ( 'LookupLDAP', 'LookupLDAP', { 'param': 'sender', 'uri': 'ldap://localhost', 'base': 'dc=example,dc=com', 'filter': '(mail=%m)' }, [ 'ldap' ], populateLDAP ),
+    ( 'P0f', 'P0f', {}, [ 'p0f' ], None ),
+    ]
+
+STATES = [ 'cold', 'warm' ]
+SIZES = [ 100, 10000 ]
+WARM_SET = 256
+
+
+class Bench:
+    """Run benchmark cases and compare them with baseline."""
+
+    def __init__(self, iterations = 1000):
+        self.iterations = iterations
+        self.results = {}
+        self.tmpDir = tempfile.mkdtemp(prefix = 'ppolicy-bench')
+        self.p0f = None
+        self.resolver = None
+        self.dnscache = None
+
+    def __install(self, standins, state, params):
+        for standin in standins:
+            if standin == 'dns':
+                from tools import dnscache
+                self.dnscache = dnscache
+                self.resolver = StubResolver(state == 'warm')
+                self.dnscacheGetResolver = dnscache.getResolver
+                dnscache.getResolver = lambda lifetime, timeout: self.resolver
+            elif standin == 'ldap':
+                import ldap.ldapobject
+                ldap.ldapobject.ReconnectLDAPObject = StubLDAPObject
+            elif standin == 'p0f':
+                params['socket'] = os.path.join(self.tmpDir, 'p0f.socket')
+                self.p0f = StubP0f(params['socket'])
+                self.p0f.start()
+
+    def __uninstall(self):
+        if self.dnscache != None:
+            self.dnscache.getResolver = self.dnscacheGetResolver
+            self.dnscache = None
+        if self.p0f != None:
+            self.p0f.stop()
+            self.p0f = None
+
+    def run(self, case, size, state):
+        name, mtype, params, standins, populate = case
+        params = params.copy()
+        key = "%s/%s/%i" % (name, state, size)
+        try:
+            self.__install(standins, state, params)
+            factory = BenchFactory()
+            mod = __import__(mtype, globals(), locals(), [])
+            obj = getattr(mod, mtype)(name, factory, **params)
+            obj.start()
+            if populate != None:
+                populate(obj, factory, size)
+            if state == 'warm':
+                requests = [ requestData(i) for i in range(min(size, WARM_SET)) ]
+                for data in requests:
+                    obj.check(data.copy())
+                requests = [ requests[i % len(requests)] for i in range(self.iterations) ]
+            else:
+                # requests never seen before, but in range of populated data
+                requests = [ requestData(i * size / self.iterations) for i in range(self.iterations) ]
+
+            gc.collect()
+            objects = len(gc.get_objects())
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            cpu = time.clock()
+            startTime = time.time()
+            for data in requests:
+                obj.check(data.copy())
+            endTime = time.time()
+            cpu = time.clock() - cpu
+            result = { 'ops': self.iterations / max(0.000001, endTime - startTime),
+                       'cpu': cpu / self.iterations,
+                       'objects': len(gc.get_objects()) - objects,
+                       'maxrss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - maxrss }
+            if self.resolver != None:
+                result['dns'] = self.resolver.queries
+                self.resolver = None
+            obj.stop()
+        except Exception, e:
+            logging.getLogger().debug("%s failed: %s" % (key, e))
+            result = { 'error': str(e) }
+        self.__uninstall()
+        if not result.has_key('error'):
+            self.results[key] = result
+        return key, result
+
+    def compare(self, baseline, tolerance = 0.2):
+        """Return list of (key, result, baseline result) where ops/sec
+        dropped more than tolerance."""
+        regressions = []
+        keys = self.results.keys()
+        keys.sort()
+        for key in keys:
+            base = baseline.get(key)
+            if base == None:
+                continue
+            if self.results[key]['ops'] < base['ops'] * (1 - tolerance):
+                regressions.append((key, self.results[key], base))
+        return regressions
+
+    def close(self):
+        try:
+            os.rmdir(self.tmpDir)
+        except OSError:
+            pass
+
+
+
+def benchCache(threads, shards, size = 10000, iterations = 100000, setRatio = 0.1):
+    """Run iterations cache operations (setRatio of them set, rest
+    get with random keys) split between threads and return ops/sec."""
+    from tools import lrucache
+    cache = lrucache.createCache(size, shards)
+    for i in range(0, size, 2):
+        cache.set("key%i" % i, (1, 'bench'), 3600)
+
+    def worker(count, seed):
+        rnd = random.Random(seed)
+        keys = [ "key%i" % rnd.randint(0, 2 * size) for i in range(min(count, 1000)) ]
+        sets = int(1 / max(setRatio, 0.0001))
+        for i in xrange(count):
+            key = keys[i % len(keys)]
+            if i % sets == 0:
+                cache.set(key, (1, 'bench'), 3600)
+            else:
+                cache.get(key)
+
+    workers = []
+    for i in range(threads):
+        workers.append(threading.Thread(target=worker, args=(iterations / threads, i)))
+    startTime = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return iterations / max(0.000001, time.time() - startTime)
+
+
+def benchTiered(requests = 10000, modules = 5, clients = 1000, latency = 0.0002):
+    """Simulate requests that use several modules (keys of each
+    request depend on one of clients, popular clients are used more
+    often) with memcache and tiered cache engine. Returns list of
+    (engine, requests/sec, memcache requests per request)."""
+    from tools import cachekey, lrucache, tieredcache
+    retVal = []
+    for engine in [ 'memcache', 'tiered' ]:
+        client = StubMemcache(latency)
+        if engine == 'tiered':
+            cache = tieredcache.TieredCache(lrucache.createCache(clients / 2), client)
+        rnd = random.Random(0)
+        startTime = time.time()
+        for i in xrange(requests):
+            clientId = int(clients * rnd.random() ** 3)
+            keys = [ cachekey.makeKey("mod%i" % m, (clientId, )) for m in range(modules) ]
+            if engine == 'tiered':
+                cache.getMulti(keys)
+            for key in keys:
+                if engine == 'tiered':
+                    value = cache.get(key)
+                else:
+                    value = client.get("ppolicy:%s" % cachekey.encodeKey(key))
+                if value == None:
+                    if engine == 'tiered':
+                        cache.set(key, (1, 'bench'), 3600)
+                    else:
+                        client.set("ppolicy:%s" % cachekey.encodeKey(key), (1, 'bench'), 3600)
+        duration = max(0.000001, time.time() - startTime)
+        if engine == 'tiered':
+            cache.stop()
+        retVal.append((engine, requests / duration, client.requests / float(requests)))
+    return retVal
+
+
+def usage():
+    print "usage: %s [options] [case ...]" % sys.argv[0]
+    print "Params:"
+    print "  -h, --help\t\tthis help"
+    print "  -q, -v, -l=x\t\tlog level"
+    print "  -n, --iterations=x\tchecks per case (default: 1000)"
+    print "  -s, --sizes=x,y\tdata sizes (default: %s)" % ",".join([ str(x) for x in SIZES ])
+    print "  --state=x\t\tcold or warm (default: both)"
+    print "  --save=file\t\tsave results as baseline"
+    print "  --compare=file\tcompare results with baseline"
+    print "  --tolerance=x\t\tallowed ops/sec drop (default: 0.2)"
+    print "  --cache-threads=x,y\tlocal cache ops/sec for thread counts"
+    print "  --cache-shards=x,y\tlocal cache shards (default: 1,16)"
+    print "  --cache-tiered\t\tmemcache and tiered cache engine requests/sec"
+    print "Cases: %s" % ", ".join([ x[0] for x in CASES ])
+
+
+if __name__ == "__main__":
+    streamHandler = logging.StreamHandler(sys.stdout)
+    streamHandler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s](%(module)s:%(lineno)d) %(message)s", "%d %b %H:%M:%S"))
+    logging.getLogger().addHandler(streamHandler)
+    logging.getLogger().setLevel(logging.ERROR)
+
+    import getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hvql:n:s:",
+                                   ["help", "verbose", "quiet", "log-level=",
+                                    "iterations=", "sizes=", "state=",
+                                    "save=", "compare=", "tolerance=",
+                                    "cache-threads=", "cache-shards=",
+                                    "cache-tiered" ])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    iterations = 1000
+    sizes = SIZES
+    states = STATES
+    saveFile = None
+    compareFile = None
+    tolerance = 0.2
+    cacheThreads = None
+    cacheShards = [ 1, 16 ]
+    cacheTiered = False
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        if o in ("-v", "--verbose"):
+            logging.getLogger().setLevel(logging.DEBUG)
+        if o in ("-q", "--quiet"):
+            logging.getLogger().setLevel(logging.CRITICAL)
+        if o in ("-l", "--log-level"):
+            logging.getLogger().setLevel(int(a))
+        if o in ("-n", "--iterations"):
+            iterations = int(a)
+        if o in ("-s", "--sizes"):
+            sizes = [ int(x) for x in a.split(',') ]
+        if o in ("--state", ):
+            states = [ a ]
+        if o in ("--save", ):
+            saveFile = a
+        if o in ("--compare", ):
+            compareFile = a
+        if o in ("--tolerance", ):
+            tolerance = float(a)
+        if o in ("--cache-threads", ):
+            cacheThreads = [ int(x) for x in a.split(',') ]
+        if o in ("--cache-shards", ):
+            cacheShards = [ int(x) for x in a.split(',') ]
+        if o in ("--cache-tiered", ):
+            cacheTiered = True
+
+    if cacheTiered:
+        print "%-10s %12s %12s" % ('engine', 'requests/s', 'memcache/req')
+        for engine, rate, perRequest in benchTiered(iterations * 10):
+            print "%-10s %12.1f %12.2f" % (engine, rate, perRequest)
+        sys.exit()
+
+    if cacheThreads != None:
+        print "%-10s %s" % ('threads', " ".join([ "%12s" % ("shards=%i" % x) for x in cacheShards ]))
+        for threads in cacheThreads:
+            res = [ benchCache(threads, shards, iterations = iterations * 100) for shards in cacheShards ]
+            print "%-10i %s" % (threads, " ".join([ "%12.1f" % x for x in res ]))
+        sys.exit()
+
+    cases = CASES
+    if len(args) > 0:
+        cases = [ x for x in CASES if x[0] in args ]
+
+    bench = Bench(iterations)
+    print "%-30s %12s %10s %10s %10s %8s" % ('case', 'ops/sec', 'cpu[us]', 'objects', 'rss[kB]', 'dns')
+    for case in cases:
+        for size in sizes:
+            for state in states:
+                key, result = bench.run(case, size, state)
+                if result.has_key('error'):
+                    print "%-30s skipped: %s" % (key, result['error'])
+                else:
+                    print "%-30s %12.1f %10.1f %10i %10i %8s" % (key, result['ops'], result['cpu'] * 1000000, result['objects'], result['maxrss'], result.get('dns', '-'))
+    bench.close()
+
+    if saveFile != None:
+        json.dump(bench.results, open(saveFile, 'w'), indent = 1, sort_keys = True)
+
+    if compareFile != None:
+        regressions = bench.compare(json.load(open(compareFile)), tolerance)
+        for key, result, base in regressions:
+            print "REGRESSION %s: %.1f ops/sec (baseline %.1f)" % (key, result['ops'], base['ops'])
+        if len(regressions) > 0:
+            sys.exit(1)
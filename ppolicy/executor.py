@@ -0,0 +1,427 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Bounded executors used to limit concurrency of check modules
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import time
+import logging
+import threading
+import collections
+import Queue
+from twisted.internet import reactor, threads, defer
+from twisted.python import threadpool
+
+
+__version__ = "$Revision$"
+
+
+class ExecutorOverflow(Exception):
+    """Raised when executor can't accept more work. Result that should
+    be returned instead of calling module is stored in result attribute."""
+    def __init__(self, result):
+        Exception.__init__(self, result)
+        self.result = result
+
+
+class _Waiter(object):
+    """Synchronous call waiting in executor queue for free slot."""
+
+    def __init__(self, lock):
+        self.cond = threading.Condition(lock)
+        self.ready = False
+
+
+
+class Executor(object):
+    """Bulkhead for slow check modules. At most "threads" calls run at
+    the same time, at most "queue" calls wait for free slot (waiting is
+    limited by "timeout" seconds) and all other calls are rejected
+    immediately with "overflow" result. This prevents slow modules
+    (e.g. SMTP verification) to occupy all threads from reactor thread
+    pool. Free slots are given to synchronous and asynchronous calls
+    in the order they were queued.
+
+    Executor configuration options (see executors in config file):
+    threads, queue, timeout, overflow
+    """
+
+    def __init__(self, name, threads = 5, queue = 10, timeout = None, overflow = None):
+        self.name = name
+        self.threads = threads
+        self.queue = queue
+        self.timeout = timeout
+        if overflow == None:
+            overflow = (0, "executor %s overloaded" % name)
+        self.overflow = overflow
+        self.lock = threading.Lock()
+        self.pool = None
+        # queued calls in FIFO order, _Waiter for synchronous calls
+        # and [ d, start, f, args, keywords, timer ] for asynchronous
+        self.pending = collections.deque()
+        self.running = 0
+        self.waiting = 0
+        self.waitingMax = 0
+        self.calls = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+
+    def __acquire(self, item = None):
+        """Reserve slot in executor. Returns None if executor is full
+        or timeout expired, 'run' when caller can run immediately and
+        'queue' when asynchronous call item was queued (synchronous
+        caller without item waits in queue)."""
+        self.lock.acquire()
+        try:
+            self.calls += 1
+            if self.running < self.threads and len(self.pending) == 0:
+                self.running += 1
+                return 'run'
+            if self.waiting >= self.queue:
+                self.rejected += 1
+                return None
+
+            self.waiting += 1
+            if self.waiting > self.waitingMax:
+                self.waitingMax = self.waiting
+            if item != None:
+                self.pending.append(item)
+                return 'queue'
+
+            waiter = _Waiter(self.lock)
+            self.pending.append(waiter)
+            if self.timeout != None:
+                deadline = time.time() + self.timeout
+            while not waiter.ready:
+                if self.timeout == None:
+                    waiter.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.pending.remove(waiter)
+                        self.waiting -= 1
+                        self.timeouts += 1
+                        return None
+                    waiter.cond.wait(remaining)
+            return 'run'
+        finally:
+            self.lock.release()
+
+
+    def __release(self):
+        item = None
+        self.lock.acquire()
+        try:
+            self.running -= 1
+            if len(self.pending) > 0:
+                # free slot goes to the oldest queued call
+                item = self.pending.popleft()
+                self.waiting -= 1
+                self.running += 1
+                if isinstance(item, _Waiter):
+                    item.ready = True
+                    item.cond.notify()
+                    item = None
+        finally:
+            self.lock.release()
+        if item != None:
+            reactor.callFromThread(self.__startQueued, item)
+
+
+    def __queue(self, d, start, f, args, keywords):
+        """Reserve slot for asynchronous call and start it or queue it.
+        Queued call fails with ExecutorOverflow after timeout."""
+        item = [ d, start, f, args, keywords, None ]
+        state = self.__acquire(item)
+        if state == None:
+            logging.getLogger().warn("executor %s overflow (running %i, waiting %i)" % (self.name, self.running, self.waiting))
+            d.errback(ExecutorOverflow(self.overflow))
+        elif state == 'run':
+            start(d, f, args, keywords)
+        elif self.timeout != None:
+            # slot can be given to this call in other thread, but it
+            # is started in reactor thread after timer was set
+            item[5] = reactor.callLater(self.timeout, self.__expire, item)
+        return d
+
+
+    def __startQueued(self, item):
+        d, start, f, args, keywords, timer = item
+        if timer != None and timer.active():
+            timer.cancel()
+        start(d, f, args, keywords)
+
+
+    def __expire(self, item):
+        """Remove asynchronous call from queue after timeout."""
+        self.lock.acquire()
+        try:
+            if item not in self.pending:
+                return
+            self.pending.remove(item)
+            self.waiting -= 1
+            self.timeouts += 1
+        finally:
+            self.lock.release()
+        logging.getLogger().warn("executor %s timeout (running %i, waiting %i)" % (self.name, self.running, self.waiting))
+        item[0].errback(ExecutorOverflow(self.overflow))
+
+
+    def __cancel(self, item):
+        """Fail asynchronous call removed from queue by stop."""
+        timer = item[5]
+        if timer != None and timer.active():
+            timer.cancel()
+        item[0].errback(ExecutorOverflow(self.overflow))
+
+
+    def call(self, f, *args, **keywords):
+        """Call f in current thread when executor has free slot (wait
+        in queue if necessary). Raise ExecutorOverflow if queue is
+        full or timeout expired."""
+        if self.__acquire() == None:
+            logging.getLogger().warn("executor %s overflow (running %i, waiting %i)" % (self.name, self.running, self.waiting))
+            raise ExecutorOverflow(self.overflow)
+        try:
+            return f(*args, **keywords)
+        finally:
+            self.__release()
+
+
+    def callAsync(self, f, *args, **keywords):
+        """Call f in executor thread pool and return Deferred. It must
+        be called from reactor thread, calls over threads limit wait
+        in queue without occupying any thread. Deferred fails with
+        ExecutorOverflow when executor queue is full or timeout
+        expired."""
+        return self.__queue(defer.Deferred(), self.__startThread, f, args, keywords)
+
+
+    def callDeferred(self, f, *args, **keywords):
+        """Call f that returns Deferred (e.g. native checkAsync of
+        module) when executor has free slot. It must be called from
+        reactor thread, calls over threads limit wait in queue without
+        occupying any thread. Deferred fails with ExecutorOverflow when
+        executor queue is full or timeout expired."""
+        return self.__queue(defer.Deferred(), self.__startDeferred, f, args, keywords)
+
+
+    def __startThread(self, d, f, args, keywords):
+        def callAsyncDone(result):
+            self.__release()
+            return result
+
+        if self.pool == None:
+            self.pool = threadpool.ThreadPool(0, self.threads, "executor-%s" % self.name)
+            self.pool.start()
+
+        td = threads.deferToThreadPool(reactor, self.pool, f, *args, **keywords)
+        td.addBoth(callAsyncDone)
+        td.addCallbacks(d.callback, d.errback)
+
+
+    def __startDeferred(self, d, f, args, keywords):
+        def callDeferredDone(result):
+            self.__release()
+            return result
+
+        fd = defer.maybeDeferred(f, *args, **keywords)
+        fd.addBoth(callDeferredDone)
+        fd.addCallbacks(d.callback, d.errback)
+
+
+    def stop(self):
+        if self.pool != None:
+            self.pool.stop()
+            self.pool = None
+        self.lock.acquire()
+        try:
+            # synchronous callers stay in queue and get slot when
+            # running calls finish
+            pending = [ x for x in self.pending if not isinstance(x, _Waiter) ]
+            for item in pending:
+                self.pending.remove(item)
+            self.waiting -= len(pending)
+        finally:
+            self.lock.release()
+        # stop can be called from reload thread, Deferred callbacks
+        # (writing response) and timers must run in reactor thread
+        for item in pending:
+            reactor.callFromThread(self.__cancel, item)
+
+
+    def getStats(self):
+        return { 'threads': self.threads, 'queue': self.queue,
+                 'running': self.running, 'waiting': self.waiting,
+                 'waitingMax': self.waitingMax, 'calls': self.calls,
+                 'rejected': self.rejected, 'timeouts': self.timeouts }
+
+
+
+class Future(object):
+    """Result of call submitted to CheckPool."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+        self.value = None
+        self.error = None
+
+    def run(self, f, *args, **keywords):
+        try:
+            value = f(*args, **keywords)
+        except Exception, e:
+            self.set(None, e)
+        else:
+            self.set(value)
+
+    def set(self, value, error = None):
+        """Set result and call registered callbacks."""
+        self.lock.acquire()
+        try:
+            self.value = value
+            self.error = error
+            self.event.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        finally:
+            self.lock.release()
+        for f in callbacks:
+            f(self)
+
+    def addCallback(self, f):
+        """Call f(future) in thread that sets result (immediately
+        when result is already available)."""
+        self.lock.acquire()
+        try:
+            if not self.event.isSet():
+                self.callbacks.append(f)
+                return
+        finally:
+            self.lock.release()
+        f(self)
+
+    def done(self):
+        return self.event.isSet()
+
+    def result(self, timeout = None):
+        """Wait for result (at most timeout seconds) and return it.
+        Exception raised by called function is raised here."""
+        self.event.wait(timeout)
+        if not self.event.isSet():
+            raise Exception("result is not available after %ss" % timeout)
+        if self.error != None:
+            raise self.error
+        return self.value
+
+
+class CheckPool(object):
+    """Small thread pool used to run several checks of one request at
+    the same time. Threads are started on demand up to "threads" and
+    when there is no idle thread the call runs immediately in thread
+    that submitted it, so checks waiting for other checks can't
+    deadlock the pool."""
+
+    def __init__(self, name, threads = 20):
+        self.name = name
+        self.threads = threads
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.workers = []
+        self.idle = 0
+        self.calls = 0
+        self.inline = 0
+        self.stopped = False
+
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                break
+            future, f, args, keywords = item
+            future.run(f, *args, **keywords)
+            self.lock.acquire()
+            try:
+                self.idle += 1
+            finally:
+                self.lock.release()
+
+
+    def __reserve(self, item, inline):
+        """Queue call for pool thread, returns False when all threads
+        are busy or pool was stopped."""
+        self.lock.acquire()
+        try:
+            if self.stopped:
+                if inline:
+                    self.calls += 1
+                    self.inline += 1
+                return False
+            if self.idle > 0:
+                self.idle -= 1
+            elif len(self.workers) < self.threads:
+                worker = threading.Thread(target=self.__run, name="%s-%i" % (self.name, len(self.workers)))
+                worker.setDaemon(True)
+                worker.start()
+                self.workers.append(worker)
+            else:
+                if inline:
+                    self.calls += 1
+                    self.inline += 1
+                return False
+            self.calls += 1
+            # queued under lock, so stop can't put end marker before it
+            self.queue.put(item)
+            return True
+        finally:
+            self.lock.release()
+
+
+    def submit(self, f, *args, **keywords):
+        """Run call in pool thread or in current thread when all
+        threads are busy or pool was stopped."""
+        future = Future()
+        if not self.__reserve((future, f, args, keywords), True):
+            future.run(f, *args, **keywords)
+        return future
+
+
+    def trySubmit(self, f, *args, **keywords):
+        """Submit call only if there is free thread (never runs it in
+        current thread) and return its Future or None (also after
+        pool was stopped)."""
+        future = Future()
+        if not self.__reserve((future, f, args, keywords), False):
+            return None
+        return future
+
+
+    def stop(self):
+        """Stop worker threads after they finish queued calls, new
+        calls are not accepted by pool."""
+        self.lock.acquire()
+        try:
+            self.stopped = True
+            workers = self.workers
+            self.workers = []
+            self.idle = 0
+            for worker in workers:
+                self.queue.put(None)
+        finally:
+            self.lock.release()
+        for worker in workers:
+            worker.join(1)
+
+
+    def getStats(self):
+        return { 'threads': self.threads, 'started': len(self.workers),
+                 'idle': self.idle, 'calls': self.calls,
+                 'inline': self.inline }
@@ -9,7 +9,11 @@
 #
 # $Id$
 #
+import time
+import random
 import logging
+import threading
+import collections
 import twisted.python.log
 
 class TwistedHandler(logging.Handler):
@@ -23,3 +27,177 @@ class TwistedHandler(logging.Handler):
     def emit(self, record):
         msg = self.format(record)
         twisted.python.log.msg(msg)
+
+
+
+class SamplingFilter(logging.Filter):
+    """Pass only given fraction of DEBUG and INFO records for each
+    category (python module that created the record, e.g. "protocol"
+    or "List"). Records with higher level are never dropped.
+
+    @ivar rates: category -> fraction of passed records (0.0 - 1.0)
+    @type rates: dict
+    """
+
+    def __init__(self, rates = {}):
+        logging.Filter.__init__(self)
+        self.rates = rates
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return 1
+        rate = self.rates.get(record.module)
+        if rate == None or rate >= 1:
+            return 1
+        if rate > 0 and random.random() < rate:
+            return 1
+        self.dropped += 1
+        return 0
+
+
+
+class AsyncTwistedHandler(TwistedHandler):
+    """Twisted log handler that doesn't format and write records in
+    thread that created them. Records are appended to the queue and
+    single writer thread formats all waiting records when it wakes up
+    and sends them to twisted log (each record with its own time and
+    prefix). Message is merged with arguments by thread that logs only
+    when some argument is mutable (it can change before writer formats
+    it). Threads that log never wait for the handler lock and when
+    writer can't keep up (queue is full) new DEBUG and INFO records are
+    dropped, records with higher level are written immediately.
+
+    @ivar maxQueue: maximum number of records waiting for writer
+    @type maxQueue: int
+    @ivar flushInterval: maximum time between writer wakeups
+    @type flushInterval: float
+    """
+
+    def __init__(self, maxQueue = 10000, flushInterval = 0.5):
+        TwistedHandler.__init__(self)
+        self.maxQueue = maxQueue
+        self.flushInterval = flushInterval
+        self.records = collections.deque()
+        self.event = threading.Event()
+        self.sampling = None
+        self.dropped = 0
+        self.writer = None
+        self.running = False
+
+
+    def setSampling(self, rates):
+        """Set per category sampling rates for DEBUG and INFO records."""
+        if self.sampling != None:
+            self.removeFilter(self.sampling)
+            self.sampling = None
+        if rates != None and len(rates) > 0:
+            self.sampling = SamplingFilter(rates)
+            self.addFilter(self.sampling)
+
+
+    def setAsync(self, enabled):
+        """Start or stop writer thread. Without writer thread records
+        are written synchronously like by TwistedHandler."""
+        if enabled and not self.running:
+            self.running = True
+            self.writer = threading.Thread(target=self.__run, name="logwriter")
+            self.writer.setDaemon(True)
+            self.writer.start()
+        elif not enabled and self.running:
+            self.running = False
+            self.event.set()
+            self.writer.join()
+            self.writer = None
+            self.__write()
+
+
+    def handle(self, record):
+        if record.levelno < self.level:
+            return 0
+        if not self.filter(record):
+            return 0
+        if not self.running:
+            self.acquire()
+            try:
+                self.emit(record)
+            finally:
+                self.release()
+            return 1
+
+        # mutable arguments can change before writer formats the record
+        if record.args and not self.__immutable(record.args):
+            try:
+                record.msg = record.getMessage()
+                record.args = None
+            except Exception:
+                # writer reports invalid format with record
+                pass
+
+        if len(self.records) >= self.maxQueue:
+            if record.levelno < logging.WARNING:
+                self.dropped += 1
+                return 0
+            # never drop warnings and errors
+            self.acquire()
+            try:
+                self.emit(record)
+            finally:
+                self.release()
+            return 1
+        self.records.append(record)
+        if not self.event.isSet():
+            self.event.set()
+        return 1
+
+
+    IMMUTABLE = (str, unicode, int, long, float, bool, type(None))
+
+    def __immutable(self, args):
+        if type(args) == tuple:
+            for arg in args:
+                if type(arg) == tuple:
+                    if not self.__immutable(arg):
+                        return False
+                elif type(arg) not in self.IMMUTABLE:
+                    return False
+            return True
+        # dictionary with named arguments
+        return False
+
+
+    def __write(self):
+        while True:
+            try:
+                record = self.records.popleft()
+            except IndexError:
+                break
+            try:
+                self.emit(record)
+            except Exception:
+                self.handleError(record)
+
+
+    def __run(self):
+        dropped = 0
+        while self.running:
+            self.event.wait(self.flushInterval)
+            self.event.clear()
+            self.__write()
+            if self.dropped != dropped:
+                twisted.python.log.msg("[logging] writer queue full, %i records dropped" % (self.dropped - dropped))
+                dropped = self.dropped
+
+
+    def flush(self):
+        if self.running:
+            # give writer thread chance to process queued records
+            endTime = time.time() + self.flushInterval
+            while len(self.records) > 0 and time.time() < endTime:
+                self.event.set()
+                time.sleep(0.01)
+
+
+    def close(self):
+        self.setAsync(False)
+        TwistedHandler.close(self)
@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Statistical sampling profiler controlled from command port
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import os, sys, re
+import time
+import logging
+import threading
+
+
+__version__ = "$Revision$"
+
+
+try:
+    import ctypes, ctypes.util
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [ ('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long) ]
+
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'))
+    _clock_gettime = _librt.clock_gettime
+    _clock_gettime.argtypes = [ ctypes.c_int, ctypes.POINTER(_timespec) ]
+    CLOCK_THREAD_CPUTIME_ID = 3
+
+    def threadCpuTime():
+        """CPU time consumed by current thread (None if not available)."""
+        ts = _timespec()
+        if _clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(ts)) != 0:
+            return None
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+except Exception, e:
+    logging.getLogger().debug("thread CPU clock is not available: %s" % e)
+    def threadCpuTime():
+        return None
+
+
+class Sampler(object):
+    """Sample stacks of all threads (reactor and thread pool) in regular
+    interval and count identical stacks. Results can be exported in
+    collapsed format used by flamegraph.pl. Time spent by modules is
+    measured by thread CPU clock while sampler is active."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopEvent = threading.Event()
+        self.active = False
+        self.startTime = None
+        self.stopTime = None
+        self.samples = 0
+        self.stacks = {}
+        self.modules = {}
+
+
+    def start(self, duration = 30, interval = 0.01):
+        if self.active:
+            raise Exception("profiler is already running")
+        self.lock.acquire()
+        try:
+            self.samples = 0
+            self.stacks = {}
+            self.modules = {}
+        finally:
+            self.lock.release()
+        self.stopEvent.clear()
+        self.startTime = time.time()
+        self.stopTime = None
+        self.active = True
+        self.thread = threading.Thread(target=self.__run, args=(duration, interval), name="profiler")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.stopEvent.set()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+
+    def __threadName(self, name):
+        # group threads from one pool together
+        return re.sub('[-_]?[0-9]+$', '', name)
+
+
+    def __run(self, duration, interval):
+        logging.getLogger().info("profiler started for %ss (interval %ss)" % (duration, interval))
+        myId = threading.currentThread().ident
+        endTime = time.time() + duration
+        try:
+            while time.time() < endTime and not self.stopEvent.isSet():
+                names = dict([ (x.ident, self.__threadName(x.getName())) for x in threading.enumerate() ])
+                stacks = []
+                for threadId, frame in sys._current_frames().items():
+                    if threadId == myId:
+                        continue
+                    stack = []
+                    while frame != None:
+                        code = frame.f_code
+                        stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+                        frame = frame.f_back
+                    stack.append(names.get(threadId, 'unknown'))
+                    stack.reverse()
+                    stacks.append(";".join(stack))
+                del(frame)
+
+                self.lock.acquire()
+                try:
+                    self.samples += 1
+                    for stack in stacks:
+                        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                finally:
+                    self.lock.release()
+                self.stopEvent.wait(interval)
+        finally:
+            self.active = False
+            self.stopTime = time.time()
+            logging.getLogger().info("profiler stopped after %i samples" % self.samples)
+
+
+    def isActive(self):
+        return self.active
+
+
+    def addModule(self, name, cpuTime, wallTime):
+        self.lock.acquire()
+        try:
+            stats = self.modules.get(name)
+            if stats == None:
+                stats = [ 0, 0.0, 0.0 ]
+                self.modules[name] = stats
+            stats[0] += 1
+            stats[1] += cpuTime
+            stats[2] += wallTime
+        finally:
+            self.lock.release()
+
+
+    def getStatus(self):
+        if self.startTime == None:
+            return "profiler was not started"
+        if self.active:
+            return "profiler running %is, %i samples" % (time.time() - self.startTime, self.samples)
+        return "profiler stopped, %i samples in %is" % (self.samples, self.stopTime - self.startTime)
+
+
+    def getCollapsed(self):
+        """Return stacks in collapsed format (stack count), the most
+        frequent stacks first."""
+        self.lock.acquire()
+        try:
+            stacks = self.stacks.items()
+        finally:
+            self.lock.release()
+        stacks.sort(lambda x, y: cmp(y[1], x[1]))
+        return [ "%s %i" % x for x in stacks ]
+
+
+    def getModules(self):
+        """Return per module (calls, CPU time, wall time) sorted
+        by CPU time."""
+        self.lock.acquire()
+        try:
+            modules = [ (k, v[0], v[1], v[2]) for k, v in self.modules.items() ]
+        finally:
+            self.lock.release()
+        modules.sort(lambda x, y: cmp(y[2], x[2]))
+        return [ "%s: calls=%i cpu=%.3fs wall=%.3fs" % x for x in modules ]
+
+
+_sampler = Sampler()
+
+
+def getInstance():
+    return _sampler
+
+
+def isActive():
+    return _sampler.active
+
+
+def call(name, f, *args, **keywords):
+    """Call f and account thread CPU and wall time to module name
+    when profiler is running."""
+    if not _sampler.active:
+        return f(*args, **keywords)
+    cpuStart = threadCpuTime()
+    wallStart = time.time()
+    try:
+        return f(*args, **keywords)
+    finally:
+        if cpuStart != None:
+            _sampler.addModule(name, threadCpuTime() - cpuStart, time.time() - wallStart)
+
+
+def command(args):
+    """Handle "profile" command from command port and return output lines.
+    profile start [seconds] [interval_ms] ... start sampling (default 30s, 10ms)
+    profile stop ............................ stop sampling
+    profile status .......................... profiler state
+    profile stacks .......................... collapsed stacks (flamegraph)
+    profile modules ......................... CPU time spent by modules
+    """
+    if len(args) == 0:
+        return [ x.strip() for x in command.__doc__.split("\n")[1:] if x.strip() != '' ]
+    cmd = args[0].lower()
+    if cmd == 'start':
+        duration = 30
+        interval = 0.01
+        if len(args) > 1:
+            duration = float(args[1])
+        if len(args) > 2:
+            interval = float(args[2]) / 1000
+        if threadCpuTime() == None:
+            logging.getLogger().warn("thread CPU clock is not available, module CPU time will not be measured")
+        _sampler.start(duration, interval)
+        return [ _sampler.getStatus() ]
+    elif cmd == 'stop':
+        _sampler.stop()
+        return [ _sampler.getStatus() ]
+    elif cmd == 'status':
+        return [ _sampler.getStatus() ]
+    elif cmd == 'stacks':
+        return _sampler.getCollapsed()
+    elif cmd == 'modules':
+        return _sampler.getModules()
+    return [ "unknown profile command %s" % cmd ]
@@ -9,19 +9,23 @@
 #
 # $Id$
 #
-import sys, time, string, gc, resource, pickle
+import os, sys, time, gc, resource, pickle
 import logging
 import threading
 import traceback
 import StringIO
-from twisted.internet import reactor, protocol, interfaces, threads
+from twisted.internet import reactor, protocol, interfaces, threads, defer
 from twisted.enterprise import adbapi
 from twisted.protocols.basic import LineReceiver
+from executor import Executor, ExecutorOverflow, CheckPool, Future
+from worker import getWorkerId
+from tools import deadline, metrics, cachekey, membudget
+import profiler
 
 
 class CommandProtocol(LineReceiver):
 
-    COMMANDS = [ "quit" ]
+    COMMANDS = [ "quit", "status", "executors", "cache", "memory", "metrics", "profile" ]
 
     def __init__(self):
         self.factory = None # set by buildProtocol
@@ -49,6 +53,41 @@ class CommandProtocol(LineReceiver):
             self.sendLine('bye')
             self.transport.loseConnection()
             return
+        if line.lower() == 'status':
+            for name, value in ppolicyFactory.getStatus():
+                self.sendLine("%s: %s" % (name, value))
+            self.__printPrefix('>>> ')
+            return
+        if line.lower() == 'metrics':
+            for line in ppolicyFactory.getMetrics().rstrip("\n").split("\n"):
+                self.sendLine(line)
+            self.__printPrefix('>>> ')
+            return
+        if line.lower().split(' ')[0] == 'profile':
+            try:
+                for line in profiler.command(line.split()[1:]):
+                    self.sendLine(line)
+            except Exception, e:
+                self.sendLine("profile failed: %s" % e)
+            self.__printPrefix('>>> ')
+            return
+        if line.lower() == 'cache':
+            for name, stats in ppolicyFactory.getCacheStats():
+                self.sendLine("%s: %s" % (name, ", ".join([ "%s=%s" % x for x in stats ])))
+            self.__printPrefix('>>> ')
+            return
+        if line.lower() == 'memory':
+            for name, used, limit in ppolicyFactory.getMemoryReport():
+                if limit == None:
+                    limit = 'unlimited'
+                self.sendLine("%s: used=%s, limit=%s" % (name, used, limit))
+            self.__printPrefix('>>> ')
+            return
+        if line.lower() == 'executors':
+            for name, stats in ppolicyFactory.getExecutorStats():
+                self.sendLine("%s: %s" % (name, ", ".join([ "%s=%s" % x for x in stats ])))
+            self.__printPrefix('>>> ')
+            return
         try:
             prefix = '>>> '
             buf = ''
@@ -106,6 +145,39 @@ class CommandFactory(protocol.ServerFactory):
         pass
 
 
+class MetricsProtocol(LineReceiver):
+    """Minimal HTTP/1.0 server that returns metrics in Prometheus text
+    format for any GET request."""
+
+    def __init__(self):
+        self.factory = None # set by buildProtocol
+        self.method = None
+
+    def lineReceived(self, line):
+        if self.method == None:
+            self.method = line.split(' ', 1)[0]
+            return
+        if line != '':
+            # ignore HTTP headers
+            return
+        if self.method in [ 'GET', 'HEAD' ]:
+            body = self.factory.factory.getMetrics()
+            self.transport.write("HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %i\r\n\r\n" % len(body))
+            if self.method == 'GET':
+                self.transport.write(body)
+        else:
+            self.transport.write("HTTP/1.0 405 Method Not Allowed\r\nContent-Length: 0\r\n\r\n")
+        self.transport.loseConnection()
+
+
+class MetricsFactory(protocol.ServerFactory):
+
+    protocol = MetricsProtocol
+
+    def __init__(self, factory):
+        self.factory = factory
+
+
 class PPolicyFactory(protocol.ServerFactory):
 
     """This is a factory which produces protocols."""
@@ -113,54 +185,371 @@ class PPolicyFactory(protocol.ServerFactory):
     __implements__ = (interfaces.IProtocolFactory,)
 
 
+    # options that invalidate cached results resp. database connections
+    CACHE_OPTIONS = ( 'cacheEngine', 'cacheSize', 'cacheServers', 'cacheShmFile', 'cacheAdmission', 'cacheShards', 'cacheL1TTL', 'cacheTimeout', 'cacheDeadRetry', 'cacheBreakerFailures', 'cacheBreakerReset', 'cachePartitions' )
+    DATABASE_OPTIONS = ( 'databaseAPI', 'database' )
+
+
     def __init__(self, config = {}):
         self.protocol = PPolicyRequest
+        self.configVersion = 0
+        self.reloading = None
+        self.reloadPending = None
+        self.reloadWaiting = []
+        self.flights = {}   # cache key -> Future of running check
+        self.flightsLock = threading.Lock()
         self.__initConfig(config)
 
 
     def __initConfig(self, config):
         self.numProtocols = 0
         self.numProtocolsId = 0
+        self.requestsInFlight = 0
+        self.requestsRejected = 0
+        self.requestsExpired = 0
+        self.requestsSkipped = 0
         self.dbPool = None
         self.config = config
         self.modules = {}
-        self.__addChecks(self.getConfig('modules'))
-        self.cacheValue = {}   # used by local cache engine
-        self.cacheExpire = {}  # used by local cache engine
+        self.moduleDefs = {}
+        self.moduleLocks = {}
+        self.moduleKeys = {}   # name -> cache key prefix
+        self.startGeneration = 0
+        self.__addChecks(self.getConfig('modules'), self.__loadState())
+        self.__initRuntime()
+        self.__initCache()
+
+
+    def __initRuntime(self):
+        """Create executors, thread pools and session memo. These
+        objects don't keep any data that should survive reload."""
+        self.executors = {}
+        for name, params in self.getConfig('executors', {}).items():
+            logging.getLogger().info("Adding executor %s(%s)" % (name, params))
+            self.executors[name] = Executor(name, **params)
+        self.checkPool = CheckPool('check', self.getConfig('checkManyThreads', 20))
+        self.refreshPool = CheckPool('refresh', self.getConfig('refreshThreads', 5))
+        if not hasattr(self, 'refreshLock'):
+            self.refreshLock = threading.Lock()
+            self.refreshing = {}   # cache keys with running refresh
+        if not hasattr(self, 'saveResultLock'):
+            self.saveResultLock = threading.Lock()
+        self.dnsPrefetch = None
+        if self.getConfig('dnsPrefetch') != None:
+            from tools import dnscache
+            self.dnsPrefetch = dnscache.Prefetch(self.getConfig('dnsPrefetchThreads', 10))
+        self.moduleExecutors = {}
+        for name in self.modules.keys():
+            executor = self.getExecutor(name)
+            if executor != None:
+                self.moduleExecutors[name] = executor
+        self.sessionMemo = {}  # instance -> [ expire, { key: result } ]
+        self.sessionMemoTTL = self.getConfig('sessionMemoTTL', 10*60)
+        self.sessionMemoSize = self.getConfig('sessionMemoSize', 1000)
+        self.sessionMemoCleanup = time.time() + self.sessionMemoTTL
+        if not hasattr(self, 'sessionMemoLock'):
+            self.sessionMemoLock = threading.Lock()
+        self.memoryBudget = membudget.MemoryBudget(self.getMemoryCaches,
+                                                   self.getConfig('memoryBudget'),
+                                                   self.getConfig('memoryBudgets', {}),
+                                                   self.getConfig('memoryCheckInterval', 60))
+        self.memoryBudget.start()
+
+
+    def __stopRuntime(self):
+        for executor in self.executors.values():
+            executor.stop()
+        self.checkPool.stop()
+        self.refreshPool.stop()
+        self.memoryBudget.stop()
+        if self.dnsPrefetch != None:
+            self.dnsPrefetch.stop()
+
+
+    def __initCache(self):
+        self.__stopCache()
+        self.cacheLocal = None  # used by local and tiered cache engine
+        self.cacheTiered = None # used by tiered cache engine
+        self.cacheMemcache = None # used by memcache and tiered engine
+        self.cachePartitions = {} # partition name -> local or tiered cache
+        self.cacheModules = {}  # module name -> cache of its partition
         self.cacheEngine = self.getConfig('cacheEngine', 'local')
         if self.cacheEngine == 'local':
+            from tools import lrucache
             self.__cacheGet = self.__cacheGetLocal
             self.__cacheSet = self.__cacheSetLocal
             self.cacheSize = self.getConfig('cacheSize', 10000)
-            if not hasattr(self, 'cacheLock'):
-                self.cacheLock = threading.Lock()
+            self.cacheLocal = lrucache.createCache(self.cacheSize, self.getConfig('cacheShards', 1), self.getConfig('cacheAdmission'))
         elif self.cacheEngine == 'memcache':
-            import memcache
-            self.cacheServers = self.getConfig('cacheServers', [ '127.0.0.1:11211' ])
-            self.cacheMemcache = memcache.Client(self.cacheServers)
-            sver = sys.version_info
-            mver = tuple([ int(x) for x in memcache.__version__.split('.')[:2] ])
-            if sver[0] >= 2 and sver[1] >= 4 and mver[0] >= 1 and mver[1] >= 40:
-                # thread safe memcached
-                self.__cacheGet = self.__cacheGetMemcache
-                self.__cacheSet = self.__cacheSetMemcache
-            else:
-                # memcache requires locking
-                if not hasattr(self, 'cacheLock'):
-                    self.cacheLock = threading.Lock()
-                self.__cacheGet = self.__cacheGetMemcacheLocking
-                self.__cacheSet = self.__cacheSetMemcacheLocking
+            self.__initMemcache()
+            self.__cacheGet = self.__cacheGetMemcache
+            self.__cacheSet = self.__cacheSetMemcache
+        elif self.cacheEngine == 'tiered':
+            from tools import lrucache, tieredcache
+            self.__initMemcache()
+            self.cacheSize = self.getConfig('cacheSize', 10000)
+            l1 = lrucache.createCache(self.cacheSize, self.getConfig('cacheShards', 1), self.getConfig('cacheAdmission'))
+            self.cacheTiered = tieredcache.TieredCache(l1, self.cacheMemcache, self.getConfig('cacheL1TTL', 5))
+            self.cacheLocal = self.cacheTiered
+            self.__cacheGet = self.__cacheGetTiered
+            self.__cacheSet = self.__cacheSetTiered
+        elif self.cacheEngine == 'shm':
+            from tools import shmcache
+            self.cacheSize = self.getConfig('cacheSize', 10000)
+            self.cacheShm = shmcache.SharedCache(self.getConfig('cacheShmFile', '/dev/shm/ppolicy.cache'), self.cacheSize)
+            self.__cacheGet = self.__cacheGetShm
+            self.__cacheSet = self.__cacheSetShm
         else:
             raise Exception("Unknown cache engine %s" % self.cacheEngine)
+        self.__initPartitions()
+
+
+    def __initPartitions(self):
+        """Create cache partitions for modules that should not share
+        local cache with other modules (e.g. Greylist with many unique
+        keys would evict long lived DnsblScore results). Each partition
+        has own size, shards, admission policy and statistics."""
+        partitions = self.getConfig('cachePartitions', {})
+        if len(partitions) == 0:
+            return
+        if self.cacheEngine not in [ 'local', 'tiered' ]:
+            logging.getLogger().warn("cache partitions are not supported by %s cache engine" % self.cacheEngine)
+            return
+        from tools import lrucache, tieredcache
+        for partName, params in partitions.items():
+            logging.getLogger().info("Adding cache partition %s(%s)" % (partName, params))
+            cache = lrucache.createCache(params.get('size', self.cacheSize),
+                                         params.get('shards', self.getConfig('cacheShards', 1)),
+                                         params.get('admission', self.getConfig('cacheAdmission')))
+            if self.cacheEngine == 'tiered':
+                cache = tieredcache.TieredCache(cache, self.cacheMemcache, params.get('l1TTL', self.getConfig('cacheL1TTL', 5)))
+            self.cachePartitions[partName] = cache
+            for modName in params.get('modules', [ partName ]):
+                if self.cacheModules.has_key(modName):
+                    raise Exception("module %s is in more cache partitions" % modName)
+                self.cacheModules[modName] = cache
+
+
+    def __stopCache(self):
+        """Write results waiting in tiered cache and close memcache
+        connections and shared cache file."""
+        if getattr(self, 'cacheTiered', None) != None:
+            self.cacheTiered.stop()
+            for cache in self.cachePartitions.values():
+                cache.stop()
+        if getattr(self, 'cacheMemcache', None) != None:
+            self.cacheMemcache.disconnect()
+        if getattr(self, 'cacheShm', None) != None:
+            # shared cache file can be resized only if it is not mapped
+            self.cacheShm.close()
+            self.cacheShm = None
+
+
+    def __initMemcache(self):
+        """Create memcache clients for memcache and tiered engine."""
+        from tools import memcachepool
+        self.cacheServers = self.getConfig('cacheServers', [ '127.0.0.1:11211' ])
+        self.cacheMemcache = memcachepool.MemcachePool(self.cacheServers,
+                                                       self.getConfig('cacheTimeout', 0.5),
+                                                       self.getConfig('cacheDeadRetry', 5),
+                                                       self.getConfig('cacheBreakerFailures', 5),
+                                                       self.getConfig('cacheBreakerReset', 10))
 
 
     def reload(self, config = None):
-        # FIXME: Implement factrory reloading
-        self.stopFactory() # FIXME: stop all "check" before doing "__stopCheck"
+        """Apply new configuration without restarting ppolicy. New
+        requests are queued until requests in progress finish (at most
+        reloadTimeout seconds), then only added modules and modules
+        with changed definition are (re)started. Unchanged modules
+        keep their instances including all cached data and results
+        in cache engine stay valid. Modules and threads are stopped
+        in background thread, so reactor is not blocked. Returns
+        deferred that fires when new configuration is active."""
         if config == None:
             config = self.config
-        self.__initConfig(config)
-        self.startFactory()
+        if self.reloading != None:
+            # apply the latest configuration after current reload
+            logging.getLogger().info("reload in progress, new configuration will be applied later")
+            self.reloadPending = config
+            return self.reloading
+        logging.getLogger().info("reloading factory %s (%i requests in progress)" % (self, self.requestsInFlight))
+        self.reloading = defer.Deferred()
+        d = self.reloading
+        self.__reloadWait(config, time.time() + self.getConfig('reloadTimeout', 60))
+        return d
+
+
+    def isReloading(self):
+        return self.reloading != None
+
+
+    def waitReload(self, f):
+        """Call f when reload finished."""
+        if f not in self.reloadWaiting:
+            self.reloadWaiting.append(f)
+
+
+    def __reloadWait(self, config, endTime):
+        if self.requestsInFlight > 0:
+            if time.time() < endTime:
+                reactor.callLater(0.1, self.__reloadWait, config, endTime)
+                return
+            logging.getLogger().warn("reload timeout, %i requests still in progress" % self.requestsInFlight)
+
+        # stopping modules and joining threads can take several seconds
+        thread = threading.Thread(target=self.__reloadRun, args=(config,), name="reload")
+        thread.setDaemon(True)
+        thread.start()
+
+
+    def __reloadRun(self, config):
+        dbPool = None
+        try:
+            dbPool = self.__reloadConfig(config)
+        except Exception, e:
+            logging.getLogger().error("reload failed: %s" % e)
+            logging.getLogger().error(traceback.format_exc())
+        reactor.callFromThread(self.__reloadDone, dbPool)
+
+
+    def __reloadDone(self, dbPool):
+        """Finish reload in reactor thread."""
+        if dbPool != None and dbPool.running == 1:
+            dbPool.close()
+
+        d = self.reloading
+        waiting = self.reloadWaiting
+        self.reloading = None
+        self.reloadWaiting = []
+        for f in waiting:
+            reactor.callLater(0, f)
+        d.callback(None)
+
+        if self.reloadPending != None:
+            config = self.reloadPending
+            self.reloadPending = None
+            self.reload(config)
+
+
+    def __refreshWait(self, endTime):
+        """Wait for background refreshes started before refresh pool
+        was stopped (they call modules that are going to be stopped)."""
+        while time.time() < endTime:
+            self.refreshLock.acquire()
+            try:
+                running = len(self.refreshing)
+            finally:
+                self.refreshLock.release()
+            if running == 0:
+                return
+            time.sleep(0.1)
+        logging.getLogger().warn("reload timeout, %i refreshes still in progress" % running)
+
+
+    def __reloadCheck(self, config):
+        """Raise exception for configuration options that would fail
+        after running configuration was stopped."""
+        if config.get('cacheEngine', 'local') not in [ 'local', 'memcache', 'tiered', 'shm' ]:
+            raise Exception("Unknown cache engine %s" % config.get('cacheEngine'))
+        for name, params in config.get('executors', {}).items():
+            Executor(name, **params)
+
+
+    def __reloadConfig(self, config):
+        """Apply new configuration (called in reload thread while new
+        requests wait). New and changed modules are created before
+        running modules are stopped, so invalid configuration (unknown
+        module type, bad parameters) keeps the current one. Returns
+        database pool that has to be closed in reactor thread."""
+        oldConfig = self.config
+        newDefs = config.get('modules', {})
+
+        restartAll = False
+        for key in self.DATABASE_OPTIONS:
+            if oldConfig.get(key) != config.get(key):
+                logging.getLogger().info("database configuration changed, restarting all modules")
+                restartAll = True
+                break
+
+        added = {}
+        for modName, v in newDefs.items():
+            if restartAll or v != self.moduleDefs.get(modName):
+                added[modName] = v
+        self.__reloadCheck(config)
+        created = self.__createChecks(added)
+
+        # no new refreshes are started after runtime stopped
+        self.__stopRuntime()
+        try:
+            dbPool = self.__reloadModules(config, newDefs, created, restartAll)
+        finally:
+            self.__initRuntime()
+
+        cacheChanged = False
+        for key in self.CACHE_OPTIONS:
+            if oldConfig.get(key) != config.get(key):
+                cacheChanged = True
+        if cacheChanged:
+            logging.getLogger().info("cache configuration changed, cached results dropped")
+            self.__initCache()
+        elif restartAll and self.cacheLocal != None:
+            # cache keys contains module definition, so results of
+            # changed modules are not used (they are evicted later),
+            # but database content can be different for same definition
+            logging.getLogger().info("database configuration changed, cached results dropped")
+            self.cacheLocal.clear()
+            for cache in self.cachePartitions.values():
+                cache.clear()
+
+        self.__startChecks(created.keys())
+        logging.getLogger().info("reload finished: %i modules kept, %i started" % (len(self.modules) - len(created), len(created)))
+        return dbPool
+
+
+    def __reloadModules(self, config, newDefs, created, restartAll):
+        """Stop removed and changed modules and replace them with
+        created instances (runtime is stopped)."""
+        self.__refreshWait(time.time() + self.getConfig('reloadTimeout', 60))
+
+        # stop removed and changed modules
+        state = {}
+        changed = []
+        for modName, modVal in self.modules.items():
+            if not restartAll and newDefs.get(modName) == self.moduleDefs.get(modName):
+                continue
+            logging.getLogger().info("Stop module %s" % modVal[0].getId())
+            lock = self.moduleLocks[modName]
+            lock.acquire()
+            try:
+                try:
+                    if modVal[1]:
+                        modVal[0].stop()
+                        modVal[1] = False
+                    modState = modVal[0].getState()
+                    if len(modState) > 0 and newDefs.has_key(modName) and newDefs[modName][0] == modVal[0].type:
+                        state[modName] = modState
+                except Exception, e:
+                    logging.getLogger().error("Stop module %s failed: %s" % (modVal[0].getId(), e))
+                del(self.modules[modName])
+                del(self.moduleDefs[modName])
+                del(self.moduleKeys[modName])
+            finally:
+                lock.release()
+            del(self.moduleLocks[modName])
+            changed.append(modName)
+
+        dbPool = None
+        if restartAll and self.dbPool != None:
+            dbPool = self.dbPool
+            self.dbPool = None
+
+        self.config = config
+        self.configVersion += 1
+
+        # add new and changed modules
+        self.__installChecks(created, state)
+        logging.getLogger().info("%i modules stopped" % len(changed))
+        return dbPool
 
 
     def getDbPool(self):
@@ -175,6 +564,9 @@ class PPolicyFactory(protocol.ServerFactory):
 
 
     def getDbConnection(self):
+        if deadline.expired():
+            raise deadline.DeadlineExceeded()
+        metrics.inc('sql_connections_total')
         return self.getDbPool().connect()
 
 
@@ -185,14 +577,192 @@ class PPolicyFactory(protocol.ServerFactory):
         pass
 
 
+    def closeDbConnection(self, conn):
+        """Close connection returned by getDbConnection in thread that
+        is going to finish (e.g. background cleanup). Connection pool
+        keeps one connection for each thread and it would never be
+        used again."""
+        try:
+            if self.dbPool == None:
+                raise Exception("connection pool was closed")
+            self.dbPool.disconnect(conn)
+        except Exception, e:
+            # pool was replaced by reload, close connection directly
+            logging.getLogger().debug("closing database connection outside pool: %s" % e)
+            try:
+                conn.close()
+            except Exception, e:
+                logging.getLogger().debug("closing database connection failed: %s" % e)
+
+
+    def __closeThreadDbConnection(self):
+        """Close pooled database connection of current thread (if any)."""
+        pool = self.dbPool
+        if pool == None:
+            return
+        conn = pool.connections.get(pool.threadID())
+        if conn != None:
+            self.closeDbConnection(conn)
+
+
     def getConfig(self, key, default = None):
         return self.config.get(key, default)
 
 
+    def getExecutor(self, name):
+        """Return executor used to limit concurrency of module name
+        (None if calls of this module are not limited). Executor is
+        selected by module "executor" parameter or executor with
+        the same name as module name or module type."""
+        obj = self.modules[name][0]
+        for key in [ obj.getParam('executor'), name, obj.type ]:
+            if self.executors.has_key(key):
+                return self.executors[key]
+        return None
+
+
+    def isOverloaded(self):
+        """True if number of requests in progress reached
+        requestLimitOptional and optional modules should be skipped."""
+        limit = self.getConfig('requestLimitOptional')
+        return limit != None and self.requestsInFlight >= limit
+
+
+    def getStatus(self):
+        """Return list of (name, value) with current factory load."""
+        return [ ('connections', self.numProtocols),
+                 ('requestsInFlight', self.requestsInFlight),
+                 ('requestsRejected', self.requestsRejected),
+                 ('requestsExpired', self.requestsExpired),
+                 ('modulesSkipped', self.requestsSkipped) ]
+
+
+    def getMetrics(self):
+        """Return current metrics in Prometheus text format."""
+        gauges = [ ('connections', (), self.numProtocols),
+                   ('requests_in_flight', (), self.requestsInFlight) ]
+        try:
+            pool = reactor.getThreadPool()
+            gauges.append(('threadpool_queue', (), pool.q.qsize()))
+            gauges.append(('threadpool_working', (), len(pool.working)))
+            gauges.append(('threadpool_idle', (), len(pool.waiters)))
+            gauges.append(('threadpool_max', (), pool.max))
+        except Exception, e:
+            logging.getLogger().debug("unable to get thread pool stats: %s" % e)
+        if self.cacheLocal != None:
+            gauges.append(('cache_entries', (), len(self.cacheLocal)))
+        counters = []
+        names = self.cachePartitions.keys()
+        names.sort()
+        for name in names:
+            stats = self.cachePartitions[name].getStats()
+            gauges.append(('cache_entries', (('partition', name),), stats['entries']))
+            counters.append(('cache_hits_total', (('partition', name),), stats['hits']))
+            counters.append(('cache_misses_total', (('partition', name),), stats['misses']))
+        if self.cacheMemcache != None:
+            gauges.append(('cache_breaker_open', (), int(self.cacheMemcache.breaker.state != 'closed')))
+        if self.dnsPrefetch != None:
+            gauges.append(('dns_prefetch_queue', (), self.dnsPrefetch.queue.qsize()))
+        for name, used, limit in self.getMemoryReport():
+            gauges.append(('memory_bytes', (('cache', name),), used))
+        for name, stats in self.getExecutorStats():
+            for k, v in stats:
+                gauges.append(('executor_%s' % k, (('executor', name),), v))
+        return metrics.render(gauges, counters)
+
+
+    def getCacheStats(self):
+        """Return list of (name, sorted stats items) for memcache
+        clients, local cache, cache partitions and their shards."""
+        retVal = []
+        if self.cacheMemcache != None:
+            stats = self.cacheMemcache.getStats().items()
+            stats.sort()
+            retVal.append(('memcache', stats))
+        if self.cacheLocal == None:
+            return retVal
+        caches = [ ('cache', '', self.cacheLocal) ]
+        names = self.cachePartitions.keys()
+        names.sort()
+        for name in names:
+            caches.append(('cache:%s' % name, 'cache:%s:' % name, self.cachePartitions[name]))
+        for name, shardPrefix, cache in caches:
+            stats = cache.getStats().items()
+            stats.sort()
+            retVal.append((name, stats))
+            if hasattr(cache, 'getShardStats'):
+                i = 0
+                for stats in cache.getShardStats():
+                    stats = stats.items()
+                    stats.sort()
+                    retVal.append(('%sshard%i' % (shardPrefix, i), stats))
+                    i += 1
+        return retVal
+
+
+    def getMemoryCaches(self):
+        """Return list of (name, object) for memory budget. Objects
+        implement memoryUsage and memoryLimit methods (result cache,
+        DNS cache and check modules with own cache)."""
+        retVal = []
+        if self.cacheLocal != None:
+            retVal.append(('cache', self.cacheLocal))
+        elif getattr(self, 'cacheShm', None) != None and self.cacheEngine == 'shm':
+            retVal.append(('cache', self.cacheShm))
+        for name, cache in self.cachePartitions.items():
+            retVal.append(('cache:%s' % name, cache))
+        try:
+            from tools import dnscache
+            retVal.append(('dns', dnscache.getCache()))
+        except ImportError:
+            pass
+        for name, (obj, running) in self.modules.items():
+            if running:
+                retVal.append(('module:%s' % name, obj))
+        return retVal
+
+
+    def getMemoryReport(self):
+        """Return list of (name, used bytes, limit) from last memory
+        budget check."""
+        return self.memoryBudget.getReport()
+
+
+    def getExecutorStats(self):
+        """Return sorted list of (name, sorted stats items) for all executors."""
+        retVal = []
+        names = self.executors.keys()
+        names.sort()
+        for name in names:
+            stats = self.executors[name].getStats().items()
+            stats.sort()
+            retVal.append((name, stats))
+        stats = self.checkPool.getStats().items()
+        stats.sort()
+        retVal.append(('checkMany', stats))
+        return retVal
+
+
+    def __getStateFile(self, load = False):
+        """Each worker process uses its own state file, saved state
+        from single process mode is used when worker starts first time."""
+        stateFile = self.config.get('stateFile')
+        workerId = getWorkerId()
+        if stateFile == None or workerId == 0:
+            return stateFile
+        workerStateFile = "%s.%i" % (stateFile, workerId)
+        if load and not os.path.exists(workerStateFile):
+            return stateFile
+        return workerStateFile
+
+
     def __loadState(self):
         try:
-            logging.getLogger().info("loading ppolicy state from %s" % self.config.get('stateFile'))
-            inputStream = open(self.config['stateFile'])
+            stateFile = self.__getStateFile(True)
+            if stateFile == None:
+                return None
+            logging.getLogger().info("loading ppolicy state from %s" % stateFile)
+            inputStream = open(stateFile)
             data = pickle.Unpickler(inputStream).load()
             inputStream.close()
             return data
@@ -207,10 +777,13 @@ class PPolicyFactory(protocol.ServerFactory):
 
     def __saveState(self, data):
         try:
-            logging.getLogger().info("saving ppolicy state to %s" % self.config.get('stateFile'))
+            stateFile = self.__getStateFile()
+            if stateFile == None:
+                return
+            logging.getLogger().info("saving ppolicy state to %s" % stateFile)
             if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
                 logging.getLogger().debug("store: %s" % data)
-            outputStream = open(self.config['stateFile'], "w")
+            outputStream = open(stateFile, "w")
             if pickle.format_version >= '2.0':
                 pickle.Pickler(outputStream, protocol=-1).dump(data)
             else:
@@ -224,8 +797,15 @@ class PPolicyFactory(protocol.ServerFactory):
             logging.getLogger().error("unable to save state: %s" % e)
 
 
-    def __addChecks(self, modules):
-        state = self.__loadState()
+    def __addChecks(self, modules, state = None):
+        self.__installChecks(self.__createChecks(modules), state)
+
+
+    def __createChecks(self, modules):
+        """Create (not started) module instances for definitions,
+        returns dictionary name -> (instance, definition, cache key
+        prefix). Raises exception for invalid definition."""
+        created = {}
         for modName,v in modules.items():
             modType = v[0]
             modParams = v[1]
@@ -235,221 +815,700 @@ class PPolicyFactory(protocol.ServerFactory):
             if not self.modules.has_key(modName):
                 logging.getLogger().info("Adding module %s[%s(%s)]" % (modType, modName, modParams))
             else:
-                logging.getLogger().warn("Redeclaration of module %s[%s(%s)]" % (modType, modName, modParams))
+                logging.getLogger().info("Replacing module %s[%s(%s)]" % (modType, modName, modParams))
             globals()[modType] = eval("__import__('%s', globals(),  locals(), [])" % modType)
             obj = eval("%s.%s('%s', self, **%s)" % (modType, modType, modName, modParams))
+            created[modName] = (obj, v, cachekey.modulePrefix(modName, v))
+        return created
+
+
+    def __installChecks(self, created, state = None):
+        """Add instances returned by __createChecks to factory."""
+        for modName, (obj, v, keyPrefix) in created.items():
             if state != None:
-                obj.setState(state.get(modName, {}))
+                try:
+                    obj.setState(state.get(modName, {}))
+                except Exception, e:
+                    logging.getLogger().error("Restore state of module %s failed: %s" % (obj.getId(), e))
             self.modules[modName] = [ obj, False ]
+            self.moduleDefs[modName] = v
+            self.moduleKeys[modName] = keyPrefix
+            self.moduleLocks[modName] = threading.Lock()
 
 
-    def __startChecks(self):
-        """Start factory modules."""
-        for modName, modVal in self.modules.items():
+    def __startModule(self, name, generation = None):
+        """Start module unless it is already running. Module is started
+        only once even when it is used by requests before background
+        start finished (these requests wait for it)."""
+        lock = self.moduleLocks.get(name)
+        if lock == None:
+            return
+        lock.acquire()
+        try:
+            if generation != None and generation != self.startGeneration:
+                # factory was stopped before this module started
+                return
+            modVal = self.modules.get(name)
+            if modVal == None or modVal[1]:
+                return
             logging.getLogger().info("Start module %s" % modVal[0].getId())
+            startTime = time.time()
+            modVal[0].start()
+            modVal[1] = True
+            logging.getLogger().info("Module %s started in %.3fs" % (modVal[0].getId(), time.time() - startTime))
+        finally:
+            lock.release()
+
+
+    def __startChecks(self, names = None):
+        """Start factory modules (all if names is None). Modules are
+        started in parallel by startThreads threads and with enabled
+        startBackground this method doesn't wait until they are
+        started, so ppolicy can accept connections immediately."""
+        if names == None:
+            names = self.modules.keys()
+        if len(names) == 0:
+            return
+        generation = self.startGeneration
+
+        def startModule(modName):
             try:
-                modVal[0].start()
-                modVal[1] = True
+                self.__startModule(modName, generation)
             except Exception, e:
-                logging.getLogger().error("Start module %s failed: %s" % (modVal[0].getId(), e))
+                logging.getLogger().error("Start module %s failed: %s" % (modName, e))
+            # start threads finish, don't leave their connections in pool
+            self.__closeThreadDbConnection()
+
+        def startAll():
+            startTime = time.time()
+            pool = CheckPool('start', self.getConfig('startThreads', 10))
+            try:
+                futures = []
+                for modName in names:
+                    futures.append(pool.submit(startModule, modName))
+                for future in futures:
+                    future.result()
+            finally:
+                pool.stop()
+            logging.getLogger().info("%i modules started in %.3fs" % (len(names), time.time() - startTime))
+
+        if self.getConfig('startBackground', True):
+            thread = threading.Thread(target=startAll, name="start")
+            thread.setDaemon(True)
+            thread.start()
+        else:
+            startAll()
 
 
     def __stopChecks(self):
         """Stop factory modules."""
+        self.startGeneration += 1
         state = {}
         for modName, modVal in self.modules.items():
             logging.getLogger().info("Stop module %s" % modVal[0].getId())
+            lock = self.moduleLocks[modName]
+            lock.acquire()
             try:
-                modVal[0].stop()
-                modVal[1] = False
-                modState = modVal[0].getState()
-                if len(modState) > 0:
-                    state[modName] = modState
-            except Exception, e:
-                logging.getLogger().error("Stop module %s failed: %s" % (modVal[0].getId(), e))
+                try:
+                    modVal[0].stop()
+                    modVal[1] = False
+                    modState = modVal[0].getState()
+                    if len(modState) > 0:
+                        state[modName] = modState
+                except Exception, e:
+                    logging.getLogger().error("Stop module %s failed: %s" % (modVal[0].getId(), e))
+            finally:
+                lock.release()
         self.__saveState(state)
 
 
-    def check(self, name, data, *args, **keywords):
-        """Called from config file. We should cache results here."""
-        startTime = time.time()
-        allStartTime = data.get('resource_start_time', startTime)
-        reqid = data.get('instance', "unknown%i" % allStartTime)
+    def __checkBegin(self, name, data):
+        """Find module and prepare its call context."""
+        ctx = { 'name': name, 'startTime': time.time() }
+        ctx['allStartTime'] = data.get('resource_start_time', ctx['startTime'])
+        ctx['reqid'] = data.get('instance', "unknown%i" % ctx['allStartTime'])
+        ctx['prefix'] = "result_%s" % name
+        ctx['saveResult'] = False
+        ctx['deadline'] = data.get(deadline.DATA_KEY)
+        ctx['memoKey'] = None
+        ctx['memoHit'] = False
+        ctx['stale'] = False
+        ctx['flight'] = None
+        ctx['coalesced'] = False
 
         if not self.modules.has_key(name):
             raise Exception("module named \"%s\" was not defined" % name)
 
-        prefix = "result_%s" % name
-        saveResult = False
-        try:
-            obj, running = self.modules.get(name)
+        return ctx
 
-            saveResult = obj.getParam('saveResult', False)
-            if saveResult:
-                prefix = "%s%s" % (obj.getParam('saveResultPrefix', ''), name)
+
+    def __checkCached(self, ctx, data, *args, **keywords):
+        """Start module if necessary and return its cached result
+        (None if the check has to be called)."""
+        name = ctx['name']
+        obj, running = self.modules.get(name)
+        ctx['obj'] = obj
+
+        ctx['saveResult'] = obj.getParam('saveResult', False)
+        if ctx['saveResult']:
+            prefix = "%s%s" % (obj.getParam('saveResultPrefix', ''), name)
+            # checks submitted by checkMany can run at the same time,
+            # so reserve result keys for this call
+            self.saveResultLock.acquire()
+            try:
                 if data.has_key("%s_code" % prefix):
                     reqnum = 1
                     while data.has_key("%s#%i_code" % (prefix, reqnum)):
                         reqnum += 1
                     prefix = "%s#%i" % (prefix, reqnum)
+                data["%s_code" % prefix] = None
+            finally:
+                self.saveResultLock.release()
+            ctx['prefix'] = prefix
+
+        if not running:
+            self.__startModule(name)
+
+        logging.getLogger().info("%s running %s[%i]", ctx['reqid'], name, int((ctx['startTime'] - ctx['allStartTime']) * 1000))
+        if obj.getParam('sessionMemo', False) and data.has_key('instance'):
+            sessionArg = obj.sessionArg(data, *args, **keywords)
+            if sessionArg != 0:
+                ctx['memoKey'] = (name, sessionArg)
+                result = self.__sessionMemoGet(data['instance'], ctx['memoKey'])
+                if result != None:
+                    ctx['memoHit'] = True
+                    return result
+
+        hashArg = obj.hashArg(data, *args, **keywords)
+        if hashArg != 0:
+            hashArg = cachekey.makeKey(self.moduleKeys[name], hashArg)
+        ctx['hashArg'] = hashArg
+        ctx['executor'] = self.moduleExecutors.get(name)
+
+        cacheData = self.__cacheGet(name, hashArg)
+        if cacheData != None and len(cacheData) > 2:
+            # result of module with staleTTL (code, codeEx, fresh)
+            if cacheData[2] < time.time():
+                ctx['stale'] = True
+                self.__refresh(ctx, cacheData, data, args, keywords)
+            cacheData = cacheData[:2]
+        return cacheData
+
+
+    def __checkEnd(self, ctx, data, result, cached, store = True):
+        """Cache (unless store is False) and save module result."""
+        name = ctx['name']
+        obj = ctx['obj']
+        prefix = ctx['prefix']
+        code, codeEx = result
+
+        if ctx['memoHit']:
+            hitCache = ' memo'
+            metrics.inc('module_cache_total', (('module', name), ('result', 'memo')))
+        elif ctx['stale']:
+            hitCache = ' stale'
+            metrics.inc('module_cache_total', (('module', name), ('result', 'stale')))
+        elif ctx['coalesced']:
+            hitCache = ' coalesced'
+            metrics.inc('module_cache_total', (('module', name), ('result', 'coalesced')))
+        elif cached:
+            hitCache = ' cached'
+            metrics.inc('module_cache_total', (('module', name), ('result', 'hit')))
+        else:
+            hitCache = ''
+            metrics.inc('module_cache_total', (('module', name), ('result', 'miss')))
+        stored = False
+        if not cached and store:
+            stored = self.__cacheStore(name, ctx['hashArg'], obj, code, codeEx)
+        # requests waiting for this check get only result that
+        # would be returned from cache
+        self.__flightEnd(ctx, stored and result or None)
+        if ctx['memoKey'] != None and not ctx['memoHit'] and store:
+            self.__sessionMemoSet(data['instance'], ctx['memoKey'], (code, codeEx))
+
+        endTime = time.time()
+        metrics.observe('module_duration_seconds', endTime - ctx['startTime'], (('module', name),))
+        if ctx['saveResult']:
+            data["%s_code" % prefix] = code
+            data["%s_info" % prefix] = codeEx
+            data["%s_cache" % prefix] = cached
+            data["%s_time" % prefix] = int((endTime - ctx['startTime']) * 1000)
+            if logging.getLogger().getEffectiveLevel() < logging.DEBUG:
+                rusage = resource.getrusage(resource.RUSAGE_SELF)
+                rusageStr = "[ %.3f, %.3f, %s ]" % (rusage[0], rusage[1], str(rusage[2:])[1:-1])
+                data["%s_resource" % prefix] = "cache(%i), gc(%s, %s), rs%s" % (self.cacheLocal != None and len(self.cacheLocal) or 0, len(gc.get_objects()), len(gc.garbage), rusageStr)
+        logging.getLogger().info("%s result%s %s[%i,%i]: %s (%s)", ctx['reqid'], hitCache, name, int((endTime - ctx['allStartTime']) * 1000), int((endTime - ctx['startTime']) * 1000), code, codeEx)
+
+        return code, codeEx
+
+
+    def __checkError(self, ctx, data, e, tb = None):
+        """Save and log result for module that failed with exception."""
+        name = ctx['name']
+        prefix = ctx['prefix']
+        code = 0
+        codeEx = "%s failed with exception" % name
+        self.__flightEnd(ctx, None)
+        endTime = time.time()
+        try:
+            if ctx['saveResult']:
+                data["%s_code" % prefix] = code
+                data["%s_info" % prefix] = codeEx
+                data["%s_time" % prefix] = int((endTime - ctx['startTime']) * 1000)
+        except:
+            pass
 
-            if not running:
-                obj.start()
+        metrics.inc('module_errors_total', (('module', name),))
+        logging.getLogger().error("%s failed %s[%i,%i]: %s" % (ctx['reqid'], name, int((endTime - ctx['allStartTime']) * 1000), int((endTime - ctx['startTime']) * 1000), e))
+        if tb == None:
+            exc_info_type, exc_info_value, exc_info_traceback = sys.exc_info()
+            tb = traceback.format_exception(exc_info_type, exc_info_value, exc_info_traceback)
+        logging.getLogger().error("%s: %s" % (ctx['reqid'], tb))
+        return code, codeEx
 
-            logging.getLogger().info("%s running %s[%i]" % (reqid, name, int((startTime - allStartTime) * 1000)))
-            hashArg = obj.hashArg(data, *args, **keywords)
-            if hashArg != 0:
-                hashArg = "%s%s" % (name, hashArg)
 
-            cacheData = self.__cacheGet(hashArg)
-            if cacheData == None:
-                hitCache = ''
-                #logging.getLogger().debug("%s: running %s.check(%s, %s, %s)" % (reqid, name, data, args, keywords))
-                code, codeEx = obj.check(data, *args, **keywords)
-                self.__cacheSet(hashArg, code, codeEx, obj.getParam('cachePositive'), obj.getParam('cacheUnknown'), obj.getParam('cacheNegative'))
-            else:
-                hitCache = ' cached'
-                code, codeEx = cacheData
+    def __checkDeadline(self, ctx, when):
+        """Return unknown result if request deadline was exceeded. Such
+        result is not cached, because modules shorten their timeouts
+        according remaining time and their result can be incomplete."""
+        if ctx['deadline'] == None or time.time() < ctx['deadline']:
+            return None
+        logging.getLogger().warn("%s %s %s, request deadline exceeded" % (ctx['reqid'], ctx['name'], when))
+        return 0, "%s %s, request deadline exceeded" % (ctx['name'], when)
+
+
+    def __checkOverload(self, ctx):
+        """Return unknown result for optional module when ppolicy
+        is overloaded (result is not cached)."""
+        if not ctx['obj'].getParam('optional', False) or not self.isOverloaded():
+            return None
+        self.requestsSkipped += 1
+        metrics.inc('modules_skipped_total', (('module', ctx['name']),))
+        logging.getLogger().info("%s %s skipped, ppolicy overloaded", ctx['reqid'], ctx['name'])
+        return 0, "%s skipped, ppolicy overloaded" % ctx['name']
 
-            endTime = time.time()
-            if saveResult:
-                data["%s_code" % prefix] = code
-                data["%s_info" % prefix] = codeEx
-                data["%s_cache" % prefix] = not (hitCache == '')
-                data["%s_time" % prefix] = int((endTime - startTime) * 1000)
-                if logging.getLogger().getEffectiveLevel() < logging.DEBUG:
-                    rusage = resource.getrusage(resource.RUSAGE_SELF)
-                    rusageStr = "[ %.3f, %.3f, %s ]" % (rusage[0], rusage[1], str(rusage[2:])[1:-1])
-                    data["%s_resource" % prefix] = "cache(%i), gc(%s, %s), rs%s" % (len(self.cacheValue), len(gc.get_objects()), len(gc.garbage), rusageStr)
-            logging.getLogger().info("%s result%s %s[%i,%i]: %s (%s)" % (reqid, hitCache, name, int((endTime - allStartTime) * 1000), int((endTime - startTime) * 1000), code, codeEx))
 
-            return code, codeEx
+    def check(self, name, data, *args, **keywords):
+        """Called from config file. We should cache results here."""
+        ctx = self.__checkBegin(name, data)
+        try:
+            cacheData = self.__checkCached(ctx, data, *args, **keywords)
+            if cacheData != None:
+                return self.__checkEnd(ctx, data, cacheData, True)
+
+            flight = self.__flightBegin(ctx)
+            if flight != None:
+                result = self.__flightWait(ctx, flight)
+                if result != None:
+                    return self.__checkEnd(ctx, data, result, True, False)
+
+            result = self.__checkDeadline(ctx, 'skipped')
+            if result != None:
+                return self.__checkEnd(ctx, data, result, False, False)
+
+            result = self.__checkOverload(ctx)
+            if result != None:
+                return self.__checkEnd(ctx, data, result, False, False)
+
+            #logging.getLogger().debug("%s: running %s.check(%s, %s, %s)" % (ctx['reqid'], name, data, args, keywords))
+            if ctx['executor'] != None:
+                result = deadline.callWithDeadline(ctx['deadline'], ctx['executor'].call, profiler.call, name, ctx['obj'].check, data, *args, **keywords)
+            else:
+                result = deadline.callWithDeadline(ctx['deadline'], profiler.call, name, ctx['obj'].check, data, *args, **keywords)
+
+            resultDeadline = self.__checkDeadline(ctx, 'finished')
+            if resultDeadline != None:
+                return self.__checkEnd(ctx, data, resultDeadline, False, False)
+            return self.__checkEnd(ctx, data, result, False)
+        except ExecutorOverflow, e:
+            return self.__checkEnd(ctx, data, e.result, False, False)
         except Exception, e:
-            code = 0
-            codeEx = "%s failed with exception" % name
-            endTime = time.time()
-            try:
-                if saveResult:
-                    data["%s_code" % prefix] = code
-                    data["%s_info" % prefix] = codeEx
-                    data["%s_time" % prefix] = int((endTime - startTime) * 1000)
-            except:
-                pass
-
-            logging.getLogger().error("%s failed %s[%i,%i]: %s" % (reqid, name, int((endTime - allStartTime) * 1000), int((endTime - startTime) * 1000), e))
-            exc_info_type, exc_info_value, exc_info_traceback = sys.exc_info()
-            logging.getLogger().error("%s: %s" % (reqid, traceback.format_exception(exc_info_type, exc_info_value, exc_info_traceback)))
             # raise e
-            return code, codeEx
+            return self.__checkError(ctx, data, e)
+
+
+    def submit(self, name, data, *args, **keywords):
+        """Start check in factory check pool and return Future, its
+        result() method waits for the same (code, codeEx) tuple
+        as returned by check. Called from config file to run
+        independent checks (e.g. DNS based) at the same time."""
+        return self.checkPool.submit(self.check, name, data, *args, **keywords)
+
+
+    def __checkManyItem(self, check):
+        if type(check) == str:
+            return check, (), {}
+        if len(check) == 1:
+            return check[0], (), {}
+        if len(check) == 2:
+            return check[0], check[1], {}
+        return check[0], check[1], check[2]
+
+
+    def checkMany(self, checks, data):
+        """Run several checks at the same time and return list of their
+        results in the same order. Each item in checks is module name
+        or tuple (name, args) or (name, args, keywords)."""
+        self.cachePrefetch(checks, data)
+        futures = []
+        for check in checks:
+            name, args, keywords = self.__checkManyItem(check)
+            if len(futures) == len(checks) - 1:
+                # last check runs in current thread
+                futures.append(Future())
+                futures[-1].run(self.check, name, data, *args, **keywords)
+            else:
+                futures.append(self.checkPool.submit(self.check, name, data, *args, **keywords))
+        return [ x.result() for x in futures ]
+
+
+    def checkManyAsync(self, checks, data):
+        """Asynchronous version of checkMany called from checkAsync
+        function in config file. Returns Deferred which fires with list
+        of results."""
+        self.cachePrefetch(checks, data)
+        dl = []
+        for check in checks:
+            name, args, keywords = self.__checkManyItem(check)
+            dl.append(self.checkAsync(name, data, *args, **keywords))
+        return defer.gatherResults(dl)
+
+
+    def checkAsync(self, name, data, *args, **keywords):
+        """Asynchronous version of check method called from checkAsync
+        function in config file. It must be called from reactor thread
+        and returns Deferred which fires with (code, codeEx) tuple.
+        Modules that implement native checkAsync don't occupy thread
+        from reactor thread pool (nor executor thread, executor only
+        limits number of their running calls), all other modules are
+        called in thread like with synchronous check."""
+        ctx = self.__checkBegin(name, data)
+        try:
+            cacheData = self.__checkCached(ctx, data, *args, **keywords)
+            if cacheData != None:
+                return defer.succeed(self.__checkEnd(ctx, data, cacheData, True))
 
+            flight = self.__flightBegin(ctx)
+        except Exception, e:
+            return defer.succeed(self.__checkError(ctx, data, e))
+
+        if flight == None:
+            return self.__checkAsyncRun(ctx, data, args, keywords)
+
+        # wait for the same check running in other request
+        d = defer.Deferred()
+        timeout = []
+        def flightDone(result):
+            if d.called:
+                return
+            for delayedCall in timeout:
+                if delayedCall.active():
+                    delayedCall.cancel()
+            d.callback(result)
+        if ctx['deadline'] != None:
+            timeout.append(reactor.callLater(max(0, ctx['deadline'] - time.time()), flightDone, None))
+        flight.addCallback(lambda f: reactor.callFromThread(flightDone, f.value))
+
+        def flightCallback(result):
+            if result != None:
+                ctx['coalesced'] = True
+                return self.__checkEnd(ctx, data, result, True, False)
+            return self.__checkAsyncRun(ctx, data, args, keywords)
+
+        d.addCallback(flightCallback)
+        return d
+
+
+    def __checkAsyncRun(self, ctx, data, args, keywords):
+        """Call module for checkAsync (result was not cached)."""
+        name = ctx['name']
+        try:
+            result = self.__checkDeadline(ctx, 'skipped')
+            if result != None:
+                return defer.succeed(self.__checkEnd(ctx, data, result, False, False))
+
+            result = self.__checkOverload(ctx)
+            if result != None:
+                return defer.succeed(self.__checkEnd(ctx, data, result, False, False))
+
+            if ctx['executor'] != None and ctx['obj'].hasCheckAsync():
+                # executor limits number of running native asynchronous
+                # checks, they don't need executor thread
+                d = ctx['executor'].callDeferred(ctx['obj'].checkAsync, data, *args, **keywords)
+            elif ctx['executor'] != None:
+                d = ctx['executor'].callAsync(deadline.callWithDeadline, ctx['deadline'], profiler.call, name, ctx['obj'].check, data, *args, **keywords)
+            else:
+                d = ctx['obj'].checkAsync(data, *args, **keywords)
+        except Exception, e:
+            return defer.succeed(self.__checkError(ctx, data, e))
 
-    def __cacheGet(self, key):
-        raise Exception("cache get function was not defined")
+        def checkAsyncCallback(result):
+            resultDeadline = self.__checkDeadline(ctx, 'finished')
+            if resultDeadline != None:
+                return self.__checkEnd(ctx, data, resultDeadline, False, False)
+            return self.__checkEnd(ctx, data, result, False)
 
+        def checkAsyncErrback(err):
+            if err.check(ExecutorOverflow):
+                return self.__checkEnd(ctx, data, err.value.result, False, False)
+            return self.__checkError(ctx, data, err.getErrorMessage(), err.getTraceback())
 
-    def __cacheSet(self, key, code, codeEx, cachePositive, cacheUnknown, cacheNegative):
-        raise Exception("cache set function was not defined")
+        d.addCallback(checkAsyncCallback)
+        d.addErrback(checkAsyncErrback)
+        return d
 
 
-    def __cacheGetLocal(self, key):
-        if key == 0: return None
-        retVal = None
-        self.cacheLock.acquire()
-        #logging.getLogger().debug("_cacheGet for %s" % key)
+    def __sessionMemoGet(self, instance, key):
+        """Get result remembered for SMTP session (postfix instance)."""
+        self.sessionMemoLock.acquire()
         try:
-            if self.cacheExpire.has_key(key) and self.cacheExpire[key] >= time.time():
-                retVal = self.cacheValue[key]
-        except Exception, e:
-            self.cacheLock.release()
-            raise e
-        self.cacheLock.release()
-        return retVal
+            session = self.sessionMemo.get(instance)
+            if session == None or session[0] < time.time():
+                return None
+            return session[1].get(key)
+        finally:
+            self.sessionMemoLock.release()
+
+
+    def __sessionMemoSet(self, instance, key, result):
+        """Remember result for SMTP session (postfix instance). Sessions
+        expire sessionMemoTTL seconds after first remembered result."""
+        now = time.time()
+        self.sessionMemoLock.acquire()
+        try:
+            if len(self.sessionMemo) >= self.sessionMemoSize or self.sessionMemoCleanup < now:
+                for k in [ k for k, v in self.sessionMemo.items() if v[0] < now ]:
+                    del(self.sessionMemo[k])
+                if len(self.sessionMemo) >= self.sessionMemoSize:
+                    # drop older half of sessions
+                    exp = [ v[0] for v in self.sessionMemo.values() ]
+                    exp.sort()
+                    expTr = exp[len(exp)/2]
+                    for k in [ k for k, v in self.sessionMemo.items() if v[0] <= expTr ]:
+                        del(self.sessionMemo[k])
+                self.sessionMemoCleanup = now + self.sessionMemoTTL
+            session = self.sessionMemo.get(instance)
+            if session == None or session[0] < now:
+                session = [ now + self.sessionMemoTTL, {} ]
+                self.sessionMemo[instance] = session
+            session[1][key] = result
+        finally:
+            self.sessionMemoLock.release()
+
+
+    def __cacheStore(self, name, key, obj, code, codeEx):
+        """Cache module result for time defined by its cachePositive,
+        cacheUnknown or cacheNegative parameter. Results of modules
+        with staleTTL are stored with time when they become stale and
+        they are kept in cache for additional staleTTL seconds. Returns
+        False if result should not be cached."""
+        if key == 0: return False
 
+        cacheTime = 0
+        if code > 0: cacheTime = obj.getParam('cachePositive')
+        elif code < 0: cacheTime = obj.getParam('cacheNegative')
+        else: cacheTime = obj.getParam('cacheUnknown')
 
-    def __cacheSetLocal(self, key, code, codeEx, cachePositive, cacheUnknown, cacheNegative):
-        if key == 0: return
+        if cacheTime <= 0: return False
 
-        cacheTime = 0
-        if code > 0: cacheTime = cachePositive
-        elif code < 0: cacheTime = cacheNegative
-        else: cacheTime = cacheUnknown
+        staleTTL = obj.getParam('staleTTL', 0)
+        if staleTTL > 0:
+            self.__cacheSet(name, key, (code, codeEx, time.time() + cacheTime), cacheTime + staleTTL)
+        else:
+            self.__cacheSet(name, key, (code, codeEx), cacheTime)
+        return True
 
-        if cacheTime <= 0: return
 
-        self.cacheLock.acquire()
-        #logging.getLogger().debug("_cacheSet for %s (%s, %s)" % (key, code, codeEx))
+    def __flightBegin(self, ctx):
+        """Return Future of the same check (module and cache key) that
+        is already running in other request or None when this request
+        has to call module (other requests will wait for its result)."""
+        key = ctx['hashArg']
+        obj = ctx['obj']
+        if key == 0 or not obj.getParam('coalesce', True):
+            return None
+        if max(obj.getParam('cachePositive'), obj.getParam('cacheUnknown'), obj.getParam('cacheNegative')) <= 0:
+            # module with side effects (e.g. DOS counters)
+            return None
+        self.flightsLock.acquire()
+        try:
+            flight = self.flights.get(key)
+            if flight != None:
+                return flight
+            ctx['flight'] = Future()
+            self.flights[key] = ctx['flight']
+        finally:
+            self.flightsLock.release()
+        return None
+
+
+    def __flightEnd(self, ctx, result):
+        """Pass result to requests waiting for this check (None means
+        that they have to call module themselves)."""
+        flight = ctx['flight']
+        if flight == None:
+            return
+        ctx['flight'] = None
+        self.flightsLock.acquire()
         try:
-            # full cache 3/4 cleanup?
-            if len(self.cacheExpire) > self.cacheSize:
-                logging.getLogger().debug("memory cache cleanup")
-                exp = self.cacheExpire.values()
-                exp.sort()
-                expTr = exp[3*len(exp)/4]
-                if expTr < time.time():
-                    expTr = time.time()
-                toDelArr = [ name for name, exp in self.cacheExpire.items() if exp < expTr ]
-                for toDel in toDelArr:
-                    del(self.cacheValue[toDel])
-                    del(self.cacheExpire[toDel])
-            self.cacheValue[key] = (code, codeEx)
-            self.cacheExpire[key] = time.time() + cacheTime
+            if self.flights.get(ctx['hashArg']) is flight:
+                del(self.flights[ctx['hashArg']])
+        finally:
+            self.flightsLock.release()
+        flight.set(result)
+
+
+    def __flightWait(self, ctx, flight):
+        """Wait for result of check running in other request (at most
+        until request deadline), returns None if it is not available."""
+        timeout = None
+        if ctx['deadline'] != None:
+            timeout = max(0, ctx['deadline'] - time.time())
+        try:
+            result = flight.result(timeout)
         except Exception, e:
-            self.cacheLock.release()
-            raise e
-        self.cacheLock.release()
+            return None
+        if result != None:
+            ctx['coalesced'] = True
+        return result
 
 
-    def __cacheGetMemcache(self, key):
-        if key == 0: return None
-        #logging.getLogger().debug("_cacheGet for %s" % key)
-        return self.cacheMemcache.get("ppolicy:%s" % key)
+    def __refresh(self, ctx, cacheData, data, args, keywords):
+        """Start background refresh of stale cached result (only one
+        for each cache key). Refresh is skipped when all refreshThreads
+        are busy, some of next requests will try it again."""
+        key = ctx['hashArg']
+        self.refreshLock.acquire()
+        try:
+            if self.refreshing.has_key(key):
+                return
+            self.refreshing[key] = True
+        finally:
+            self.refreshLock.release()
+
+        # refresh doesn't save results to request data and it is not
+        # limited by request deadline
+        refreshData = data.copy()
+        if refreshData.has_key(deadline.DATA_KEY):
+            del(refreshData[deadline.DATA_KEY])
+        future = self.refreshPool.trySubmit(self.__refreshRun, ctx['name'], ctx['obj'], ctx['executor'], key, cacheData, refreshData, args, keywords)
+        if future == None:
+            self.refreshLock.acquire()
+            try:
+                del(self.refreshing[key])
+            finally:
+                self.refreshLock.release()
+            metrics.inc('cache_refresh_total', (('module', ctx['name']), ('result', 'skipped')))
 
 
-    def __cacheSetMemcache(self, key, code, codeEx, cachePositive, cacheUnknown, cacheNegative):
-        if key == 0: return
+    def __refreshRun(self, name, obj, executor, key, cacheData, data, args, keywords):
+        """Call module check and replace stale result. When module
+        returns unknown result (e.g. DNS timeout) the stale result is
+        kept (at most until its staleTTL expire) and next refresh is
+        tried after cacheUnknown seconds."""
+        try:
+            try:
+                if executor != None:
+                    code, codeEx = executor.call(profiler.call, name, obj.check, data, *args, **keywords)
+                else:
+                    code, codeEx = profiler.call(name, obj.check, data, *args, **keywords)
+            except ExecutorOverflow, e:
+                code, codeEx = e.result
+            except Exception, e:
+                logging.getLogger().error("refresh %s failed: %s" % (name, e))
+                code, codeEx = 0, "%s failed with exception" % name
+
+            staleCode, staleCodeEx, fresh = cacheData
+            now = time.time()
+            keepTime = fresh + obj.getParam('staleTTL', 0) - now
+            if code == obj.CHECK_UNKNOWN and staleCode != obj.CHECK_UNKNOWN and keepTime > 0:
+                logging.getLogger().info("refresh %s returned %s (%s), keeping stale result" % (name, code, codeEx))
+                retry = min(max(obj.getParam('cacheUnknown'), 1), keepTime)
+                self.__cacheSet(name, key, (staleCode, staleCodeEx, now + retry), keepTime)
+                metrics.inc('cache_refresh_total', (('module', name), ('result', 'kept')))
+            else:
+                logging.getLogger().debug("refresh %s: %s (%s)" % (name, code, codeEx))
+                self.__cacheStore(name, key, obj, code, codeEx)
+                metrics.inc('cache_refresh_total', (('module', name), ('result', 'refreshed')))
+        finally:
+            self.refreshLock.acquire()
+            try:
+                del(self.refreshing[key])
+            finally:
+                self.refreshLock.release()
+
 
-        cacheTime = 0
-        if code > 0: cacheTime = cachePositive
-        elif code < 0: cacheTime = cacheNegative
-        else: cacheTime = cacheUnknown
+    def __cacheGet(self, name, key):
+        raise Exception("cache get function was not defined")
 
-        if cacheTime <= 0: return
 
-        #logging.getLogger().debug("_cacheSet for %s (%s, %s)" % (key, code, codeEx))
-        self.cacheMemcache.set("ppolicy:%s" % key, (code, codeEx), cacheTime)
+    def __cacheSet(self, name, key, value, ttl):
+        raise Exception("cache set function was not defined")
 
 
-    def __cacheGetMemcacheLocking(self, key):
+    def __cacheGetLocal(self, name, key):
+        if key == 0: return None
+        return self.cacheModules.get(name, self.cacheLocal).get(key)
+
+
+    def __cacheSetLocal(self, name, key, value, ttl):
+        self.cacheModules.get(name, self.cacheLocal).set(key, value, ttl)
+
+
+    def __cacheGetMemcache(self, name, key):
         if key == 0: return None
-        self.cacheLock.acquire()
         #logging.getLogger().debug("_cacheGet for %s" % key)
-        try:
-            retVal = self.cacheMemcache.get("ppolicy:%s" % key)
-        except Exception, e:
-            self.cacheLock.release()
-            raise e
-        self.cacheLock.release()
-        return retVal
+        return self.cacheMemcache.get("ppolicy:%s" % cachekey.encodeKey(key))
 
 
-    def __cacheSetMemcacheLocking(self, key, code, codeEx, cachePositive, cacheUnknown, cacheNegative):
-        if key == 0: return
+    def __cacheSetMemcache(self, name, key, value, ttl):
+        #logging.getLogger().debug("_cacheSet for %s (%s)" % (key, value))
+        self.cacheMemcache.set("ppolicy:%s" % cachekey.encodeKey(key), value, ttl)
 
-        cacheTime = 0
-        if code > 0: cacheTime = cachePositive
-        elif code < 0: cacheTime = cacheNegative
-        else: cacheTime = cacheUnknown
 
-        if cacheTime <= 0: return
+    def __cacheGetTiered(self, name, key):
+        if key == 0: return None
+        return self.cacheModules.get(name, self.cacheTiered).get(key)
 
-        self.cacheLock.acquire()
-        #logging.getLogger().debug("_cacheSet for %s (%s, %s)" % (key, code, codeEx))
-        try:
-            self.cacheMemcache.set("ppolicy:%s" % key, (code, codeEx), cacheTime)
-        except Exception, e:
-            self.cacheLock.release()
-            raise e
-        self.cacheLock.release()
+
+    def __cacheSetTiered(self, name, key, value, ttl):
+        self.cacheModules.get(name, self.cacheTiered).set(key, value, ttl)
+
+
+    def cachePrefetch(self, checks, data):
+        """Load cached results for checks (list of module names or
+        tuples like for checkMany) with one request to cache servers.
+        Called by checkMany or from config file with all modules that
+        will be probably used by request. Only tiered cache engine
+        supports it, for other engines it does nothing. Keys of modules
+        in one cache partition are loaded together."""
+        if self.cacheTiered == None:
+            return
+        keys = {}
+        for check in checks:
+            name, args, keywords = self.__checkManyItem(check)
+            modVal = self.modules.get(name)
+            if modVal == None or not modVal[1]:
+                continue
+            try:
+                hashArg = modVal[0].hashArg(data, *args, **keywords)
+                if hashArg != 0:
+                    cache = self.cacheModules.get(name, self.cacheTiered)
+                    keys.setdefault(cache, []).append(cachekey.makeKey(self.moduleKeys[name], hashArg))
+            except Exception, e:
+                logging.getLogger().debug("cache key for %s failed: %s" % (name, e))
+        for cache, cacheKeys in keys.items():
+            if len(cacheKeys) > 1:
+                cache.getMulti(cacheKeys)
+
+
+    def __cacheGetShm(self, name, key):
+        if key == 0: return None
+        return self.cacheShm.get(key)
+
+
+    def __cacheSetShm(self, name, key, value, ttl):
+        self.cacheShm.set(key, value, ttl)
 
 
     def startFactory(self):
@@ -462,6 +1521,8 @@ class PPolicyFactory(protocol.ServerFactory):
         """Called once."""
         logging.getLogger().info("Stopping factory %s" % self)
         self.__stopChecks()
+        self.__stopRuntime()
+        self.__stopCache()
         if self.dbPool != None and self.dbPool.running == 1:
             self.dbPool.close()
         if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
@@ -473,17 +1534,32 @@ class PPolicyFactory(protocol.ServerFactory):
 
 class PPolicyRequest(protocol.Protocol):
 
+    # maximum size of incomplete request kept in input buffer
+    MAX_REQUEST_SIZE = 64*1024
+
 
     def __init__(self):
         logging.getLogger().debug("PPolicyRequest.__init__()")
         self.factory = None
         # self.factory = factory - this is set in protocol.Factory by buildProtocol
         self.check = None
+        self.checkAsync = None
+        self.requestTimeout = None
         self.connOpen = False
         self.connLimit = 100
+        self.connRequestLimit = 100
         self.returnOnFatalError = ('dunno', None)
         self.returnOnConnLimit = ('dunno', None)
+        self.returnOnOverload = ('dunno', None)
+        self.requestLimit = None
+        self.requestQueueWait = None
+        self.dnsPrefetch = None
+        self.dnsPrefetchInstance = None
+        self.configVersion = -1
         self.numProtocolsId = -1
+        self.buffer = ''
+        self.requests = []
+        self.requestRunning = False
 
 
     def __del__(self):
@@ -494,13 +1570,9 @@ class PPolicyRequest(protocol.Protocol):
         self.factory.numProtocols += 1
         self.factory.numProtocolsId += 1
         self.numProtocolsId = self.factory.numProtocolsId
-        logging.getLogger().debug("connection id %s" % self.numProtocolsId)
+        logging.getLogger().debug("connection id %s", self.numProtocolsId)
         self.connOpen = True
-
-        self.check = self.factory.getConfig('check')
-        self.connLimit = self.factory.getConfig('connLimit', 100)
-        self.returnOnFatalError = self.factory.getConfig('returnOnFatalError', ('dunno', None))
-        self.returnOnConnLimit = self.factory.getConfig('returnOnConnLimit', ('dunno', None))
+        self.__loadConfig()
 
         if self.factory.numProtocols > self.connLimit:
             logging.getLogger().error("connection limit (%s) reached, returning dunno" % self.connLimit)
@@ -509,43 +1581,151 @@ class PPolicyRequest(protocol.Protocol):
             self.transport.loseConnection()
 
 
+    def __loadConfig(self):
+        """Read options used by this connection (again after factory
+        configuration was reloaded)."""
+        self.configVersion = self.factory.configVersion
+        self.check = self.factory.getConfig('check')
+        self.checkAsync = self.factory.getConfig('checkAsync')
+        self.requestTimeout = self.factory.getConfig('requestTimeout')
+        self.connLimit = self.factory.getConfig('connLimit', 100)
+        self.connRequestLimit = self.factory.getConfig('connRequestLimit', 100)
+        self.returnOnFatalError = self.factory.getConfig('returnOnFatalError', ('dunno', None))
+        self.returnOnConnLimit = self.factory.getConfig('returnOnConnLimit', ('dunno', None))
+        self.returnOnOverload = self.factory.getConfig('returnOnOverload', ('dunno', None))
+        self.requestLimit = self.factory.getConfig('requestLimit')
+        self.requestQueueWait = self.factory.getConfig('requestQueueWait')
+        self.dnsPrefetch = self.factory.getConfig('dnsPrefetch')
+
+
     def connectionLost(self, reason):
-        logging.getLogger().debug("connection id %s lost: %s" % (self.numProtocolsId, reason))
+        logging.getLogger().debug("connection id %s lost: %s", self.numProtocolsId, reason)
         self.connOpen = False
         self.factory.numProtocols -= 1
+        self.buffer = ''
+        self.requests = []
 
 
     def dataReceived(self, data):
+        """Split incomming stream to requests terminated by empty line
+        and queue them for processing. Requests from one connection
+        are processed one after another and responses are sent back
+        in the same order."""
+        if data.find('\r') != -1:
+            data = data.replace('\r', '')
+        self.buffer += data
+
+        start = 0
+        while True:
+            end = self.buffer.find('\n\n', start)
+            if end == -1:
+                break
+            if end > start:
+                self.requests.append(self.buffer[start:end+1])
+            start = end + 2
+        if start > 0:
+            self.buffer = self.buffer[start:]
+
+        if len(self.buffer) > self.MAX_REQUEST_SIZE:
+            logging.getLogger().error("policy protocol error: request from connection id %s exceeded %i bytes" % (self.numProtocolsId, self.MAX_REQUEST_SIZE))
+            self.buffer = ''
+            self.requests = []
+            self.dataResponse(self.returnOnFatalError[0], self.returnOnFatalError[1])
+            self.transport.loseConnection()
+            return
+
+        if self.connRequestLimit != None and len(self.requests) > self.connRequestLimit:
+            # postfix waits for response before it sends next request,
+            # client that floods connection with requests is dropped
+            logging.getLogger().error("policy protocol error: connection id %s exceeded %i queued requests" % (self.numProtocolsId, self.connRequestLimit))
+            self.buffer = ''
+            self.requests = []
+            self.transport.loseConnection()
+            return
+
+        self.__processRequest()
+
+
+    def __processRequest(self):
         """Parse data, call check method from config file and return results."""
+        if self.requestRunning or len(self.requests) == 0 or not self.connOpen:
+            return
+        if self.factory.isReloading():
+            # don't start new request until configuration is reloaded
+            self.factory.waitReload(self.__processRequest)
+            return
+        if self.configVersion != self.factory.configVersion:
+            self.__loadConfig()
+
+        self.requestRunning = True
+        data = self.requests.pop(0)
         startTime = time.time()
         reqid = "unknown%i" % startTime
 
-        def checkDeferred(data, _host):
+        if self.requestLimit != None and self.factory.requestsInFlight >= self.requestLimit:
+            # too many requests waiting for free thread or in progress
+            self.factory.requestsRejected += 1
+            metrics.inc('requests_rejected_total')
+            logging.getLogger().warn("request limit (%s) reached for connection id %s" % (self.requestLimit, self.numProtocolsId))
+            self.dataResponse(self.returnOnOverload[0], self.returnOnOverload[1])
+            self.requestRunning = False
+            reactor.callLater(0, self.__processRequest)
+            return
+
+        def checkStart(data):
             parsedData = self.__parseData(data)
             if parsedData != None:
                 if not parsedData.has_key('resource_start_time'):
                     parsedData['resource_start_time'] = startTime
+                if self.requestTimeout != None:
+                    parsedData[deadline.DATA_KEY] = startTime + self.requestTimeout
+                if self.dnsPrefetch != None:
+                    self.__prefetch(parsedData)
                 reqid = parsedData.get('instance', "unknown%i" % startTime)
-                logging.getLogger().info("%s start[%i]" % (reqid, startTime))
+                logging.getLogger().info("%s start[%i]", reqid, startTime)
                 if logging.getLogger().getEffectiveLevel() < logging.DEBUG:
                     rusage = list(resource.getrusage(resource.RUSAGE_SELF))
                     rusageStr = "[ %.3f, %.3f, %s ]" % (rusage[0], rusage[1], str(rusage[2:])[1:-1])
-                    logging.getLogger().debug("%s gc(%s, %s), rs%s" % (reqid, len(gc.get_objects()), len(gc.garbage), rusageStr))
+                    logging.getLogger().debug("%s gc(%s, %s), rs%s", reqid, len(gc.get_objects()), len(gc.garbage), rusageStr)
+            return parsedData
+
+        def checkFinish(result, parsedData):
+            action, actionEx = result
+            reqid = parsedData.get('instance', "unknown%i" % startTime)
+            runTime = int((time.time() - startTime) * 1000)
+            logging.getLogger().info("%s finish[%i]: %s (%s)", reqid, runTime, action, actionEx)
+            metrics.observe('request_duration_seconds', time.time() - startTime)
+            if logging.getLogger().getEffectiveLevel() < logging.DEBUG:
+                rusage = list(resource.getrusage(resource.RUSAGE_SELF))
+                rusageStr = "[ %.3f, %.3f, %s ]" % (rusage[0], rusage[1], str(rusage[2:])[1:-1])
+                logging.getLogger().debug("%s gc(%s, %s), rs%s", reqid, len(gc.get_objects()), len(gc.garbage), rusageStr)
+            return action, actionEx
 
-                action, actionEx = self.check(self.factory, parsedData, _host)
-
-                runTime = int((time.time() - startTime) * 1000)
-                logging.getLogger().info("%s finish[%i]: %s (%s)" % (reqid, runTime, action, actionEx))
-                if logging.getLogger().getEffectiveLevel() < logging.DEBUG:
-                    rusage = list(resource.getrusage(resource.RUSAGE_SELF))
-                    rusageStr = "[ %.3f, %.3f, %s ]" % (rusage[0], rusage[1], str(rusage[2:])[1:-1])
-                    logging.getLogger().debug("%s gc(%s, %s), rs%s" % (reqid, len(gc.get_objects()), len(gc.garbage), rusageStr))
-
-                return action, actionEx
+        def checkDeferred(data, _host):
+            queueWait = time.time() - startTime
+            metrics.observe('request_queue_wait_seconds', queueWait)
+            if self.requestQueueWait != None and queueWait > self.requestQueueWait:
+                # request waited too long for free thread
+                self.factory.requestsExpired += 1
+                metrics.inc('requests_expired_total')
+                logging.getLogger().warn("request from connection id %s waited %.3fs for free thread" % (self.numProtocolsId, queueWait))
+                return self.returnOnOverload
+            parsedData = checkStart(data)
+            if parsedData != None:
+                return checkFinish(self.check(self.factory, parsedData, _host), parsedData)
             else:
                 # default return action for garbage?
                 return None, None
 
+        def checkDeferredAsync(data, _host):
+            parsedData = checkStart(data)
+            if parsedData != None:
+                d = defer.maybeDeferred(self.checkAsync, self.factory, parsedData, _host)
+                d.addCallback(checkFinish, parsedData)
+                return d
+            else:
+                return None, None
+
         def checkDeferredCallback(data):
             self.dataResponse(data[0], data[1])
 
@@ -554,55 +1734,102 @@ class PPolicyRequest(protocol.Protocol):
             logging.getLogger().error(str(err.getTraceback()))
             self.dataResponse(self.returnOnFatalError[0], self.returnOnFatalError[1])
 
-        # handle data in new thread and return results using deferred
-        d = threads.deferToThread(checkDeferred, data, self.transport.getHost())
+        def checkDeferredNext(_):
+            self.factory.requestsInFlight -= 1
+            self.requestRunning = False
+            self.__processRequest()
+
+        self.factory.requestsInFlight += 1
+
+        if self.checkAsync != None:
+            # config provides asynchronous check function, it is called
+            # directly in reactor thread and returns deferred
+            d = defer.maybeDeferred(checkDeferredAsync, data, self.transport.getHost())
+        else:
+            # handle data in new thread and return results using deferred
+            d = threads.deferToThread(checkDeferred, data, self.transport.getHost())
         d.addCallback(checkDeferredCallback)
         d.addErrback(checkDeferredErrback)
+        d.addBoth(checkDeferredNext)
+
+
+    def __prefetch(self, data):
+        """Start resolving DNS records that will be probably required
+        by check modules (PTR for client address, mailhosts and SPF
+        for sender domain, configured DNSBL) in background threads."""
+        prefetch = self.factory.dnsPrefetch
+        if prefetch == None:
+            return
+        instance = data.get('instance')
+        if instance != None and instance == self.dnsPrefetchInstance:
+            # next request from the same SMTP transaction
+            return
+        self.dnsPrefetchInstance = instance
+
+        try:
+            client_address = data.get('client_address')
+            domain = None
+            sender = data.get('sender', '')
+            if sender.find('@') != -1:
+                domain = sender[sender.rfind('@')+1:].lower()
+            if client_address and self.dnsPrefetch.get('ptr', True):
+                prefetch.submit(client_address, 'PTR')
+            if domain and self.dnsPrefetch.get('mx', True):
+                prefetch.submit(domain, 'MX')
+            if domain and self.dnsPrefetch.get('spf', True):
+                prefetch.submit(domain, 'TXT')
+            checkList = self.dnsPrefetch.get('dnsbl', [])
+            if len(checkList) > 0:
+                from tools import dnsbl
+                for name in dnsbl.queries(client_address or None, domain, checkList):
+                    prefetch.submit(name, 'A')
+        except Exception, e:
+            logging.getLogger().warn("DNS prefetch failed: %s" % e)
 
 
     def __parseData(self, data):
-        """Parse incomming data."""
+        """Parse one request (lines up to the terminating empty line)."""
         retData = {}
-        for line in string.split(data, '\n'):
-            line = line.strip()
+        for line in data.split('\n'):
             if line == '':
-                if retData.has_key("request"):
-                    return retData
-                else:
-                    logging.getLogger().error("policy protocol error: request wasn't specified before empty line")
-                    return None
-            try:
-                k, v = line.split('=', 1)
-                #if k == 'instance' and self.cluster == True:
-                #    self.clusterip = self.transport.getPeer().host
-                #    v = '%s_%s' % (self.clusterip, v)
-                if k == 'client_name' and v == 'unknown':
-                    v = ''
-                retData[k] = v
-                logging.getLogger().debug("input: %s=%s" % (k, v))
-            except ValueError:
+                continue
+            pos = line.find('=')
+            if pos == -1:
                 logging.getLogger().warn("garbage in input: %s" % line)
-        logging.getLogger().warn("input was not ended by empty line")
+                continue
+            k = line[:pos].strip()
+            v = line[pos+1:].strip()
+            #if k == 'instance' and self.cluster == True:
+            #    self.clusterip = self.transport.getPeer().host
+            #    v = '%s_%s' % (self.clusterip, v)
+            if k == 'client_name' and v == 'unknown':
+                v = ''
+            retData[k] = v
+
+        if logging.getLogger().getEffectiveLevel() <= logging.DEBUG:
+            logging.getLogger().debug("input: %s", retData)
+
         if retData.has_key("request"):
             return retData
         else:
+            logging.getLogger().error("policy protocol error: request wasn't specified before empty line")
             return None
 
 
     def dataResponse(self, action=None, actionEx=None):
         """Check response"""
         if not self.connOpen:
-            logging.getLogger().info("connection id %s lost before sending results" % self.numProtocolsId)
+            logging.getLogger().info("connection id %s lost before sending results", self.numProtocolsId)
             return
         if action == None:
             logging.getLogger().debug("output: action=dunno")
-            self.transport.writeSomeData("action=dunno\n\n")
+            self.transport.write("action=dunno\n\n")
         elif actionEx == None:
-            logging.getLogger().debug("output: action=%s" % action)
-            self.transport.writeSomeData("action=%s\n\n" % action)
+            logging.getLogger().debug("output: action=%s", action)
+            self.transport.write("action=%s\n\n" % action)
         else:
-            logging.getLogger().debug("output: action=%s %s" % (action, actionEx))
-            self.transport.writeSomeData("action=%s %s\n\n" % (action, actionEx))
+            logging.getLogger().debug("output: action=%s %s", action, actionEx)
+            self.transport.write("action=%s %s\n\n" % (action, actionEx))
 
 
 
@@ -34,6 +34,9 @@ class FakeFactory:
     def releaseDbConnection(self, conn):
         conn.close()
 
+    def closeDbConnection(self, conn):
+        conn.close()
+
 
 modules = {}
 
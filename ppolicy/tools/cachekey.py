@@ -0,0 +1,111 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Stable compact keys for result cache
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import re
+import types
+import base64
+import logging
+try:
+    from hashlib import blake2b
+    def digest(value):
+        return blake2b(value, digest_size=16).digest()
+except ImportError:
+    try:
+        from hashlib import sha256
+        def digest(value):
+            return sha256(value).digest()[:16]
+    except ImportError:
+        from md5 import md5
+        def digest(value):
+            return md5(value).digest()
+
+
+__version__ = "$Revision$"
+
+
+# change when encoding of keys changes (results cached in memcache
+# by ppolicy with different key format are not used)
+KEY_VERSION = 2
+
+_patternType = type(re.compile(''))
+
+
+def canonical(value, fallback = False):
+    """Encode value (None, bool, number, string, list, tuple, set or
+    dict of these types, compiled regular expression, function or class)
+    to string that is same in all processes and python versions. Each
+    item is prefixed by its type and strings by their length, so
+    different values can't produce same string. Other types raise
+    TypeError, because their string form (e.g. with memory address)
+    is not same in all processes (with fallback their repr() is used)."""
+    t = type(value)
+    if t == str:
+        return "s%i:%s" % (len(value), value)
+    elif t == unicode:
+        value = value.encode('utf-8')
+        return "u%i:%s" % (len(value), value)
+    elif value == None:
+        return "N"
+    elif t == bool:
+        return value and "T" or "F"
+    elif t in [ int, long ]:
+        return "i%i;" % value
+    elif t == float:
+        return "f%r;" % value
+    elif t in [ list, tuple ]:
+        return "l%i:%s" % (len(value), "".join([ canonical(x, fallback) for x in value ]))
+    elif t == dict:
+        items = [ (canonical(k, fallback), canonical(v, fallback)) for k, v in value.items() ]
+        items.sort()
+        return "d%i:%s" % (len(items), "".join([ k + v for k, v in items ]))
+    elif t in [ set, frozenset ]:
+        items = [ canonical(x, fallback) for x in value ]
+        items.sort()
+        return "e%i:%s" % (len(items), "".join(items))
+    elif t == _patternType:
+        return "r%s" % canonical((value.pattern, value.flags))
+    elif t == types.MethodType:
+        return "m%s" % canonical((value.im_func, value.im_self), fallback)
+    elif t == types.FunctionType:
+        # code distinguish lambdas defined in one module
+        return "c%s" % canonical((value.__module__, value.__name__, value.func_code.co_code))
+    elif t in [ types.BuiltinFunctionType, types.ClassType, type ]:
+        return "c%s" % canonical((value.__module__, value.__name__))
+    elif fallback:
+        return "o%s" % canonical(repr(value))
+    else:
+        raise TypeError("unsupported type %s in cache key" % t.__name__)
+
+
+def modulePrefix(name, definition):
+    """Return key prefix for module name and its definition (type and
+    parameters from config file), so modules with same name but
+    different configuration (on other nodes or after reload) don't
+    share cached results. Parameters of unsupported type are encoded
+    by repr(), their results can't be shared with other processes
+    when it contains e.g. memory address."""
+    try:
+        return canonical((KEY_VERSION, name, definition))
+    except TypeError, e:
+        logging.getLogger().warn("module %s: %s, using repr() (results may not be shared by worker processes)" % (name, e))
+        return canonical((KEY_VERSION, name, definition), True)
+
+
+def makeKey(prefix, fields):
+    """Return 16 byte binary key for module prefix and canonical
+    tuple of fields returned by module hashArg."""
+    return digest(prefix + canonical(fields))
+
+
+def encodeKey(key):
+    """Return printable form of binary key (e.g. for memcache
+    that doesn't accept control characters and spaces in keys)."""
+    return base64.b64encode(key)[:22]
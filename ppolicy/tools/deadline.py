@@ -0,0 +1,72 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Request processing deadline shared by modules and tools
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import time
+import threading
+
+
+# key in request data with absolute time of request deadline
+DATA_KEY = 'resource_deadline'
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """Raised by helpers that refuse to start work after deadline."""
+    def __init__(self, args = "request deadline exceeded"):
+        Exception.__init__(self, args)
+
+
+def getDeadline():
+    """Return deadline (absolute time) for request processed
+    by current thread or None if there is no deadline."""
+    return getattr(_local, 'deadline', None)
+
+
+def setDeadline(deadline):
+    _local.deadline = deadline
+
+
+def remaining():
+    """Return seconds remaining to deadline or None."""
+    deadline = getattr(_local, 'deadline', None)
+    if deadline == None:
+        return None
+    return deadline - time.time()
+
+
+def expired():
+    deadline = getattr(_local, 'deadline', None)
+    return deadline != None and time.time() >= deadline
+
+
+def timeout(value = None):
+    """Shorten timeout value to fit in remaining time. Value None
+    or <= 0 means no timeout and remaining time is returned instead
+    (or unchanged value if there is no deadline)."""
+    left = remaining()
+    if left == None:
+        return value
+    if left < 0:
+        left = 0
+    if value == None or value <= 0 or left < value:
+        return left
+    return value
+
+
+def callWithDeadline(deadline, f, *args, **keywords):
+    """Call f with deadline set for current thread."""
+    orig = getattr(_local, 'deadline', None)
+    _local.deadline = deadline
+    try:
+        return f(*args, **keywords)
+    finally:
+        _local.deadline = orig
@@ -0,0 +1,223 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Asynchronous DNS queries used by native checkAsync of modules
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import time
+import socket
+import logging
+from twisted.internet import defer
+from twisted.names import client, dns, error
+import netaddr
+import dnscache
+import metrics
+
+
+__version__ = "$Revision$"
+
+
+_resolver = None
+
+
+class DNSTimeoutError(dnscache.DNSCacheError):
+    """DNS query timeout that was not caused by request deadline."""
+    def __init__(self, args = ""):
+        dnscache.DNSCacheError.__init__(self, args)
+
+
+def getResolver():
+    """Return twisted.names resolver shared by all queries
+    (configured from /etc/resolv.conf)."""
+    global _resolver
+    if _resolver == None:
+        _resolver = client.createResolver()
+    return _resolver
+
+
+def getTimeout(deadlineTime = None):
+    """Return tuple of retry timeouts with the same values that use
+    dnscache resolver (timeout doubled for each retry) and flag
+    if they were shortened to fit before request deadline."""
+    timeouts = []
+    timeout = dnscache._dnsTimeout
+    left = None
+    if deadlineTime != None:
+        left = deadlineTime - time.time()
+    for i in range(dnscache._dnsMaxRetry):
+        if left != None and left < timeout:
+            if left > 0:
+                timeouts.append(left)
+            return tuple(timeouts), True
+        timeouts.append(timeout)
+        if left != None:
+            left -= timeout
+        timeout *= 2
+    return tuple(timeouts), False
+
+
+_QUERY = { 'A': ('lookupAddress', dns.A),
+           'AAAA': ('lookupIPV6Address', dns.AAAA),
+           'PTR': ('lookupPointer', dns.PTR),
+           'MX': ('lookupMailExchange', dns.MX),
+           }
+
+
+def query(name, qtype, deadlineTime = None):
+    """Resolve DNS records of qtype (A, AAAA, PTR, MX). Returned
+    Deferred fires with list of record payloads ([] when there is
+    no such record or DNS problem) or None if the name doesn't exist.
+    It fails with DNSTimeoutError on timeout and with DNSCacheError
+    when timeout was caused by request deadline."""
+    timeouts, shortened = getTimeout(deadlineTime)
+    if len(timeouts) == 0:
+        return defer.fail(dnscache.DNSCacheError("request deadline exceeded"))
+
+    metrics.inc('dns_queries_total')
+    method, rrtype = _QUERY[qtype]
+    try:
+        d = getattr(getResolver(), method)(name, timeout=timeouts)
+    except Exception, e:
+        return defer.fail(e)
+
+    def queryCallback(result):
+        answers, authority, additional = result
+        return [ rr.payload for rr in answers if rr.type == rrtype ]
+
+    def queryErrback(err):
+        if err.check(error.DNSNameError):
+            return None
+        if err.check(defer.TimeoutError):
+            logging.getLogger().debug("DNS timeout (%s), query: %s [%s]" % (timeouts, name, qtype))
+            if shortened:
+                raise dnscache.DNSCacheError("request deadline exceeded, query: %s [%s]" % (name, qtype))
+            raise DNSTimeoutError("DNS timeout, query: %s [%s]" % (name, qtype))
+        # no results or DNS problem
+        logging.getLogger().debug("DNS error, query: %s [%s]: %s" % (name, qtype, err.getErrorMessage()))
+        return []
+
+    d.addCallbacks(queryCallback, queryErrback)
+    return d
+
+
+def getIpForName(domain, ipv6 = True, deadlineTime = None):
+    """Asynchronous version of dnscache.getIpForName."""
+
+    # don't process DNS query for servers that timeouts
+    if dnscache.dnsTimeoutBlacklistHas((domain.lower(), 'A')):
+        return defer.fail(dnscache.DNSCacheError("DNS error getting IP for domain name (cached): %s" % domain))
+
+    if ipv6:
+        types = [ 'A', 'AAAA' ]
+    else:
+        types = [ 'A' ]
+
+    def getIpCallback(results):
+        ips = []
+        failures = []
+        for success, payloads in results:
+            if not success:
+                failures.append(payloads)
+                continue
+            for payload in payloads or []:
+                if payload.TYPE == dns.AAAA:
+                    ips.append(socket.inet_ntop(socket.AF_INET6, payload.address))
+                else:
+                    ips.append(payload.dottedQuad())
+        if len(failures) > 0 and len(ips) == 0:
+            for failure in failures:
+                if failure.check(DNSTimeoutError):
+                    dnscache.dnsTimeoutBlacklistAdd((domain.lower(), 'A'), dnscache._dnsTimeoutBlacklistInterval)
+                    break
+            raise dnscache.DNSCacheError("DNS error getting IP for domain name: %s" % domain)
+        return ips
+
+    dl = [ query(domain, qtype, deadlineTime) for qtype in types ]
+    d = defer.DeferredList(dl, consumeErrors=True)
+    d.addCallback(getIpCallback)
+    return d
+
+
+def getNameForIp(ip, deadlineTime = None):
+    """Asynchronous version of dnscache.getNameForIp."""
+
+    # don't process DNS query for servers that timeouts
+    if dnscache.dnsTimeoutBlacklistHas((ip.lower(), 'PTR')):
+        return defer.fail(dnscache.DNSCacheError("DNS error getting domain name for IP (cached): %s" % ip))
+
+    try:
+        ipaddr = netaddr.IPAddress(ip).reverse_dns.rstrip('.')
+    except Exception, e:
+        return defer.fail(dnscache.DNSCacheError("invalid IP address %s: %s" % (ip, e)))
+
+    def getNameCallback(payloads):
+        return [ str(payload.name) for payload in payloads or [] ]
+
+    def getNameErrback(err):
+        err.trap(dnscache.DNSCacheError)
+        if err.check(DNSTimeoutError):
+            dnscache.dnsTimeoutBlacklistAdd((ip.lower(), 'PTR'), dnscache._dnsTimeoutBlacklistInterval)
+        raise dnscache.DNSCacheError("DNS error getting domain name for IP: %s" % ip)
+
+    d = query(ipaddr, 'PTR', deadlineTime)
+    d.addCallbacks(getNameCallback, getNameErrback)
+    return d
+
+
+def getDomainMailhosts(domain, ipv6 = True, local = True, deadlineTime = None):
+    """Asynchronous version of dnscache.getDomainMailhosts."""
+
+    # don't process DNS query for servers that timeouts
+    if dnscache.dnsTimeoutBlacklistHas((domain.lower(), 'MX')):
+        return defer.fail(dnscache.DNSCacheError("DNS error getting mailhost for domain name (cached): %s" % domain))
+
+    def mailhostsCallback(results):
+        ips = []
+        for success, hostIps in results:
+            # ignore mailhosts that can't be resolved
+            if success:
+                ips.extend(hostIps)
+        return ips
+
+    def mxCallback(payloads):
+        if payloads == None:
+            return []
+        if len(payloads) == 0:
+            # search for MX failed, try A (AAAA) record
+            return getIpForName(domain, ipv6, deadlineTime)
+        fqdnPref = {}
+        for payload in payloads:
+            if not fqdnPref.has_key(payload.preference):
+                fqdnPref[payload.preference] = []
+            fqdnPref[payload.preference].append(str(payload.name))
+        fqdnPrefKeys = fqdnPref.keys()
+        fqdnPrefKeys.sort()
+        dl = []
+        for key in fqdnPrefKeys:
+            for mailhost in fqdnPref[key]:
+                dl.append(getIpForName(mailhost, ipv6, deadlineTime))
+        d = defer.DeferredList(dl, consumeErrors=True)
+        d.addCallback(mailhostsCallback)
+        return d
+
+    def mxErrback(err):
+        err.trap(dnscache.DNSCacheError)
+        if err.check(DNSTimeoutError):
+            dnscache.dnsTimeoutBlacklistAdd((domain.lower(), 'MX'), dnscache._dnsTimeoutBlacklistInterval)
+        raise dnscache.DNSCacheError("DNS error getting mailhost for domain name: %s" % domain)
+
+    def localCallback(ips):
+        # remove invalid IP from the list of mailhost
+        if not local:
+            ips = dnscache.publicIps(ips)
+        return ips
+
+    d = query(domain, 'MX', deadlineTime)
+    d.addCallbacks(mxCallback, mxErrback)
+    d.addCallback(localCallback)
+    return d
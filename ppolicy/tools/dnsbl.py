@@ -20,7 +20,9 @@ useAdns = False
 #    logging.getLogger().info("using adns library")
 #except:
 import dnscache
+import dnsasync
 import dns.exception
+from twisted.internet import defer
 logging.getLogger().info("using dnspython library")
 
 
@@ -125,17 +127,61 @@ class dnsbl:
         """
         logging.getLogger().debug("score(%s, %s, %s)" % (ip, domain, len(checkList)))
 
-        if ip != None:
-            # XXX: IPv6
-            if self.reIPv4.match(ip) == None:
-                logging.getLogger().info("%s doesn't looks like valid IPv4 address" % ip)
-                ipr = None
-            else:
-                ipr = ip.split('.')
-                ipr.reverse()
-                ipr = '.'.join(ipr)
+        check_items, check_items_bl = self.__checkItems(ip, domain, checkList, scoreOnly)
+        if len(check_items) == 0:
+            return (0, 0)
+
+        if useAdns:
+            check_items_bl_res = self.__adnsCheck(check_items_bl)
         else:
-            ipr = None
+            check_items_bl_res = self.__dnspythonCheck(check_items_bl)
+
+        return self.__checkResult(check_items, check_items_bl_res)
+
+
+    def checkAsync(self, ip = None, domain = None, checkList = [], scoreOnly = False, deadlineTime = None):
+        """Asynchronous version of check method that use twisted.names
+        resolver. It returns Deferred that fires with the same tuple as
+        check method. Optional deadlineTime (absolute time) limits
+        time spent waiting for DNS answers."""
+        logging.getLogger().debug("scoreAsync(%s, %s, %s)" % (ip, domain, len(checkList)))
+
+        check_items, check_items_bl = self.__checkItems(ip, domain, checkList, scoreOnly)
+        if len(check_items) == 0:
+            return defer.succeed((0, 0))
+
+        names = []
+        dl = []
+        for bl in check_items_bl:
+            # don't process DNS query for servers that timeouts
+            if dnscache.dnsTimeoutBlacklistHas((bl.lower(), 'A')):
+                continue
+            names.append(bl)
+            dl.append(dnsasync.query(bl, 'A', deadlineTime))
+
+        def checkAsyncCallback(results):
+            check_items_bl_res = {}
+            for i in range(len(names)):
+                bl = names[i]
+                success, payloads = results[i]
+                if not success:
+                    if payloads.check(dnsasync.DNSTimeoutError):
+                        dnscache.dnsTimeoutBlacklistAdd((bl.lower(), 'A'), 24*60*60)
+                    continue
+                ips = [ x.dottedQuad() for x in payloads or [] ]
+                if len(ips) > 0:
+                    check_items_bl_res[bl] = ips
+            return self.__checkResult(check_items, check_items_bl_res)
+
+        d = defer.DeferredList(dl, consumeErrors=True)
+        d.addCallback(checkAsyncCallback)
+        return d
+
+
+    def __checkItems(self, ip, domain, checkList, scoreOnly):
+        """Return list of checks (bl, name, value, score) and list
+        of DNS names that has to be resolved for these checks."""
+        ipr = self.__reverseIp(ip)
 
         check_items = []
         check_items_bl = []
@@ -163,14 +209,11 @@ class dnsbl:
                 if check_name not in check_items_bl:
                     check_items_bl.append(check_name)
 
-        if len(check_items) == 0:
-            return (0, 0)
+        return check_items, check_items_bl
 
-        if useAdns:
-            check_items_bl_res = self.__adnsCheck(check_items_bl)
-        else:
-            check_items_bl_res = self.__dnspythonCheck(check_items_bl)
 
+    def __checkResult(self, check_items, check_items_bl_res):
+        """Return blacklist hits and score for resolved DNS names."""
         retHit = 0
         retScore = 0
 
@@ -196,6 +239,38 @@ class dnsbl:
             return (retHit, retScore)
 
 
+    def queries(self, ip = None, domain = None, checkList = []):
+        """Return list of DNS names (A records) that are resolved
+        when checking client ip and sender domain against blacklists
+        from checkList."""
+        ipr = self.__reverseIp(ip)
+        retVal = []
+        for check in checkList:
+            if not self.config.has_key(check):
+                continue
+            if not self.config[check]['envfrom']:
+                if ipr == None: continue
+                name = "%s.%s" % (ipr, self.config[check]['dnsbl'])
+            else:
+                if domain == None: continue
+                name = "%s.%s" % (domain, self.config[check]['dnsbl'])
+            if name not in retVal:
+                retVal.append(name)
+        return retVal
+
+
+    def __reverseIp(self, ip):
+        if ip == None:
+            return None
+        # XXX: IPv6
+        if self.reIPv4.match(ip) == None:
+            logging.getLogger().info("%s doesn't looks like valid IPv4 address" % ip)
+            return None
+        ipr = ip.split('.')
+        ipr.reverse()
+        return '.'.join(ipr)
+
+
     def __adnsCheck(self, check_items_bl):
         retVal = {}
 
@@ -270,6 +345,16 @@ def check(ip = None, domain = None, checkList = [], score = False):
     return getInstance().check(ip, domain, checkList, score)
 
 
+def checkAsync(ip = None, domain = None, checkList = [], score = False, deadlineTime = None):
+    """See documentation for dnsbl.checkAsync method."""
+    return getInstance().checkAsync(ip, domain, checkList, score, deadlineTime)
+
+
+def queries(ip = None, domain = None, checkList = []):
+    """See documentation for dnsbl.queries method."""
+    return getInstance().queries(ip, domain, checkList)
+
+
 
 
 def parseSpamassassinCf(dnsblFile, scoreFile):
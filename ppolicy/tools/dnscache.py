@@ -9,15 +9,20 @@
 #
 # $Id$
 #
+import copy
 import logging
 import time
 import random
 import struct
 import socket
 import threading
+import Queue
 import dns.resolver
 import dns.exception
 import netaddr
+import deadline
+import metrics
+import membudget
 
 
 class Cache(object):
@@ -111,6 +116,23 @@ class Cache(object):
         finally:
             self.lock.release()
 
+    def memoryUsage(self):
+        """Approximate memory used by cached answers."""
+        self.lock.acquire()
+        try:
+            return membudget.dictUsage(self.data)
+        finally:
+            self.lock.release()
+
+    def memoryLimit(self, limit):
+        """Remove answers with the nearest expiration to use at most
+        limit bytes."""
+        self.lock.acquire()
+        try:
+            membudget.dictLimit(self.data, membudget.dictUsage(self.data), limit, lambda k, v: v.expiration)
+        finally:
+            self.lock.release()
+
     def flush(self, key=None):
         """Flush the cache.
 
@@ -133,6 +155,51 @@ class Cache(object):
             self.lock.release()
 
 
+class SharedCache(object):
+    """DNS answer cache stored in shmcache.SharedCache, so it can be
+    shared by multiple ppolicy processes. Answers that can't be
+    serialized or doesn't fit in cache slot are not cached.
+    """
+
+    def __init__(self, fileName, max_size=10000, slot_size=1024):
+        import shmcache
+        self.cache = shmcache.SharedCache(fileName, max_size, slot_size)
+
+    def __key(self, key):
+        return "%s/%s/%s" % (str(key[0]).lower(), key[1], key[2])
+
+    def get(self, key):
+        try:
+            v = self.cache.get(self.__key(key))
+        except Exception, e:
+            logging.getLogger().debug("shared DNS cache get failed: %s" % e)
+            return None
+        if v is None or v.expiration <= time.time():
+            return None
+        return v
+
+    def put(self, key, value):
+        ttl = value.expiration - time.time()
+        if ttl <= 0:
+            return
+        try:
+            self.cache.set(self.__key(key), value, ttl)
+        except Exception, e:
+            logging.getLogger().debug("shared DNS cache put failed: %s" % e)
+
+    def flush(self, key=None):
+        if not key is None:
+            self.cache.delete(self.__key(key))
+        else:
+            self.cache.clear()
+
+    def memoryUsage(self):
+        return self.cache.memoryUsage()
+
+    def memoryLimit(self, limit):
+        pass
+
+
 # DNS query parameters
 _dnsResolvers = {}
 _dnsCache = Cache(30*60, 10000)
@@ -161,7 +228,11 @@ def dnsTimeoutBlacklistHas(key):
 
 def dnsTimeoutBlacklistAdd(key, interval):
     global _dnsTimeoutBlacklist
+    if deadline.expired():
+        # timeout was probably caused by shortened request deadline
+        return
     logging.getLogger().debug("blacklisting DNS for %s" % str(key))
+    metrics.inc('dns_blacklisted_total')
     _dnsTimeoutBlacklistLock.acquire()
     try:
         _dnsTimeoutBlacklist[key] = time.time() + interval
@@ -180,7 +251,21 @@ def dnsTimeoutBlacklistAdd(key, interval):
     _dnsTimeoutBlacklistLock.release()
 
 
+def getCache():
+    """Return DNS answer cache used by all resolvers."""
+    return _dnsCache
+
+
+def setCache(cache):
+    """Replace DNS answer cache used by all resolvers."""
+    global _dnsCache
+    _dnsCache = cache
+    for resolver in _dnsResolvers.values():
+        resolver.cache = cache
+
+
 def getResolver(lifetime, timeout):
+    metrics.inc('dns_queries_total')
     resolver = _dnsResolvers.get((lifetime, timeout))
     if resolver == None:
         resolver = dns.resolver.Resolver()
@@ -189,6 +274,15 @@ def getResolver(lifetime, timeout):
         resolver.timeout = timeout
         resolver.cache = _dnsCache
         _dnsResolvers[(lifetime, timeout)] = resolver
+
+    # don't wait for DNS answer after request deadline
+    left = deadline.remaining()
+    if left != None and left < lifetime:
+        if left <= 0:
+            raise DNSCacheError("request deadline exceeded")
+        resolver = copy.copy(resolver)
+        resolver.lifetime = left
+        resolver.timeout = min(timeout, left)
     return resolver
 
 
@@ -327,19 +421,120 @@ def getDomainMailhosts(domain, ipv6=True, local=True):
 
     # remove invalid IP from the list of mailhost
     if not local:
-        fips = []
-        for ip in ips:
-            nip = netaddr.IPAddress(ip)
-            if nip.is_multicast(): continue
-            if nip.is_private(): continue
-            if nip.is_reserved(): continue
-            if nip.is_loopback(): continue
-            fips.append(ip)
-        ips = fips
+        ips = publicIps(ips)
 
     return ips
 
 
+def publicIps(ips):
+    """Return IP addresses without multicast, private, reserved
+    and loopback addresses."""
+    fips = []
+    for ip in ips:
+        nip = netaddr.IPAddress(ip)
+        if nip.is_multicast(): continue
+        if nip.is_private(): continue
+        if nip.is_reserved(): continue
+        if nip.is_loopback(): continue
+        fips.append(ip)
+    return fips
+
+
+
+
+class Prefetch(object):
+    """Resolve DNS records in background threads, so answers are
+    already in DNS cache when check modules ask for them. Prefetch
+    never blocks caller - queries are dropped when all threads are
+    busy and the queue is full. Errors are ignored (module that needs
+    the record repeats the query and handles them).
+
+    Supported query types: PTR (name is IP address), MX (mailhosts
+    including their A records, see getDomainMailhosts) and any other
+    type resolved directly (e.g. A for DNSBL, TXT for SPF).
+    """
+
+    def __init__(self, threads = 10, maxQueue = 1000):
+        self.threads = threads
+        self.queue = Queue.Queue(maxQueue)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.workers = []
+        self.submitted = 0
+        self.dropped = 0
+        for i in range(0, threads):
+            worker = threading.Thread(target=self.__run, name="dnsprefetch-%i" % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+
+    def __query(self, name, qtype):
+        if qtype == 'PTR':
+            getNameForIp(name)
+        elif qtype == 'MX':
+            getDomainMailhosts(name)
+        elif not dnsTimeoutBlacklistHas((name.lower(), qtype)):
+            getResolver(_dnsLifetime, _dnsTimeout).query(name, qtype)
+
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                break
+            try:
+                try:
+                    self.__query(*item)
+                except Exception, e:
+                    logging.getLogger().debug("DNS prefetch %s [%s] failed: %s", item[0], item[1], e)
+            finally:
+                self.lock.acquire()
+                try:
+                    del(self.pending[item])
+                finally:
+                    self.lock.release()
+
+
+    def submit(self, name, qtype):
+        """Queue DNS query (same query is not queued twice)."""
+        item = (name.lower(), qtype)
+        self.lock.acquire()
+        try:
+            if self.pending.has_key(item):
+                return
+            self.pending[item] = True
+        finally:
+            self.lock.release()
+        try:
+            self.queue.put_nowait(item)
+            self.submitted += 1
+            metrics.inc('dns_prefetch_total')
+        except Queue.Full:
+            self.lock.acquire()
+            try:
+                del(self.pending[item])
+            finally:
+                self.lock.release()
+            self.dropped += 1
+            metrics.inc('dns_prefetch_dropped_total')
+
+
+    def stop(self):
+        for worker in self.workers:
+            try:
+                self.queue.put(None, True, 1)
+            except Queue.Full:
+                break
+        for worker in self.workers:
+            worker.join(1)
+        self.workers = []
+
+
+    def getStats(self):
+        return { 'threads': self.threads, 'queued': self.queue.qsize(),
+                 'submitted': self.submitted, 'dropped': self.dropped }
+
 
 if __name__ == "__main__":
     print "Module tests:"
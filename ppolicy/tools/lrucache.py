@@ -0,0 +1,481 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Local result cache with LRU eviction and TTL expiration
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import sys
+import time
+import types
+import threading
+import metrics
+import membudget
+
+
+__version__ = "$Revision$"
+
+
+# node items (node is list [ prev, next, key, value, expire, slot, window ])
+PREV, NEXT, KEY, VALUE, EXPIRE, SLOT, WINDOW = 0, 1, 2, 3, 4, 5, 6
+
+
+class FrequencyAdmission(object):
+    """TinyLFU admission policy. Access frequency of keys is estimated
+    by count-min sketch and new entry can replace least recently used
+    entry only if it was requested more often. Counters are halved
+    after each sampleSize recorded accesses, so old popularity fades
+    out. One-off keys (e.g. random senders) can't push out entries
+    that are used repeatedly (e.g. client addresses of big senders).
+    New entries first stay in small LRU window of TTLCache, so they
+    can collect accesses before they compete with LRU entry.
+    """
+
+    DEPTH = 4
+    MAX_COUNT = 15
+
+    def __init__(self, size, sampleSize = None):
+        self.width = 64
+        while self.width < size:
+            self.width *= 2
+        self.mask = self.width - 1
+        if sampleSize == None:
+            sampleSize = 10 * size
+        self.sampleSize = max(sampleSize, 1)
+        self.table = [ 0 ] * (self.DEPTH * self.width)
+        self.samples = 0
+
+
+    def __indexes(self, key):
+        h = hash(key)
+        h1 = h & self.mask
+        h2 = (h >> 16) | 1
+        return [ i * self.width + ((h1 + i * h2) & self.mask) for i in range(self.DEPTH) ]
+
+
+    def frequency(self, key):
+        table = self.table
+        return min([ table[i] for i in self.__indexes(key) ])
+
+
+    def record(self, key):
+        """Count one access to the key (not thread safe, caller
+        has to hold cache lock)."""
+        table = self.table
+        for i in self.__indexes(key):
+            if table[i] < self.MAX_COUNT:
+                table[i] += 1
+        self.samples += 1
+        if self.samples >= self.sampleSize:
+            self.table = [ x >> 1 for x in table ]
+            self.samples /= 2
+
+
+    def admit(self, key, victim):
+        """True if key should replace victim in full cache."""
+        return self.frequency(key) > self.frequency(victim)
+
+
+
+class TTLCache(object):
+    """Thread safe cache with O(1) get and set. Entries are kept in
+    doubly linked list in order of their usage and least recently
+    used entry is evicted when cache is full. With admission policy
+    new entries are stored in LRU window (WINDOW_RATIO of size) and
+    entry evicted from the window replaces least recently used entry
+    of main list only if admission policy accepts it (W-TinyLFU).
+    Expired entries are removed incrementally using timer wheel with
+    slots of resolution seconds, each set removes at most MAX_EXPIRE
+    of them.
+
+    @ivar size: maximum number of entries
+    @type size: int
+    @ivar admission: admission policy (object with record and admit
+    methods, e.g. FrequencyAdmission) or None to always evict LRU entry
+    """
+
+    MAX_EXPIRE = 100
+    WINDOW_RATIO = 0.01
+
+    def __init__(self, size = 10000, admission = None, resolution = 1.0):
+        self.size = size
+        self.maxSize = size
+        self.admission = admission
+        self.windowSize = self.__windowSize(size)
+        self.resolution = resolution
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.rejections = 0
+        self.__clear()
+
+
+    def __clear(self):
+        self.data = {}
+        self.root = []
+        self.root[:] = [ self.root, self.root, None, None, None, None, False ]
+        self.window = []
+        self.window[:] = [ self.window, self.window, None, None, None, None, True ]
+        self.windowCount = 0
+        self.wheel = {}   # slot -> { key: node }
+        self.wheelPos = int(time.time() / self.resolution)
+
+
+    def __windowSize(self, size):
+        if self.admission == None:
+            return 0
+        return max(1, int(size * self.WINDOW_RATIO))
+
+
+    def __link(self, node):
+        """Insert node at the beginning (most recently used) of window
+        or main list."""
+        if node[WINDOW]:
+            root = self.window
+        else:
+            root = self.root
+        first = root[NEXT]
+        node[PREV] = root
+        node[NEXT] = first
+        first[PREV] = node
+        root[NEXT] = node
+
+
+    def __unlink(self, node):
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+
+
+    def __wheelAdd(self, node):
+        slot = int(node[EXPIRE] / self.resolution) + 1
+        node[SLOT] = slot
+        bucket = self.wheel.get(slot)
+        if bucket == None:
+            bucket = {}
+            self.wheel[slot] = bucket
+        bucket[node[KEY]] = node
+
+
+    def __wheelRemove(self, node):
+        slot = node[SLOT]
+        bucket = self.wheel.get(slot)
+        if bucket != None and bucket.has_key(node[KEY]):
+            del(bucket[node[KEY]])
+            if len(bucket) == 0:
+                del(self.wheel[slot])
+
+
+    def __remove(self, node):
+        self.__unlink(node)
+        self.__wheelRemove(node)
+        del(self.data[node[KEY]])
+        if node[WINDOW]:
+            self.windowCount -= 1
+
+
+    def __windowEvict(self):
+        """Move least recently used entry from window to main list.
+        When cache is full it replaces least recently used entry of
+        main list only if admission policy accepts it."""
+        candidate = self.window[PREV]
+        self.__unlink(candidate)
+        self.windowCount -= 1
+        candidate[WINDOW] = False
+        if len(self.data) > self.size:
+            victim = self.root[PREV]
+            if victim is self.root or not self.admission.admit(candidate[KEY], victim[KEY]):
+                self.__wheelRemove(candidate)
+                del(self.data[candidate[KEY]])
+                self.rejections += 1
+                metrics.inc('cache_rejections_total')
+                return
+            self.__remove(victim)
+            self.evictions += 1
+            metrics.inc('cache_evictions_total')
+        self.__link(candidate)
+
+
+    def __expire(self, now):
+        """Remove entries from timer wheel slots that already passed."""
+        nowSlot = int(now / self.resolution)
+        if self.wheelPos >= nowSlot:
+            return
+        if nowSlot - self.wheelPos > len(self.wheel):
+            # cache was not used for long time
+            slots = [ x for x in self.wheel.keys() if x <= nowSlot ]
+            slots.sort()
+        else:
+            slots = xrange(self.wheelPos + 1, nowSlot + 1)
+        limit = self.MAX_EXPIRE
+        expired = 0
+        for slot in slots:
+            bucket = self.wheel.get(slot)
+            if bucket != None:
+                while len(bucket) > 0 and expired < limit:
+                    key, node = bucket.popitem()
+                    self.__unlink(node)
+                    del(self.data[key])
+                    if node[WINDOW]:
+                        self.windowCount -= 1
+                    expired += 1
+                if len(bucket) > 0:
+                    break
+                del(self.wheel[slot])
+            self.wheelPos = slot
+        else:
+            self.wheelPos = nowSlot
+        if expired > 0:
+            self.expirations += expired
+            metrics.inc('cache_expirations_total', (), expired)
+
+
+    def get(self, key):
+        """Return cached value or None."""
+        self.lock.acquire()
+        try:
+            if self.admission != None:
+                self.admission.record(key)
+            node = self.data.get(key)
+            if node == None:
+                self.misses += 1
+                return None
+            if node[EXPIRE] < time.time():
+                self.__remove(node)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.__unlink(node)
+            self.__link(node)
+            self.hits += 1
+            return node[VALUE]
+        finally:
+            self.lock.release()
+
+
+    def set(self, key, value, ttl):
+        """Cache value for ttl seconds. Returns False when cache
+        can't store any entry."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.__expire(now)
+            node = self.data.get(key)
+            if node != None:
+                self.__unlink(node)
+                self.__wheelRemove(node)
+                node[VALUE] = value
+                node[EXPIRE] = now + ttl
+                self.__link(node)
+                self.__wheelAdd(node)
+            elif self.admission != None:
+                # new entry competes with LRU entry after it leaves window
+                node = [ None, None, key, value, now + ttl, None, True ]
+                self.data[key] = node
+                self.windowCount += 1
+                self.__link(node)
+                self.__wheelAdd(node)
+                while self.windowCount > self.windowSize:
+                    self.__windowEvict()
+            else:
+                if len(self.data) >= self.size:
+                    victim = self.root[PREV]
+                    if victim is self.root:
+                        return False
+                    self.__remove(victim)
+                    self.evictions += 1
+                    metrics.inc('cache_evictions_total')
+                node = [ None, None, key, value, now + ttl, None, False ]
+                self.data[key] = node
+                self.__link(node)
+                self.__wheelAdd(node)
+            return True
+        finally:
+            self.lock.release()
+
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            node = self.data.get(key)
+            if node != None:
+                self.__remove(node)
+        finally:
+            self.lock.release()
+
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.__clear()
+        finally:
+            self.lock.release()
+
+
+    def keys(self):
+        self.lock.acquire()
+        try:
+            return self.data.keys()
+        finally:
+            self.lock.release()
+
+
+    def __len__(self):
+        return len(self.data)
+
+
+    def memoryUsage(self):
+        """Approximate memory used by cache (estimated from sample
+        of entries)."""
+        self.lock.acquire()
+        try:
+            nodes = membudget.sample(self.data.itervalues())
+            count = len(self.data)
+            size = sys.getsizeof(self.data) + sum([ sys.getsizeof(x) for x in self.wheel.values() ])
+        finally:
+            self.lock.release()
+        if len(nodes) == 0:
+            return size
+        nodeSize = 0
+        for node in nodes:
+            nodeSize += sys.getsizeof(node) + membudget.sizeOf(node[KEY]) + membudget.sizeOf(node[VALUE]) + sys.getsizeof(node[EXPIRE])
+        return size + nodeSize * count / len(nodes)
+
+
+    def memoryLimit(self, limit):
+        """Change number of entries to fit in limit bytes (at most
+        size given to constructor, None restores this size) and evict
+        least recently used entries over new size."""
+        if limit == None:
+            newSize = self.maxSize
+        else:
+            count = len(self.data)
+            if count == 0:
+                return
+            entrySize = max(1, self.memoryUsage() / count)
+            newSize = max(1, min(self.maxSize, int(limit / entrySize)))
+        evicted = 0
+        self.lock.acquire()
+        try:
+            self.size = newSize
+            self.windowSize = self.__windowSize(newSize)
+            while len(self.data) > self.size:
+                victim = self.root[PREV]
+                if victim is self.root:
+                    victim = self.window[PREV]
+                self.__remove(victim)
+                evicted += 1
+            self.evictions += evicted
+            while self.windowCount > self.windowSize:
+                self.__windowEvict()
+        finally:
+            self.lock.release()
+        if evicted > 0:
+            metrics.inc('cache_evictions_total', (), evicted)
+
+
+    def getStats(self):
+        return { 'size': self.size, 'entries': len(self.data),
+                 'hits': self.hits, 'misses': self.misses,
+                 'evictions': self.evictions,
+                 'expirations': self.expirations,
+                 'rejections': self.rejections }
+
+
+
+class ShardedCache(object):
+    """Cache split to independent TTLCache shards selected by key hash.
+    Each shard has its own lock, size (size / shards) and statistics,
+    so threads using different keys don't wait for each other."""
+
+    def __init__(self, size = 10000, shards = 16, admission = None, resolution = 1.0):
+        self.size = size
+        self.shards = []
+        shardSize = max(1, (size + shards - 1) / shards)
+        for i in range(shards):
+            self.shards.append(TTLCache(shardSize, createAdmission(admission, shardSize), resolution))
+        self.count = len(self.shards)
+
+
+    def get(self, key):
+        return self.shards[hash(key) % self.count].get(key)
+
+
+    def set(self, key, value, ttl):
+        return self.shards[hash(key) % self.count].set(key, value, ttl)
+
+
+    def delete(self, key):
+        self.shards[hash(key) % self.count].delete(key)
+
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+
+    def keys(self):
+        retVal = []
+        for shard in self.shards:
+            retVal.extend(shard.keys())
+        return retVal
+
+
+    def __len__(self):
+        return sum([ len(shard) for shard in self.shards ])
+
+
+    def memoryUsage(self):
+        return sum([ shard.memoryUsage() for shard in self.shards ])
+
+
+    def memoryLimit(self, limit):
+        """Divide limit equally between shards."""
+        for shard in self.shards:
+            if limit == None:
+                shard.memoryLimit(None)
+            else:
+                shard.memoryLimit(limit / self.count)
+
+
+    def getStats(self):
+        """Return statistics summed for all shards."""
+        retVal = {}
+        for shard in self.shards:
+            for k, v in shard.getStats().items():
+                retVal[k] = retVal.get(k, 0) + v
+        return retVal
+
+
+    def getShardStats(self):
+        return [ shard.getStats() for shard in self.shards ]
+
+
+
+def createCache(size, shards = 1, admission = None):
+    """Return local cache for cacheSize, cacheShards and cacheAdmission
+    options (TTLCache for one shard)."""
+    if shards > 1:
+        return ShardedCache(size, shards, admission)
+    return TTLCache(size, createAdmission(admission, size))
+
+
+
+def createAdmission(policy, size):
+    """Return admission policy object for cacheAdmission option
+    (None or 'lru', 'tinylfu', custom policy class or object)."""
+    if policy == None or policy == 'lru':
+        return None
+    if policy == 'tinylfu':
+        return FrequencyAdmission(size)
+    if isinstance(policy, (type, types.ClassType)):
+        # policy class, each (shard) cache gets its own instance
+        return policy(size)
+    if hasattr(policy, 'admit') and hasattr(policy, 'record'):
+        return policy
+    raise Exception("Unknown cache admission policy %s" % policy)
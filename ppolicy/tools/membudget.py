@@ -0,0 +1,207 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Memory budget for caches
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import sys
+import random
+import logging
+import threading
+import metrics
+
+
+__version__ = "$Revision$"
+
+
+SAMPLE = 100
+
+
+def sizeOf(obj, depth = 3):
+    """Approximate memory used by object including objects it refers
+    to (at most depth levels of containers and object attributes)."""
+    size = sys.getsizeof(obj)
+    if depth <= 0:
+        return size
+    t = type(obj)
+    if t in [ str, unicode, int, long, float, bool ] or obj == None:
+        return size
+    if t in [ tuple, list, set, frozenset ]:
+        for item in obj:
+            size += sizeOf(item, depth - 1)
+    elif t == dict:
+        for k, v in obj.iteritems():
+            size += sizeOf(k, depth - 1) + sizeOf(v, depth - 1)
+    elif hasattr(obj, '__dict__'):
+        size += sizeOf(obj.__dict__, depth - 1)
+    return size
+
+
+def sample(items, count = SAMPLE):
+    """Return at most count items from iterator (dictionary can be
+    changed by other thread, in that case shorter sample is returned)."""
+    retVal = []
+    try:
+        for item in items:
+            retVal.append(item)
+            if len(retVal) >= count:
+                break
+    except RuntimeError:
+        pass
+    return retVal
+
+
+def dictUsage(data, depth = 3):
+    """Estimate memory used by dictionary from sample of its items."""
+    size = sys.getsizeof(data)
+    items = sample(data.iteritems())
+    if len(items) == 0:
+        return size
+    itemSize = sum([ sizeOf(k, depth) + sizeOf(v, depth) for k, v in items ])
+    return size + itemSize * len(data) / len(items)
+
+
+def dictLimit(data, usage, limit, order = None):
+    """Remove items from dictionary to reduce its memory usage from
+    usage to limit bytes. Items with the lowest order(key, value) are
+    removed first (random items without order function). Returns
+    number of removed items."""
+    if limit == None or usage <= limit or len(data) == 0:
+        return 0
+    count = len(data) - int(len(data) * float(limit) / usage)
+    if order != None:
+        items = [ (order(k, v), k) for k, v in data.items() ]
+        items.sort()
+        keys = [ k for o, k in items[:count] ]
+    else:
+        keys = random.sample(data.keys(), min(count, len(data)))
+    for key in keys:
+        data.pop(key, None)
+    return len(keys)
+
+
+
+class MemoryBudget(object):
+    """Keep memory used by caches under global limit "total" and under
+    per cache limits from "budgets" dictionary (cache name -> bytes).
+    Caches are provided by "caches" function that returns list of
+    (name, object) tuples, each object has memoryUsage method that
+    returns approximate number of bytes (None if it is not accounted)
+    and memoryLimit(bytes) method that evicts data over given limit
+    (resizable caches can use it also to grow back, None means that
+    cache is not limited).
+
+    Memory left by caches with own budget is shared by other caches,
+    caches using less than equal share keep all their data and rest
+    is equally divided between bigger caches. Limits are applied by
+    background thread each "interval" seconds."""
+
+    def __init__(self, caches, total = None, budgets = {}, interval = 60):
+        self.caches = caches
+        self.total = total
+        self.budgets = budgets
+        self.interval = interval
+        self.event = threading.Event()
+        self.thread = None
+        self.report = []
+        self.checks = 0
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__run, name="membudget")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+
+    def stop(self):
+        self.event.set()
+        if self.thread != None:
+            self.thread.join(5)
+            self.thread = None
+
+
+    def __run(self):
+        while True:
+            self.event.wait(self.interval)
+            if self.event.isSet():
+                break
+            try:
+                self.check()
+            except Exception, e:
+                logging.getLogger().error("memory budget check failed: %s" % e)
+
+
+    def __limits(self, usage):
+        """Return dictionary with limit for each cache (None = unlimited)."""
+        limits = {}
+        shared = []
+        free = self.total
+        for name, used in usage:
+            if self.budgets.has_key(name):
+                limits[name] = self.budgets[name]
+                if free != None:
+                    free -= min(used, self.budgets[name])
+            else:
+                shared.append((used, name))
+        if free == None:
+            for used, name in shared:
+                limits[name] = None
+            return limits
+
+        # caches using less than equal share keep all their data
+        # (and resizable caches can grow up to the share)
+        shared.sort()
+        free = max(0, free)
+        while len(shared) > 0:
+            share = free / len(shared)
+            used, name = shared[0]
+            if used > share:
+                break
+            limits[name] = share
+            free -= used
+            shared.pop(0)
+        for used, name in shared:
+            limits[name] = free / len(shared)
+        return limits
+
+
+    def check(self):
+        """Apply memory limits and update report."""
+        caches = []
+        usage = []
+        for name, obj in self.caches():
+            try:
+                used = obj.memoryUsage()
+            except Exception, e:
+                logging.getLogger().warn("memory usage of %s failed: %s" % (name, e))
+                continue
+            if used == None:
+                continue
+            caches.append((name, obj, used))
+            usage.append((name, used))
+
+        limits = self.__limits(usage)
+        report = []
+        for name, obj, used in caches:
+            limit = limits.get(name)
+            try:
+                obj.memoryLimit(limit)
+            except Exception, e:
+                logging.getLogger().warn("memory limit of %s failed: %s" % (name, e))
+            if limit != None and used > limit:
+                metrics.inc('memory_evictions_total', (('cache', name),))
+                logging.getLogger().info("%s uses %i bytes, limit %i bytes" % (name, used, limit))
+            report.append((name, used, limit))
+        report.sort()
+        self.report = report
+        self.checks += 1
+
+
+    def getReport(self):
+        """Return list of (cache name, used bytes, limit) from last check."""
+        return self.report
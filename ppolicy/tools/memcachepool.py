@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Memcache clients for worker threads with circuit breaker
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import time
+import inspect
+import logging
+import threading
+import memcache
+import metrics
+
+
+__version__ = "$Revision$"
+
+
+class CircuitBreaker(object):
+    """Stop using failing service. After "failures" consecutive failures
+    breaker is open for "reset" seconds and all calls are refused
+    immediately, then one call is allowed to test the service (half
+    open state) and its result close or open the breaker again."""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failures = 5, reset = 10):
+        self.failures = failures
+        self.reset = reset
+        self.lock = threading.Lock()
+        self.state = self.CLOSED
+        self.failed = 0
+        self.openUntil = 0
+        self.opened = 0
+        self.refused = 0
+
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        self.lock.acquire()
+        try:
+            if self.state == self.OPEN and self.openUntil <= time.time():
+                # let one call test the service
+                self.state = self.HALF_OPEN
+                return True
+            self.refused += 1
+            return False
+        finally:
+            self.lock.release()
+
+
+    def success(self):
+        if self.state == self.CLOSED and self.failed == 0:
+            return
+        self.lock.acquire()
+        try:
+            if self.state != self.CLOSED:
+                logging.getLogger().info("circuit breaker closed")
+            self.state = self.CLOSED
+            self.failed = 0
+        finally:
+            self.lock.release()
+
+
+    def failure(self):
+        self.lock.acquire()
+        try:
+            self.failed += 1
+            if self.state == self.HALF_OPEN or self.failed >= self.failures:
+                if self.state != self.OPEN:
+                    logging.getLogger().warn("circuit breaker open for %ss after %i failures" % (self.reset, self.failed))
+                    self.opened += 1
+                    metrics.inc('cache_breaker_open_total')
+                self.state = self.OPEN
+                self.openUntil = time.time() + self.reset
+        finally:
+            self.lock.release()
+
+
+    def getStats(self):
+        return { 'state': self.state, 'failed': self.failed,
+                 'opened': self.opened, 'refused': self.refused }
+
+
+
+class MemcachePool(object):
+    """Subset of memcache.Client interface (get, set, get_multi and
+    set_multi) for many threads. Each thread uses its own client, so
+    requests are not serialized by lock (even with old not thread safe
+    python-memcache). Client socket timeout (used for connect and read)
+    is "timeout" and unavailable server is not used for "deadRetry"
+    seconds. Calls fail when all servers are dead and after breaker
+    failures calls return None immediately (cache miss) for breaker
+    reset seconds, so dead memcached doesn't slow down requests."""
+
+    def __init__(self, servers, timeout = 0.5, deadRetry = 5, breakerFailures = 5, breakerReset = 10):
+        self.servers = servers
+        self.clientArgs = {}
+        try:
+            clientArgs = inspect.getargspec(memcache.Client.__init__)[0]
+        except TypeError:
+            clientArgs = []
+        if 'socket_timeout' in clientArgs:
+            self.clientArgs['socket_timeout'] = timeout
+        if 'dead_retry' in clientArgs:
+            self.clientArgs['dead_retry'] = deadRetry
+        self.breaker = CircuitBreaker(breakerFailures, breakerReset)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.clients = []
+        self.requests = 0
+        self.errors = 0
+
+
+    def __client(self):
+        client = getattr(self.local, 'client', None)
+        if client == None:
+            client = memcache.Client(self.servers, **self.clientArgs)
+            self.local.client = client
+            self.lock.acquire()
+            try:
+                self.clients.append(client)
+            finally:
+                self.lock.release()
+        return client
+
+
+    def __alive(self, client):
+        """False when all servers are marked dead by client."""
+        now = time.time()
+        for server in getattr(client, 'servers', []):
+            if getattr(server, 'deaduntil', 0) <= now:
+                return True
+        return False
+
+
+    def __call(self, method, failed, *args):
+        if not self.breaker.allow():
+            return failed
+        self.requests += 1
+        client = self.__client()
+        try:
+            retVal = getattr(client, method)(*args)
+        except Exception, e:
+            logging.getLogger().warn("memcache %s failed: %s" % (method, e))
+            retVal = failed
+            ok = False
+        else:
+            ok = self.__alive(client)
+            if method in [ 'set' ] and not retVal:
+                ok = False
+            if method in [ 'set_multi' ] and len(retVal) > 0:
+                ok = False
+        if ok:
+            self.breaker.success()
+        else:
+            self.errors += 1
+            self.breaker.failure()
+        return retVal
+
+
+    def get(self, key):
+        return self.__call('get', None, key)
+
+
+    def get_multi(self, keys):
+        return self.__call('get_multi', {}, keys)
+
+
+    def set(self, key, value, ttl = 0):
+        return self.__call('set', False, key, value, int(ttl))
+
+
+    def set_multi(self, mapping, ttl = 0):
+        """Returns list of keys that were not stored."""
+        return self.__call('set_multi', mapping.keys(), mapping, int(ttl))
+
+
+    def disconnect(self):
+        self.lock.acquire()
+        try:
+            clients = self.clients
+            self.clients = []
+        finally:
+            self.lock.release()
+        for client in clients:
+            try:
+                client.disconnect_all()
+            except Exception, e:
+                logging.getLogger().debug("memcache disconnect failed: %s" % e)
+        self.local = threading.local()
+
+
+    def getStats(self):
+        retVal = self.breaker.getStats()
+        retVal.update({ 'clients': len(self.clients),
+                        'requests': self.requests,
+                        'errors': self.errors })
+        return retVal
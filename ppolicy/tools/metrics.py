@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# In-process metrics (counters and latency histograms)
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import threading
+
+
+class Histogram(object):
+    """Latency histogram with log-linear buckets (similar to HDR
+    histogram). Values are stored in microseconds, each power of two
+    range is divided to SUB_BUCKETS linear buckets, so relative error
+    of reported percentiles is less than 1/SUB_BUCKETS.
+    """
+
+    SUB_BUCKETS = 16
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def __index(self, value):
+        if value < 2 * self.SUB_BUCKETS:
+            return value
+        shift = value.bit_length() - 5
+        return shift * self.SUB_BUCKETS + (value >> shift)
+
+    def __value(self, index):
+        """Highest value (in microseconds) stored in bucket index."""
+        if index < 2 * self.SUB_BUCKETS:
+            return index
+        shift = index / self.SUB_BUCKETS - 1
+        return ((index - shift * self.SUB_BUCKETS + 1) << shift) - 1
+
+    def add(self, value):
+        """Add value in seconds."""
+        if value < 0:
+            value = 0.0
+        index = self.__index(int(value * 1000000))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Return value (in seconds) for percentile p (0.0 - 1.0)."""
+        if self.count == 0:
+            return 0.0
+        limit = p * self.count
+        seen = 0
+        indexes = self.counts.keys()
+        indexes.sort()
+        for index in indexes:
+            seen += self.counts[index]
+            if seen >= limit:
+                return min(self.__value(index) / 1000000.0, self.max)
+        return self.max
+
+
+class Registry(object):
+    """Thread safe set of named counters and histograms. Each metric
+    is identified by name and tuple of (label, value) pairs."""
+
+    QUANTILES = [ 0.5, 0.9, 0.99, 0.999 ]
+
+    def __init__(self, prefix = 'ppolicy'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels = (), value = 1):
+        key = (name, labels)
+        self.lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, labels = ()):
+        key = (name, labels)
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(key)
+            if histogram == None:
+                histogram = Histogram()
+                self.histograms[key] = histogram
+            histogram.add(value)
+        finally:
+            self.lock.release()
+
+    def getHistogram(self, name, labels = ()):
+        return self.histograms.get((name, labels))
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.counters = {}
+            self.histograms = {}
+        finally:
+            self.lock.release()
+
+    def __labels(self, labels):
+        if len(labels) == 0:
+            return ''
+        return "{%s}" % ",".join([ '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels ])
+
+    def render(self, gauges = [], counters = []):
+        """Return metrics in Prometheus text format. Optional gauges
+        is list of (name, labels, value) with current values, counters
+        list of (name, labels, value) with totals kept outside registry
+        (e.g. cache statistics)."""
+        lines = []
+        self.lock.acquire()
+        try:
+            counters = self.counters.items() + [ ((name, labels), value) for name, labels, value in counters ]
+            histograms = [ (k, v.count, v.sum, [ v.percentile(q) for q in self.QUANTILES ]) for k, v in self.histograms.items() ]
+        finally:
+            self.lock.release()
+
+        counters.sort()
+        lastName = None
+        for (name, labels), value in counters:
+            if name != lastName:
+                lines.append("# TYPE %s_%s counter" % (self.prefix, name))
+                lastName = name
+            lines.append("%s_%s%s %s" % (self.prefix, name, self.__labels(labels), value))
+
+        histograms.sort()
+        lastName = None
+        for (name, labels), count, total, values in histograms:
+            if name != lastName:
+                lines.append("# TYPE %s_%s summary" % (self.prefix, name))
+                lastName = name
+            for q, value in zip(self.QUANTILES, values):
+                lines.append("%s_%s%s %.6f" % (self.prefix, name, self.__labels(labels + (('quantile', q),)), value))
+            lines.append("%s_%s_sum%s %.6f" % (self.prefix, name, self.__labels(labels), total))
+            lines.append("%s_%s_count%s %i" % (self.prefix, name, self.__labels(labels), count))
+
+        # samples of one metric family must be together (stable sort
+        # keeps order of labels given by caller)
+        gauges = list(gauges)
+        gauges.sort(key=lambda x: x[0])
+        lastName = None
+        for name, labels, value in gauges:
+            if name != lastName:
+                lines.append("# TYPE %s_%s gauge" % (self.prefix, name))
+                lastName = name
+            lines.append("%s_%s%s %s" % (self.prefix, name, self.__labels(labels), value))
+
+        return "\n".join(lines) + "\n"
+
+
+_registry = Registry()
+
+
+def getInstance():
+    return _registry
+
+
+def inc(name, labels = (), value = 1):
+    _registry.inc(name, labels, value)
+
+
+def observe(name, value, labels = ()):
+    _registry.observe(name, value, labels)
+
+
+def render(gauges = [], counters = []):
+    return _registry.render(gauges, counters)
+
+
+
+if __name__ == "__main__":
+    print "Module tests:"
+    import random
+    h = Histogram()
+    for i in range(100000):
+        h.add(random.expovariate(100))
+    for q in [ 0.5, 0.9, 0.99, 0.999 ]:
+        print q, h.percentile(q)
+    inc('requests', (('module', 'spf'),))
+    observe('latency', 0.01, (('module', 'spf'),))
+    print render([ ('threads', (), 40) ])
@@ -0,0 +1,431 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Replay requests saved by DumpDataFile module (load generator)
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import os, sys, imp
+import time
+import socket
+import logging
+import threading
+import Queue
+from metrics import Histogram
+
+
+__version__ = "$Revision$"
+
+
+def dumpRequest(data):
+    """Return (date, data) for request read from dump file."""
+    date = data.pop('date', None)
+    if date != None:
+        try:
+            date = float(date)
+        except ValueError:
+            date = None
+    return (date, data)
+
+
+def readDump(fileName, resultPrefixes = [ 'result_' ]):
+    """Read requests saved by DumpDataFile module. Returns list
+    of (date, data) tuples, date is None if it was not saved. Internal
+    resource_* values added by ppolicy and results saved by modules
+    called before DumpDataFile (keys starting with saveResultPrefix
+    from resultPrefixes) are not replayed."""
+    skipPrefixes = tuple([ 'resource_' ] + list(resultPrefixes))
+    requests = []
+    data = {}
+    for line in open(fileName):
+        line = line.rstrip("\r\n")
+        if line == '':
+            if len(data) > 0:
+                requests.append(dumpRequest(data))
+                data = {}
+            continue
+        pos = line.find('=')
+        if pos == -1:
+            logging.getLogger().warn("invalid line in %s: %s" % (fileName, line))
+            continue
+        if line.startswith(skipPrefixes):
+            continue
+        data[line[:pos]] = line[pos+1:]
+    if len(data) > 0:
+        requests.append(dumpRequest(data))
+    return requests
+
+
+
+class Stats(object):
+    """Thread safe latency statistics for requests and modules."""
+
+    QUANTILES = [ 0.5, 0.99, 0.999 ]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.results = {}
+        self.errors = 0
+        self.lag = Histogram()
+        self.startTime = None
+        self.endTime = None
+
+    def add(self, name, seconds, result = None):
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram == None:
+                histogram = Histogram()
+                self.histograms[name] = histogram
+            histogram.add(seconds)
+            if result != None:
+                self.results[result] = self.results.get(result, 0) + 1
+        finally:
+            self.lock.release()
+
+    def addError(self):
+        self.lock.acquire()
+        try:
+            self.errors += 1
+        finally:
+            self.lock.release()
+
+    def addLag(self, seconds):
+        self.lock.acquire()
+        try:
+            self.lag.add(seconds)
+        finally:
+            self.lock.release()
+
+    def report(self):
+        lines = []
+        elapsed = max(0.000001, self.endTime - self.startTime)
+        requests = self.histograms.get('request')
+        count = 0
+        if requests != None:
+            count = requests.count
+        lines.append("requests: %i, errors: %i, time: %.3fs, throughput: %.1f req/s" % (count, self.errors, elapsed, count / elapsed))
+        if self.lag.count > 0:
+            lines.append("schedule lag: p50 %.1fms, p99 %.1fms, max %.1fms" % (self.lag.percentile(0.5) * 1000, self.lag.percentile(0.99) * 1000, self.lag.max * 1000))
+        lines.append("%-30s %8s %10s %10s %10s %10s" % ('name', 'count', 'p50[ms]', 'p99[ms]', 'p999[ms]', 'max[ms]'))
+        names = self.histograms.keys()
+        names.sort()
+        if 'request' in names:
+            names.remove('request')
+            names.insert(0, 'request')
+        for name in names:
+            h = self.histograms[name]
+            lines.append("%-30s %8i %10.2f %10.2f %10.2f %10.2f" % tuple([ name, h.count ] + [ h.percentile(q) * 1000 for q in self.QUANTILES ] + [ h.max * 1000 ]))
+        results = self.results.items()
+        results.sort(lambda x, y: cmp(y[1], x[1]))
+        for result, count in results:
+            lines.append("result %s: %i" % (result, count))
+        return lines
+
+
+
+class PolicyTarget(object):
+    """Send requests to running ppolicy using postfix policy
+    protocol. Each replay thread uses its own connection, with reuse
+    False new connection is created for each request."""
+
+    def __init__(self, host = 'localhost', port = 10031, reuse = True, timeout = 30):
+        self.host = host
+        self.port = port
+        self.reuse = reuse
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def __connect(self):
+        sock = getattr(self.local, 'sock', None)
+        if sock == None:
+            sock = socket.create_connection((self.host, self.port), self.timeout)
+            self.local.sock = sock
+            self.local.buffer = ''
+        return sock
+
+    def __close(self):
+        sock = getattr(self.local, 'sock', None)
+        if sock != None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+            self.local.sock = None
+
+    def call(self, data):
+        try:
+            sock = self.__connect()
+            sock.sendall("".join([ "%s=%s\n" % (k, v) for k, v in data.items() ]) + "\n")
+            buffer = self.local.buffer
+            while buffer.find("\n\n") == -1:
+                recv = sock.recv(4096)
+                if recv == '':
+                    raise socket.error("connection closed by ppolicy")
+                buffer += recv
+            pos = buffer.find("\n\n")
+            response = buffer[:pos]
+            self.local.buffer = buffer[pos+2:]
+        except:
+            self.__close()
+            raise
+        if not self.reuse:
+            self.__close()
+        for line in response.split("\n"):
+            if line.startswith('action='):
+                return line[len('action='):]
+        return response
+
+
+
+class FactoryTarget(object):
+    """Call check function from ppolicy configuration file in-process
+    with PPolicyFactory, time spent in each module is measured by
+    factory metrics (module_duration_seconds)."""
+
+    def __init__(self, configFile, defaults = {}):
+        self.configFile = configFile
+        self.defaults = defaults
+        self.factory = None
+
+    def start(self):
+        from ppolicy.protocol import PPolicyFactory
+        from ppolicy.tools import metrics
+        config = { 'stateFile': None, 'modules': {}, 'executors': {}, 'checkAsync': None }
+        config.update(self.defaults)
+        ppolicyConfig = imp.load_source("ppolicy_config", self.configFile)
+        for key in dir(ppolicyConfig):
+            if key[:2] == '__': continue
+            val = getattr(ppolicyConfig, key)
+            if type(val).__name__ == 'module': continue
+            config[key] = val
+        # never overwrite state of production ppolicy
+        config['stateFile'] = None
+        self.check = config['check']
+        self.metrics = metrics.getInstance()
+        self.factory = PPolicyFactory(config)
+        self.factory.startFactory()
+        self.metrics.reset()
+
+    def stop(self):
+        if self.factory != None:
+            self.factory.stopFactory()
+            self.factory = None
+
+    def call(self, data):
+        data = data.copy()
+        data['resource_start_time'] = time.time()
+        action, actionEx = self.check(self.factory, data, None)
+        return "%s %s" % (action, actionEx)
+
+    def getModuleStats(self):
+        """Return per module histograms collected by factory."""
+        ret = {}
+        for (name, labels), histogram in self.metrics.histograms.items():
+            if name == 'module_duration_seconds':
+                ret["module %s" % dict(labels).get('module')] = histogram
+        return ret
+
+
+
+class Replay(object):
+    """Replay requests using concurrency threads. Requests are
+    sent as fast as possible, with given rate (requests per second)
+    or with original timing from dump compressed speed times.
+
+    @ivar target: PolicyTarget or FactoryTarget
+    @ivar requests: list of (date, data) from readDump
+    @ivar concurrency: number of replay threads
+    @ivar rate: requests per second (None - unlimited)
+    @ivar speed: time compression for original timing (None - disabled)
+    @ivar loops: how many times requests should be replayed
+    """
+
+    def __init__(self, target, requests, concurrency = 10, rate = None, speed = None, loops = 1):
+        self.target = target
+        self.requests = requests
+        self.concurrency = concurrency
+        self.rate = rate
+        self.speed = speed
+        self.loops = loops
+        self.stats = Stats()
+        self.queue = Queue.Queue(concurrency * 100)
+
+    def __schedule(self):
+        """Put (offset, data) to the queue for all requests."""
+        offset = 0.0
+        num = 0
+        firstDate = None
+        loopOffset = 0.0
+        for loop in range(self.loops):
+            for date, data in self.requests:
+                if self.speed != None and date != None:
+                    if firstDate == None:
+                        firstDate = date
+                    offset = loopOffset + (date - firstDate) / self.speed
+                elif self.rate != None:
+                    offset = num / float(self.rate)
+                self.queue.put((offset, data))
+                num += 1
+            loopOffset = offset
+        for i in range(self.concurrency):
+            self.queue.put(None)
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                break
+            offset, data = item
+            scheduled = self.stats.startTime + offset
+            now = time.time()
+            if scheduled > now:
+                time.sleep(scheduled - now)
+            if self.rate != None or self.speed != None:
+                self.stats.addLag(max(0, now - scheduled))
+            startTime = time.time()
+            try:
+                action = self.target.call(data)
+            except Exception, e:
+                logging.getLogger().warn("request failed: %s" % e)
+                self.stats.addError()
+                continue
+            self.stats.add('request', time.time() - startTime, str(action).split(' ')[0])
+
+    def run(self):
+        self.target.start()
+        try:
+            self.stats.startTime = time.time()
+            threadList = []
+            for i in range(self.concurrency):
+                thread = threading.Thread(target=self.__run, name="replay-%i" % i)
+                thread.setDaemon(True)
+                thread.start()
+                threadList.append(thread)
+            self.__schedule()
+            for thread in threadList:
+                while thread.isAlive():
+                    thread.join(1)
+            self.stats.endTime = time.time()
+            if hasattr(self.target, 'getModuleStats'):
+                self.stats.histograms.update(self.target.getModuleStats())
+        finally:
+            self.target.stop()
+        return self.stats
+
+
+
+def usage():
+    print "usage: %s [options] dump.dat [dump2.dat ...]" % sys.argv[0]
+    print "Params:"
+    print "  -h, --help\t\tthis help"
+    print "  -q, -v, -l=x\t\tlog level"
+    print "  -H, --host=x\t\tppolicy host (default: localhost)"
+    print "  -p, --port=x\t\tppolicy port (default: 10031)"
+    print "  -f, --config=x\tcall check from ppolicy.conf in-process"
+    print "  -c, --concurrency=x\tnumber of parallel clients (default: 10)"
+    print "  -r, --rate=x\t\trequests per second (default: unlimited)"
+    print "  -s, --speed=x\t\treplay with original timing x times faster"
+    print "  -n, --count=x\t\treplay only first x requests"
+    print "  --loops=x\t\treplay requests x times (default: 1)"
+    print "  --no-reuse\t\tnew connection for each request"
+    print "  --timeout=x\t\tsocket timeout (default: 30)"
+    print "  --result-prefix=x\tsaveResultPrefix of dumped module results"
+    print "\t\t\tthat are not replayed (default: result_)"
+
+
+if __name__ == "__main__":
+    streamHandler = logging.StreamHandler(sys.stdout)
+    streamHandler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s](%(module)s:%(lineno)d) %(message)s", "%d %b %H:%M:%S"))
+    logging.getLogger().addHandler(streamHandler)
+    logging.getLogger().setLevel(logging.WARN)
+
+    import getopt
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hvql:H:p:f:c:r:s:n:",
+                                   ["help", "verbose", "quiet", "log-level=",
+                                    "host=", "port=", "config=",
+                                    "concurrency=", "rate=", "speed=",
+                                    "count=", "loops=", "no-reuse",
+                                    "timeout=", "result-prefix=" ])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    host = 'localhost'
+    port = 10031
+    configFile = None
+    concurrency = 10
+    rate = None
+    speed = None
+    count = None
+    loops = 1
+    reuse = True
+    timeout = 30
+    resultPrefixes = []
+
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        if o in ("-v", "--verbose"):
+            logging.getLogger().setLevel(logging.DEBUG)
+        if o in ("-q", "--quiet"):
+            logging.getLogger().setLevel(logging.ERROR)
+        if o in ("-l", "--log-level"):
+            logging.getLogger().setLevel(int(a))
+        if o in ("-H", "--host"):
+            host = a
+        if o in ("-p", "--port"):
+            port = int(a)
+        if o in ("-f", "--config"):
+            configFile = a
+        if o in ("-c", "--concurrency"):
+            concurrency = int(a)
+        if o in ("-r", "--rate"):
+            rate = float(a)
+        if o in ("-s", "--speed"):
+            speed = float(a)
+        if o in ("-n", "--count"):
+            count = int(a)
+        if o in ("--loops", ):
+            loops = int(a)
+        if o in ("--no-reuse", ):
+            reuse = False
+        if o in ("--timeout", ):
+            timeout = float(a)
+        if o in ("--result-prefix", ):
+            resultPrefixes.append(a)
+
+    if len(args) == 0:
+        usage()
+        sys.exit(1)
+
+    if len(resultPrefixes) == 0:
+        resultPrefixes = [ 'result_' ]
+    requests = []
+    for fileName in args:
+        requests += readDump(fileName, resultPrefixes)
+    if count != None:
+        requests = requests[:count]
+    print "loaded %i requests" % len(requests)
+
+    if configFile != None:
+        target = FactoryTarget(configFile)
+    else:
+        target = PolicyTarget(host, port, reuse, timeout)
+
+    stats = Replay(target, requests, concurrency, rate, speed, loops).run()
+    for line in stats.report():
+        print line
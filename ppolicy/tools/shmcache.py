@@ -0,0 +1,289 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Cache shared between processes using memory mapped file
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import os
+import time
+import mmap
+import fcntl
+import struct
+import pickle
+import logging
+import threading
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+
+# instances of SharedCache in this process (real path -> list)
+_users = {}
+_usersLock = threading.Lock()
+
+
+class SharedCache(object):
+    """Fixed size key/value cache stored in memory mapped file, so it
+    can be shared by all ppolicy worker processes (use file on tmpfs,
+    e.g. /dev/shm). Table is divided to buckets with BUCKET_SLOTS slots,
+    key digest selects bucket and when bucket is full record with
+    the nearest expiration time is replaced. Each bucket is protected
+    by thread lock (threads in one process) and by fcntl record lock
+    (other processes). Values are pickled and records that doesn't fit
+    in one slot are not cached.
+
+    @ivar fileName: path to the cache file
+    @type fileName: str
+    @ivar slots: number of records in the cache
+    @type slots: int
+    @ivar slotSize: maximum size of one record (including its header)
+    @type slotSize: int
+    """
+
+    MAGIC = 'PPSHM001'
+    HEADER = struct.Struct('8sII')
+    HEADER_SIZE = 64
+    SLOT = struct.Struct('16sdH')
+    BUCKET_SLOTS = 4
+    LOCKS = 64
+    # header bytes locked while the file is initialized and one byte
+    # locked shared by every process that has the file mapped
+    INIT_LOCK = (HEADER_SIZE - 1, 0)
+    USERS_LOCK = (1, HEADER_SIZE - 1)
+
+    def __init__(self, fileName, slots = 10000, slotSize = 256):
+        if slotSize <= self.SLOT.size:
+            raise ValueError("slot size %i is too small" % slotSize)
+        self.fileName = fileName
+        self.__setSize(slots, slotSize)
+        self.locks = [ threading.Lock() for i in range(self.LOCKS) ]
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.drops = 0
+
+        self.fd = os.open(fileName, os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, *self.INIT_LOCK)
+        try:
+            fileSize = os.fstat(self.fd).st_size
+            if fileSize != self.size and fileSize >= self.HEADER_SIZE and self.__inUse():
+                # other processes have the file mapped and changing
+                # its size would kill them with SIGBUS
+                header = os.read(self.fd, self.HEADER.size)
+                magic, slots, slotSize = self.HEADER.unpack(header)
+                if magic != self.MAGIC or self.HEADER_SIZE + slots * slotSize != fileSize:
+                    raise ValueError("shared cache %s is in use and has invalid header" % fileName)
+                logging.getLogger().warn("shared cache %s is in use, can't change its size to %i slots of %i bytes, using %i slots of %i bytes" % (fileName, self.slots, self.slotSize, slots, slotSize))
+                self.__setSize(slots, slotSize)
+            if fileSize != self.size:
+                os.ftruncate(self.fd, self.size)
+            self.data = mmap.mmap(self.fd, self.size)
+            magic, slots, slotSize = self.HEADER.unpack_from(self.data, 0)
+            if magic != self.MAGIC or slots != self.slots or slotSize != self.slotSize:
+                logging.getLogger().info("initializing shared cache %s (%i slots, %i bytes)" % (fileName, self.slots, self.size))
+                self.data[:] = '\0' * self.size
+                self.HEADER.pack_into(self.data, 0, self.MAGIC, self.slots, self.slotSize)
+            fcntl.lockf(self.fd, fcntl.LOCK_SH, *self.USERS_LOCK)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, *self.INIT_LOCK)
+
+        _usersLock.acquire()
+        try:
+            _users.setdefault(os.path.realpath(fileName), []).append(self)
+        finally:
+            _usersLock.release()
+
+
+    def __setSize(self, slots, slotSize):
+        self.buckets = max(1, (slots + self.BUCKET_SLOTS - 1) / self.BUCKET_SLOTS)
+        self.slots = self.buckets * self.BUCKET_SLOTS
+        self.slotSize = slotSize
+        self.size = self.HEADER_SIZE + self.slots * self.slotSize
+
+
+    def __inUse(self):
+        """True if the file is mapped by other instance in this process
+        or by other process (fcntl locks of one process don't conflict,
+        so instances in this process are tracked separately)."""
+        _usersLock.acquire()
+        try:
+            if len(_users.get(os.path.realpath(self.fileName), [])) > 0:
+                return True
+        finally:
+            _usersLock.release()
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, *self.USERS_LOCK)
+        except IOError:
+            return True
+        return False
+
+
+    def __bucket(self, digest):
+        bucket = struct.unpack('Q', digest[:8])[0] % self.buckets
+        offset = self.HEADER_SIZE + bucket * self.BUCKET_SLOTS * self.slotSize
+        return bucket, offset
+
+
+    def __lock(self, bucket, offset, mode):
+        self.locks[bucket % self.LOCKS].acquire()
+        try:
+            fcntl.lockf(self.fd, mode, self.BUCKET_SLOTS * self.slotSize, offset)
+        except:
+            self.locks[bucket % self.LOCKS].release()
+            raise
+
+
+    def __unlock(self, bucket, offset):
+        try:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, self.BUCKET_SLOTS * self.slotSize, offset)
+        finally:
+            self.locks[bucket % self.LOCKS].release()
+
+
+    def get(self, key):
+        """Return value for key or None if it is not in the cache."""
+        digest = md5(key).digest()
+        bucket, offset = self.__bucket(digest)
+        value = None
+        now = time.time()
+        self.__lock(bucket, offset, fcntl.LOCK_SH)
+        try:
+            for i in range(self.BUCKET_SLOTS):
+                pos = offset + i * self.slotSize
+                slotDigest, expire, length = self.SLOT.unpack_from(self.data, pos)
+                if slotDigest == digest:
+                    if expire > now:
+                        pos += self.SLOT.size
+                        value = self.data[pos:pos+length]
+                    break
+        finally:
+            self.__unlock(bucket, offset)
+
+        if value == None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(value)
+
+
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds. Returns False if value is too
+        big to be stored in the cache."""
+        value = pickle.dumps(value, -1)
+        if len(value) > self.slotSize - self.SLOT.size:
+            self.drops += 1
+            return False
+
+        digest = md5(key).digest()
+        bucket, offset = self.__bucket(digest)
+        now = time.time()
+        self.__lock(bucket, offset, fcntl.LOCK_EX)
+        try:
+            slotPos = None
+            slotExpire = None
+            for i in range(self.BUCKET_SLOTS):
+                pos = offset + i * self.slotSize
+                slotDigest, expire, length = self.SLOT.unpack_from(self.data, pos)
+                if slotDigest == digest:
+                    slotPos = pos
+                    break
+                if expire <= now:
+                    expire = 0
+                if slotExpire == None or expire < slotExpire:
+                    slotPos = pos
+                    slotExpire = expire
+            self.SLOT.pack_into(self.data, slotPos, digest, now + ttl, len(value))
+            slotPos += self.SLOT.size
+            self.data[slotPos:slotPos+len(value)] = value
+        finally:
+            self.__unlock(bucket, offset)
+        self.sets += 1
+        return True
+
+
+    def delete(self, key):
+        digest = md5(key).digest()
+        bucket, offset = self.__bucket(digest)
+        self.__lock(bucket, offset, fcntl.LOCK_EX)
+        try:
+            for i in range(self.BUCKET_SLOTS):
+                pos = offset + i * self.slotSize
+                if self.SLOT.unpack_from(self.data, pos)[0] == digest:
+                    self.SLOT.pack_into(self.data, pos, '\0' * 16, 0, 0)
+                    break
+        finally:
+            self.__unlock(bucket, offset)
+
+
+    def clear(self):
+        """Remove all records. Bucket thread locks are taken first, so
+        fcntl lock of buckets can't be released under other threads of
+        this process (locks are owned by process, not by thread)."""
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            length = self.size - self.HEADER_SIZE
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, self.HEADER_SIZE)
+            try:
+                self.data[self.HEADER_SIZE:] = '\0' * length
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, self.HEADER_SIZE)
+        finally:
+            for lock in reversed(self.locks):
+                lock.release()
+
+
+    def close(self):
+        realPath = os.path.realpath(self.fileName)
+        _usersLock.acquire()
+        try:
+            users = _users.get(realPath, [])
+            if self in users:
+                users.remove(self)
+            if len(users) == 0 and _users.has_key(realPath):
+                del(_users[realPath])
+            self.data.close()
+            # closing file descriptor releases all fcntl locks of this
+            # process for the file including those of other instances
+            os.close(self.fd)
+            for user in users:
+                fcntl.lockf(user.fd, fcntl.LOCK_SH, *self.USERS_LOCK)
+        finally:
+            _usersLock.release()
+
+
+    def memoryUsage(self):
+        """Size of memory mapped file (it can't be changed)."""
+        return self.size
+
+
+    def memoryLimit(self, limit):
+        pass
+
+
+    def getStats(self):
+        return { 'slots': self.slots, 'slotSize': self.slotSize,
+                 'hits': self.hits, 'misses': self.misses,
+                 'sets': self.sets, 'drops': self.drops }
+
+
+
+if __name__ == "__main__":
+    print "Module tests:"
+    import sys, tempfile
+    fileName = tempfile.mktemp()
+    cache = SharedCache(fileName, 100, 128)
+    cache.set('a', (1, 'positive'), 60)
+    cache.set('b', (-1, 'negative'), -1)
+    cache.set('c', 'x' * 1000, 60)
+    print cache.get('a'), cache.get('b'), cache.get('c')
+    print SharedCache(fileName, 100, 128).get('a')
+    print cache.getStats()
+    cache.close()
+    os.unlink(fileName)
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Two level result cache (local L1 in front of memcache L2)
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import Queue
+import logging
+import threading
+import metrics
+import cachekey
+
+
+__version__ = "$Revision$"
+
+
+# L1 marker for keys that were not found in L2 by getMulti
+MISS = ('miss', )
+
+
+class TieredCache(object):
+    """Small local cache (L1) with short TTL in front of memcache (L2)
+    shared by all ppolicy servers. Values read from L2 are kept in L1
+    at most l1TTL seconds, so results stored by other servers are used
+    with small delay. New values are stored in L1 immediately and
+    written to L2 by background thread (several values with the same
+    TTL in one set_multi call), writes are dropped when maxQueue
+    values is waiting. getMulti reads values for several keys in one
+    L2 request (e.g. results of all modules used by request) and keys
+    not found in L2 are remembered in L1 for MISS_TTL seconds.
+
+    @ivar l1: local cache (e.g. lrucache.TTLCache)
+    @ivar client: memcache client (thread safe python-memcache)
+    """
+
+    MISS_TTL = 1
+    BATCH = 100
+
+    def __init__(self, l1, client, l1TTL = 5, prefix = 'ppolicy:', maxQueue = 10000):
+        self.l1 = l1
+        self.client = client
+        self.l1TTL = l1TTL
+        self.prefix = prefix
+        self.queue = Queue.Queue(maxQueue)
+        self.l2Hits = 0
+        self.l2Misses = 0
+        self.l2Errors = 0
+        self.writes = 0
+        self.dropped = 0
+        self.writer = threading.Thread(target=self.__write, name="cachewriter")
+        self.writer.setDaemon(True)
+        self.writer.start()
+
+
+    def __l2Key(self, key):
+        return "%s%s" % (self.prefix, cachekey.encodeKey(key))
+
+
+    def get(self, key):
+        value = self.l1.get(key)
+        if value != None:
+            if value is MISS:
+                return None
+            return value
+        try:
+            value = self.client.get(self.__l2Key(key))
+        except Exception, e:
+            self.l2Errors += 1
+            logging.getLogger().warn("L2 cache get failed: %s" % e)
+            return None
+        if value == None:
+            self.l2Misses += 1
+            return None
+        self.l2Hits += 1
+        self.l1.set(key, value, self.l1TTL)
+        return value
+
+
+    def getMulti(self, keys):
+        """Load values for keys missing in L1 with one L2 request."""
+        l2Keys = {}
+        for key in keys:
+            if self.l1.get(key) == None:
+                l2Keys[self.__l2Key(key)] = key
+        if len(l2Keys) == 0:
+            return
+        try:
+            values = self.client.get_multi(l2Keys.keys())
+        except Exception, e:
+            self.l2Errors += 1
+            logging.getLogger().warn("L2 cache get_multi failed: %s" % e)
+            return
+        for l2Key, key in l2Keys.items():
+            value = values.get(l2Key)
+            if value != None:
+                self.l2Hits += 1
+                self.l1.set(key, value, self.l1TTL)
+            else:
+                self.l2Misses += 1
+                self.l1.set(key, MISS, self.MISS_TTL)
+
+
+    def set(self, key, value, ttl):
+        self.l1.set(key, value, min(ttl, self.l1TTL))
+        try:
+            self.queue.put_nowait((self.__l2Key(key), value, int(ttl)))
+        except Queue.Full:
+            self.dropped += 1
+            metrics.inc('cache_writes_dropped_total')
+
+
+    def __write(self):
+        while True:
+            item = self.queue.get()
+            if item == None:
+                break
+            items = [ item ]
+            while len(items) < self.BATCH:
+                try:
+                    item = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if item == None:
+                    self.queue.put(None)
+                    break
+                items.append(item)
+            byTTL = {}
+            for l2Key, value, ttl in items:
+                byTTL.setdefault(ttl, {})[l2Key] = value
+            for ttl, values in byTTL.items():
+                try:
+                    self.client.set_multi(values, ttl)
+                    self.writes += len(values)
+                except Exception, e:
+                    self.l2Errors += 1
+                    logging.getLogger().warn("L2 cache set_multi failed: %s" % e)
+
+
+    def clear(self):
+        """Clear only L1 (L2 is shared with other servers)."""
+        self.l1.clear()
+
+
+    def __len__(self):
+        return len(self.l1)
+
+
+    def memoryUsage(self):
+        return self.l1.memoryUsage()
+
+
+    def memoryLimit(self, limit):
+        self.l1.memoryLimit(limit)
+
+
+    def stop(self):
+        """Write waiting values to L2 and stop writer thread."""
+        self.queue.put(None)
+        self.writer.join(5)
+
+
+    def getStats(self):
+        retVal = self.l1.getStats()
+        retVal.update({ 'l2Hits': self.l2Hits, 'l2Misses': self.l2Misses,
+                        'l2Errors': self.l2Errors, 'writes': self.writes,
+                        'writeQueue': self.queue.qsize(),
+                        'writesDropped': self.dropped })
+        return retVal
@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Multi-process mode - supervisor and worker services
+#
+# Copyright (c) 2005,2011 JAS
+#
+# Author: Petr Vokac <vokac@kmlinux.fjfi.cvut.cz>
+#
+# $Id$
+#
+import os, sys
+import socket
+import logging
+import twisted.python.log
+from twisted.application import service
+from twisted.internet import reactor, protocol, defer
+
+
+__version__ = "$Revision$"
+
+
+WORKER_ENV = 'PPOLICY_WORKER'
+
+
+def getWorkerId():
+    """Return worker number (1..N) for worker process, 0 for supervisor
+    or for ppolicy running in single process mode."""
+    try:
+        return int(os.environ.get(WORKER_ENV, 0))
+    except ValueError:
+        return 0
+
+
+class ReusePortServer(service.Service):
+    """TCP server service listening on socket with SO_REUSEPORT, so
+    all worker processes can listen on the same port and kernel
+    distributes incomming connections between them."""
+
+    def __init__(self, port, factory, backlog = 50, interface = ''):
+        self.port = port
+        self.factory = factory
+        self.backlog = backlog
+        self.interface = interface
+        self._port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            # python < 2.7 doesn't export this constant (linux >= 3.9)
+            socket.SO_REUSEPORT = 15
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.interface, self.port))
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        try:
+            self._port = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, self.factory)
+        finally:
+            # reactor uses its own copy of socket descriptor
+            sock.close()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._port != None:
+            d = defer.maybeDeferred(self._port.stopListening)
+            self._port = None
+            return d
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    """Process protocol for one worker, it forwards worker output
+    to supervisor log."""
+
+    def __init__(self, supervisor, workerId):
+        self.supervisor = supervisor
+        self.workerId = workerId
+        self.buffer = ''
+        self.stopped = defer.Deferred()
+
+    def outReceived(self, data):
+        lines = (self.buffer + data).split('\n')
+        self.buffer = lines.pop()
+        for line in lines:
+            twisted.python.log.msg("[worker %i] %s" % (self.workerId, line))
+
+    def errReceived(self, data):
+        self.outReceived(data)
+
+    def processEnded(self, reason):
+        if self.buffer != '':
+            twisted.python.log.msg("[worker %i] %s" % (self.workerId, self.buffer))
+            self.buffer = ''
+        self.supervisor.workerEnded(self, reason)
+        self.stopped.callback(None)
+
+
+class WorkerSupervisor(service.Service):
+    """Start configured number of ppolicy worker processes (twistd with
+    the same tap file), restart worker that died and stop all workers
+    when supervisor is stopped. Workers are distinguished by PPOLICY_WORKER
+    environment variable."""
+
+    def __init__(self, workers, tapFile, restartDelay = 5, stopTimeout = 30):
+        self.workers = workers
+        self.tapFile = tapFile
+        self.restartDelay = restartDelay
+        self.stopTimeout = stopTimeout
+        self.processes = {}
+        self.stopping = False
+
+    def __spawn(self, workerId):
+        logging.getLogger().info("starting worker %i" % workerId)
+        env = os.environ.copy()
+        env[WORKER_ENV] = str(workerId)
+        args = [ sys.executable, sys.argv[0], '--nodaemon', '--pidfile=',
+                 '--logfile=-', '--python=%s' % self.tapFile ]
+        proc = WorkerProcess(self, workerId)
+        reactor.spawnProcess(proc, sys.executable, args, env)
+        self.processes[workerId] = proc
+
+    def startService(self):
+        service.Service.startService(self)
+        self.stopping = False
+        for workerId in range(1, self.workers + 1):
+            self.__spawn(workerId)
+
+    def workerEnded(self, proc, reason):
+        logging.getLogger().warn("worker %i ended: %s" % (proc.workerId, reason.getErrorMessage()))
+        if self.processes.get(proc.workerId) == proc:
+            del(self.processes[proc.workerId])
+        if not self.stopping:
+            reactor.callLater(self.restartDelay, self.__restart, proc.workerId)
+
+    def __restart(self, workerId):
+        if not self.stopping and not self.processes.has_key(workerId):
+            self.__spawn(workerId)
+
+    def __signal(self, sig):
+        for proc in self.processes.values():
+            try:
+                proc.transport.signalProcess(sig)
+            except Exception, e:
+                logging.getLogger().debug("unable to send signal %s to worker %i: %s" % (sig, proc.workerId, e))
+
+    def reload(self):
+        """Forward configuration reload request to all workers."""
+        logging.getLogger().info("reloading %i workers" % len(self.processes))
+        self.__signal('HUP')
+
+    def stopService(self):
+        """Send SIGTERM to all workers (they save their state in
+        stopFactory) and wait until they exit, workers that doesn't
+        exit in stopTimeout seconds are killed."""
+        service.Service.stopService(self)
+        self.stopping = True
+        if len(self.processes) == 0:
+            return
+        logging.getLogger().info("stopping %i workers" % len(self.processes))
+        d = defer.DeferredList([ x.stopped for x in self.processes.values() ])
+        self.__signal('TERM')
+        killCall = reactor.callLater(self.stopTimeout, self.__signal, 'KILL')
+        def stopped(result):
+            if killCall.active():
+                killCall.cancel()
+            return result
+        d.addBoth(stopped)
+        return d